@@ -1,20 +1,52 @@
-from flask import Flask, render_template, jsonify, request, session as flask_session, flash, redirect, url_for
+from flask import Flask, Request, render_template, jsonify, request, session as flask_session, flash, redirect, url_for, Response, stream_with_context, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import create_engine, event, insert, make_url, text, inspect as sqlalchemy_inspect, types as sqlalchemy_types
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.exc import IntegrityError, OperationalError
+from itsdangerous import URLSafeSerializer, BadSignature
 import pandas as pd
+import numpy as np
 import os
+import re
+import time
+import uuid
+import threading
+import queue
+import random
+import atexit
 import logging
-import matplotlib
-import matplotlib.pyplot as plt
+import multiprocessing
 import secrets
 import hashlib
 import sqlite3
+import sys
 from datetime import datetime, timedelta
 import json
+import io
+import csv
+import zlib
+import tempfile
+import gzip
+import base64
+import zipfile
+import shutil
 from werkzeug.security import generate_password_hash, check_password_hash
-from functools import wraps
+from werkzeug.utils import secure_filename
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from openpyxl import Workbook
+from decimal import Decimal
+try:
+    import msgpack
+except ImportError:  # optional; MessagePack responses are offered only when it is installed
+    msgpack = None
+from functools import wraps, lru_cache
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+import chart_render
+import upload_parse
 import requests
-matplotlib.use('Agg')
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -32,6 +64,95 @@ app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
+# SQLite connection settings, applied to every SQLite engine: 'wal' for multi-worker servers, 'legacy' for SQLite's defaults
+app.config['SQLITE_STORAGE_PROFILE'] = os.getenv('SQLITE_STORAGE_PROFILE', 'wal')
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+app.config['SQLITE_CACHE_SIZE_KB'] = int(os.getenv('SQLITE_CACHE_SIZE_KB', 32768))
+app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# Writes that still find the database locked are retried with exponential backoff
+app.config['SQLITE_WRITE_RETRIES'] = int(os.getenv('SQLITE_WRITE_RETRIES', 5))
+app.config['SQLITE_RETRY_BACKOFF_MS'] = int(os.getenv('SQLITE_RETRY_BACKOFF_MS', 50))
+
+# Rows fetched per round trip when streaming /manage results
+app.config['MANAGE_STREAM_BATCH_SIZE'] = int(os.getenv('MANAGE_STREAM_BATCH_SIZE', 1000))
+
+# Pagination for /manage results
+app.config['MANAGE_MAX_PAGE_SIZE'] = int(os.getenv('MANAGE_MAX_PAGE_SIZE', 1000))
+app.config['PAGE_CURSOR_TTL'] = int(os.getenv('PAGE_CURSOR_TTL', 300))
+app.config['PAGE_CURSOR_MAX_OPEN'] = int(os.getenv('PAGE_CURSOR_MAX_OPEN', 20))
+app.config['PAGE_CURSOR_MAX_PER_USER'] = int(os.getenv('PAGE_CURSOR_MAX_PER_USER', 3))
+# Pooled connections per engine that held cursors never take, so other requests aren't starved
+app.config['PAGE_CURSOR_POOL_HEADROOM'] = int(os.getenv('PAGE_CURSOR_POOL_HEADROOM', 5))
+page_token_serializer = URLSafeSerializer(app.secret_key, salt='manage-page-token')
+
+# In-process cache for repeated SELECT results
+app.config['RESULT_CACHE_MAX_ENTRIES'] = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 256))
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.getenv('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['RESULT_CACHE_TTL'] = int(os.getenv('RESULT_CACHE_TTL', 300))
+
+# Rows parsed and inserted per batch when ingesting uploads
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.getenv('UPLOAD_CHUNK_SIZE', 50000))
+app.config['UPLOAD_WORKERS'] = int(os.getenv('UPLOAD_WORKERS', 2))
+# Seconds between heartbeats of queued and running upload jobs; a job silent for four intervals is interrupted
+app.config['UPLOAD_JOB_HEARTBEAT'] = int(os.getenv('UPLOAD_JOB_HEARTBEAT', 15))
+# Multi-file, archive and multi-sheet uploads: files parsed at once in worker processes (0 parses in
+# the loading threads) and tables written at once; SQLite takes one writer at a time, so tables load in turn there
+app.config['UPLOAD_PARSE_WORKERS'] = int(os.getenv('UPLOAD_PARSE_WORKERS', min(4, os.cpu_count() or 1)))
+app.config['UPLOAD_TABLE_WRITERS'] = int(os.getenv('UPLOAD_TABLE_WRITERS', 4))
+app.config['UPLOAD_MAX_FILES'] = int(os.getenv('UPLOAD_MAX_FILES', 200))
+app.config['UPLOAD_MAX_ARCHIVE_BYTES'] = int(os.getenv('UPLOAD_MAX_ARCHIVE_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Use /tmp directory for Render compatibility
+UPLOAD_FOLDER = '/tmp/uploads'
+UPLOAD_EXTENSIONS = ('.csv', '.json', '.ndjson', '.jsonl', '.xlsx', '.xls')
+
+# Connection pools for user-selected databases
+app.config['ENGINE_POOL_SIZE'] = int(os.getenv('ENGINE_POOL_SIZE', 5))
+app.config['ENGINE_MAX_OVERFLOW'] = int(os.getenv('ENGINE_MAX_OVERFLOW', 10))
+app.config['ENGINE_POOL_RECYCLE'] = int(os.getenv('ENGINE_POOL_RECYCLE', 1800))
+app.config['ENGINE_REGISTRY_MAX'] = int(os.getenv('ENGINE_REGISTRY_MAX', 32))
+app.config['ENGINE_IDLE_TIMEOUT'] = int(os.getenv('ENGINE_IDLE_TIMEOUT', 600))
+
+# Write-behind query history logging
+app.config['QUERY_LOG_QUEUE_SIZE'] = int(os.getenv('QUERY_LOG_QUEUE_SIZE', 10000))
+app.config['QUERY_LOG_BATCH_SIZE'] = int(os.getenv('QUERY_LOG_BATCH_SIZE', 200))
+app.config['QUERY_LOG_FLUSH_INTERVAL_MS'] = int(os.getenv('QUERY_LOG_FLUSH_INTERVAL_MS', 500))
+app.config['QUERY_LOG_OVERFLOW'] = os.getenv('QUERY_LOG_OVERFLOW', 'sync')  # 'sync', 'block' or 'drop'
+app.config['QUERY_LOG_BLOCK_TIMEOUT'] = float(os.getenv('QUERY_LOG_BLOCK_TIMEOUT', 1.0))
+
+# Rendered charts, cached in memory and served by content hash
+app.config['CHART_CACHE_MAX_ENTRIES'] = int(os.getenv('CHART_CACHE_MAX_ENTRIES', 128))
+app.config['CHART_CACHE_MAX_BYTES'] = int(os.getenv('CHART_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['CHART_CACHE_TTL'] = int(os.getenv('CHART_CACHE_TTL', 3600))
+# Rendered charts are files named by their hash here, so any worker can serve a /charts/ URL
+app.config['CHART_CACHE_DIR'] = os.getenv('CHART_CACHE_DIR', '/tmp/chatdb-charts')
+app.config['CHART_DEFAULT_DPI'] = int(os.getenv('CHART_DEFAULT_DPI', 300))
+app.config['CHART_MAX_DPI'] = int(os.getenv('CHART_MAX_DPI', 300))
+# Largest render in total pixels (width x height x dpi squared); the default fits the default size at 300 dpi
+app.config['CHART_MAX_PIXELS'] = int(os.getenv('CHART_MAX_PIXELS', 16_000_000))
+# Larger inputs are reduced before plotting
+app.config['CHART_MAX_POINTS'] = int(os.getenv('CHART_MAX_POINTS', 4000))
+app.config['CHART_MAX_BARS'] = int(os.getenv('CHART_MAX_BARS', 200))
+# Render worker processes (0 renders in the request thread) and how long a request waits for one
+app.config['CHART_RENDER_WORKERS'] = int(os.getenv('CHART_RENDER_WORKERS', min(4, os.cpu_count() or 1)))
+app.config['CHART_RENDER_TIMEOUT'] = float(os.getenv('CHART_RENDER_TIMEOUT', 30))
+
+# Execution budget for user SQL; users may pick their own limits up to the *_MAX values
+app.config['QUERY_TIMEOUT'] = float(os.getenv('QUERY_TIMEOUT', 30))
+app.config['QUERY_TIMEOUT_MAX'] = float(os.getenv('QUERY_TIMEOUT_MAX', 300))
+app.config['QUERY_MAX_ROWS'] = int(os.getenv('QUERY_MAX_ROWS', 100000))
+app.config['QUERY_MAX_ROWS_MAX'] = int(os.getenv('QUERY_MAX_ROWS_MAX', 1000000))
+# Seconds between checks for cancellations requested through another worker process
+app.config['QUERY_CANCEL_POLL'] = float(os.getenv('QUERY_CANCEL_POLL', 0.5))
+
+# Queries slower than this (seconds) are logged with their plan and a timing breakdown
+app.config['SLOW_QUERY_THRESHOLD'] = float(os.getenv('SLOW_QUERY_THRESHOLD', 1.0))
+
+# Index advisor: history entries mined, smallest table worth indexing, most indexes created by one auto run
+app.config['INDEX_ADVISOR_HISTORY'] = int(os.getenv('INDEX_ADVISOR_HISTORY', 500))
+app.config['INDEX_ADVISOR_MIN_ROWS'] = int(os.getenv('INDEX_ADVISOR_MIN_ROWS', 1000))
+app.config['INDEX_ADVISOR_MAX_AUTO'] = int(os.getenv('INDEX_ADVISOR_MAX_AUTO', 3))
+
 # Hugging Face API Key
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
 
@@ -70,6 +191,81 @@ class QueryHistory(db.Model):
     success = db.Column(db.Boolean, default=True)
     error_message = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_query_history_user_created', 'user_id', 'created_at'),
+    )
+
+class UserQueryStats(db.Model):
+    # One row per (user, query type), incremented as history is written
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    query_type = db.Column(db.String(50), primary_key=True)
+    total_count = db.Column(db.Integer, nullable=False, default=0)
+    success_count = db.Column(db.Integer, nullable=False, default=0)
+    total_execution_time = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UserQueryLimits(db.Model):
+    # Per-user execution budget; NULL falls back to the QUERY_TIMEOUT / QUERY_MAX_ROWS defaults
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    timeout = db.Column(db.Float)
+    max_rows = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UploadCatalog(db.Model):
+    # Which file content last loaded each table, so an identical re-upload can be skipped
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    database = db.Column(db.String(512), nullable=False)  # engine URL without the password
+    table_name = db.Column(db.String(255), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)
+    options_key = db.Column(db.String(16), nullable=False)
+    filename = db.Column(db.String(255))
+    stats = db.Column(db.Text)  # JSON: columns, row_count, schema and keys of the loaded table
+    change_marker = db.Column(db.String(64))  # table_change_marker just after loading
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('database', 'table_name', name='uq_upload_catalog_table'),
+        db.Index('ix_upload_catalog_hash', 'content_hash'),
+    )
+
+class QueryTicket(db.Model):
+    # A query id issued by POST /manage/query_id; the cancel flag lives here so any worker can set it
+    query_id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='issued')  # issued, then running once claimed
+    cancelled = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class TableVersion(db.Model):
+    # Bumped on every write to a table; part of each result cache key, so all workers see the change
+    table_name = db.Column(db.String(255), primary_key=True)  # lower-cased; '*' when the written tables are unknown
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class SlowQuery(db.Model):
+    # Written alongside the query_history row for any query over SLOW_QUERY_THRESHOLD
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    query = db.Column(db.Text, nullable=False)
+    fingerprint = db.Column(db.String(16))
+    source = db.Column(db.String(20))  # 'manage' or 'visualize'
+    execution_time = db.Column(db.Float)
+    execute_time = db.Column(db.Float)
+    fetch_time = db.Column(db.Float)
+    serialize_time = db.Column(db.Float)
+    row_count = db.Column(db.Integer)
+    plan = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_slow_query_user_created', 'user_id', 'created_at'),
+    )
+    
+    @property
+    def full_scans(self):
+        """Plan lines that read a whole table rather than searching an index"""
+        return [line.strip() for line in (self.plan or '').splitlines() if FULL_SCAN_PATTERN.search(line)]
 
 class DatabaseConnection(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -80,6 +276,21 @@ class DatabaseConnection(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class UploadJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    filename = db.Column(db.String(255), nullable=False)
+    table_name = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running', 'completed', 'failed', 'interrupted'
+    rows_processed = db.Column(db.Integer, default=0)
+    rows_per_second = db.Column(db.Float)
+    error_message = db.Column(db.Text)
+    worker_pid = db.Column(db.Integer)
+    heartbeat_at = db.Column(db.DateTime)  # refreshed by the owning process while queued or running
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
 # Security decorators
 def login_required(f):
     @wraps(f)
@@ -108,35 +319,3069 @@ def login_required(f):
             flash('An error occurred. Please try again.', 'error')
             return redirect(url_for('login'))
     
-    return decorated_function
+    return decorated_function
+
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in flask_session:
+            flash('Please log in to access this page.', 'warning')
+            return redirect(url_for('login'))
+        # Add admin check logic here if needed
+        return f(*args, **kwargs)
+    return decorated_function
+
+# SQLite storage profile
+def sqlite_pragmas():
+    """PRAGMAs run on each new SQLite connection for the configured storage profile"""
+    if app.config['SQLITE_STORAGE_PROFILE'] != 'wal':
+        return []
+    return [
+        # First, so switching the journal mode waits for other connections instead of failing
+        f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}",
+        # Readers and the writer no longer block each other; the mode is stored in the database file
+        "PRAGMA journal_mode=WAL",
+        # Durable across application crashes in WAL mode; only a power loss can drop the latest commits
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_SIZE_KB']}",
+        f"PRAGMA mmap_size={app.config['SQLITE_MMAP_SIZE']}"
+    ]
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_storage_profile(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in sqlite_pragmas():
+            try:
+                cursor.execute(pragma)
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Could not apply {pragma}: {e}")
+    finally:
+        cursor.close()
+
+def is_lock_error(error):
+    error = getattr(error, 'orig', None) or error
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+def retry_on_lock(f):
+    """Retry a write with jittered exponential backoff while SQLite reports the database locked
+
+    The wrapped call must be safe to repeat, i.e. commit everything or leave nothing behind.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        retries = app.config['SQLITE_WRITE_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                return f(*args, **kwargs)
+            except (OperationalError, sqlite3.OperationalError) as e:
+                if attempt == retries or not is_lock_error(e):
+                    raise
+                if has_app_context():
+                    db.session.rollback()
+                delay = app.config['SQLITE_RETRY_BACKOFF_MS'] / 1000 * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning(f"Database locked in {f.__name__}, retrying in {delay * 1000:.0f} ms ({attempt + 1}/{retries})")
+                time.sleep(delay)
+    return decorated_function
+
+# Utility functions
+class QueryLogWriter:
+    """Buffers QueryHistory rows in a bounded queue and bulk-inserts them from a background thread"""
+    def __init__(self, max_queue, batch_size, flush_interval, overflow, block_timeout):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        # Users whose stats rows are known to cover their existing history
+        self._stats_ready = set()
+        self.written = 0
+        self.dropped = 0
+    
+    def _ensure_started(self):
+        # Threads don't survive a fork, so each app server worker starts its own flusher
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='query-log-writer', daemon=True)
+                self._thread.start()
+    
+    def enqueue(self, record):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        
+        if self.overflow == 'sync':
+            self._write([record])
+        elif self.overflow == 'block':
+            try:
+                self._queue.put(record, timeout=self.block_timeout)
+            except queue.Full:
+                self.dropped += 1
+                logger.warning("Query log queue full, dropped history record")
+        else:
+            self.dropped += 1
+            logger.warning("Query log queue full, dropped history record")
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+    
+    def _write(self, batch):
+        with self._write_lock, app.app_context():
+            slow = []
+            for record in batch:
+                details = record.pop('slow', None)
+                if details:
+                    slow.append({**details, "user_id": record['user_id'], "query": record['query'],
+                                 "execution_time": record['execution_time'], "created_at": record['created_at']})
+            try:
+                self._insert(batch, slow)
+                self.written += len(batch)
+            except Exception as e:
+                db.session.rollback()
+                self.dropped += len(batch)
+                logger.error(f"Error writing {len(batch)} query history records: {e}")
+    
+    @retry_on_lock
+    def _insert(self, batch, slow):
+        new_users = {record['user_id'] for record in batch if record['user_id'] is not None} - self._stats_ready
+        for user_id in new_users:
+            ensure_user_stats(user_id)
+        db.session.execute(insert(QueryHistory), batch)
+        if slow:
+            db.session.execute(insert(SlowQuery), slow)
+        increment_user_stats(batch)
+        db.session.commit()
+        # Only once committed, so a retried batch seeds these users' stats again
+        self._stats_ready.update(new_users)
+    
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+    
+    def flush(self, timeout=5.0):
+        """Write everything queued so far, waiting briefly for a batch already being written"""
+        batch = self._drain()
+        if batch:
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._queue.all_tasks_done.wait(remaining):
+                    break
+
+query_log_writer = QueryLogWriter(
+    app.config['QUERY_LOG_QUEUE_SIZE'],
+    app.config['QUERY_LOG_BATCH_SIZE'],
+    app.config['QUERY_LOG_FLUSH_INTERVAL_MS'] / 1000,
+    app.config['QUERY_LOG_OVERFLOW'],
+    app.config['QUERY_LOG_BLOCK_TIMEOUT']
+)
+atexit.register(query_log_writer.flush)
+
+def increment_user_stats(records):
+    """Fold a batch of history records into user_query_stats with one upsert per (user, type)"""
+    totals = {}
+    for record in records:
+        if record['user_id'] is None:
+            continue
+        key = (record['user_id'], record['query_type'])
+        entry = totals.setdefault(key, {"total_count": 0, "success_count": 0, "total_execution_time": 0.0})
+        entry['total_count'] += 1
+        entry['success_count'] += 1 if record['success'] else 0
+        entry['total_execution_time'] += record['execution_time'] or 0.0
+    if not totals:
+        return
+    
+    now = datetime.utcnow()
+    statement = sqlite_insert(UserQueryStats)
+    statement = statement.on_conflict_do_update(
+        index_elements=['user_id', 'query_type'],
+        set_={
+            "total_count": UserQueryStats.total_count + statement.excluded.total_count,
+            "success_count": UserQueryStats.success_count + statement.excluded.success_count,
+            "total_execution_time": UserQueryStats.total_execution_time + statement.excluded.total_execution_time,
+            "updated_at": statement.excluded.updated_at
+        }
+    )
+    db.session.execute(statement, [
+        {"user_id": user_id, "query_type": query_type, "updated_at": now, **entry}
+        for (user_id, query_type), entry in totals.items()
+    ])
+
+def ensure_user_stats(user_id):
+    """Seed stats from existing history the first time a user is seen without any stats rows"""
+    if db.session.query(UserQueryStats.user_id).filter_by(user_id=user_id).first() is not None:
+        return False
+    
+    db.session.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_query_history_user_created ON query_history (user_id, created_at)"
+    ))
+    aggregates = db.session.query(
+        QueryHistory.query_type,
+        db.func.count(QueryHistory.id),
+        db.func.sum(db.case((QueryHistory.success == True, 1), else_=0)),
+        db.func.coalesce(db.func.sum(QueryHistory.execution_time), 0.0)
+    ).filter(QueryHistory.user_id == user_id).group_by(QueryHistory.query_type).all()
+    
+    now = datetime.utcnow()
+    for query_type, total_count, success_count, total_execution_time in aggregates:
+        db.session.add(UserQueryStats(
+            user_id=user_id,
+            query_type=query_type,
+            total_count=total_count,
+            success_count=success_count or 0,
+            total_execution_time=total_execution_time,
+            updated_at=now
+        ))
+    db.session.flush()
+    return bool(aggregates)
+
+def log_query(query, query_type, execution_time=None, success=True, error_message=None, user_id=None, slow=None):
+    """Log query execution for analytics; the row is written asynchronously by query_log_writer
+
+    slow holds the slow_query_details() breakdown when the query went over the threshold.
+    """
+    try:
+        # Background jobs pass user_id explicitly since they have no request session
+        if user_id is None:
+            user_id = flask_session.get('user_id')
+        query_log_writer.enqueue({
+            "user_id": user_id,
+            "query": query,
+            "query_type": query_type,
+            "execution_time": execution_time,
+            "success": success,
+            "error_message": error_message,
+            "created_at": datetime.utcnow(),
+            "slow": slow
+        })
+    except Exception as e:
+        logger.error(f"Error logging query: {e}")
+
+# Slow query log
+QUERY_STAGES = ('execute', 'fetch', 'serialize')
+# SQLite reports "SCAN t" for full table scans (index scans say "USING ... INDEX"); Postgres "Seq Scan", MySQL "ALL"
+FULL_SCAN_PATTERN = re.compile(r"^\s*SCAN (?!.*\bUSING\b.*\bINDEX\b)|Seq Scan|\| ALL \|")
+
+class QueryTimings:
+    """Wall time spent in each stage of one query"""
+    def __init__(self):
+        self.stages = dict.fromkeys(QUERY_STAGES, 0.0)
+    
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+
+def explain_query(engine, query, limits=None):
+    """The backend's plan for a query as text, without running it"""
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as connection, query_budget(connection, limits or get_query_limits()):
+            rows = connection.execute(text(f"EXPLAIN QUERY PLAN {normalize_sql(query)}")).fetchall()
+        # Rows are (id, parent, notused, detail); indent children under their parent like the sqlite3 shell
+        depth, lines = {0: -1}, []
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[node_id] + detail)
+        return "\n".join(lines)
+    
+    with engine.connect() as connection, query_budget(connection, limits or get_query_limits()):
+        result = connection.execute(text(f"EXPLAIN {normalize_sql(query)}"))
+        rows = result.fetchall()
+        columns = list(result.keys())
+    if len(columns) == 1:
+        return "\n".join(str(row[0]) for row in rows)
+    return "\n".join([" | ".join(columns)] + [" | ".join("" if value is None else str(value) for value in row) for row in rows])
+
+def slow_query_details(query, engine, execution_time, timings, row_count, source, limits=None):
+    """Plan and timing breakdown for log_query when a query went over SLOW_QUERY_THRESHOLD, else None"""
+    if execution_time is None or execution_time < app.config['SLOW_QUERY_THRESHOLD']:
+        return None
+    try:
+        plan = explain_query(engine, query, limits)
+    except Exception as e:
+        plan = f"Plan unavailable: {e}"
+    logger.warning(f"Slow query ({execution_time:.3f}s, {row_count} rows) from {source}: {normalize_sql(query)[:200]}")
+    return {
+        "fingerprint": parse_sql(query).fingerprint,
+        "source": source,
+        "execute_time": timings.stages['execute'],
+        "fetch_time": timings.stages['fetch'],
+        "serialize_time": timings.stages['serialize'],
+        "row_count": row_count,
+        "plan": plan
+    }
+
+def ndjson_line(payload):
+    """Serialize one NDJSON record using the app's JSON provider"""
+    return app.json.dumps(payload) + "\n"
+
+# Response encoding
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+COMPRESS_MIN_BYTES = 1024
+RESULT_FORMATS = ('rows', 'columnar')
+
+def column_types(columns, rows):
+    """Type name per column, taken from its first non-NULL value"""
+    types = []
+    for index in range(len(columns)):
+        value = next((row[index] for row in rows if row[index] is not None), None)
+        if value is None:
+            types.append('null')
+        elif isinstance(value, bool):
+            types.append('boolean')
+        elif isinstance(value, int):
+            types.append('integer')
+        elif isinstance(value, (float, Decimal)):
+            types.append('real')
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            types.append('blob')
+        elif isinstance(value, datetime):
+            types.append('datetime')
+        else:
+            types.append('text')
+    return types
+
+def msgpack_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+def wants_msgpack():
+    if msgpack is None:
+        return False
+    return request.accept_mimetypes.best_match(['application/json', *MSGPACK_MIMETYPES]) in MSGPACK_MIMETYPES
+
+def negotiated_response(payload, status=200):
+    """Serialize as JSON or MessagePack and compress with gzip or deflate, following the Accept headers"""
+    if wants_msgpack():
+        response = Response(msgpack.packb(payload, default=msgpack_default), status=status, mimetype='application/msgpack')
+    else:
+        response = jsonify(payload)
+        response.status_code = status
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    body = response.get_data()
+    if encoding and len(body) >= COMPRESS_MIN_BYTES:
+        response.set_data(gzip.compress(body, compresslevel=6) if encoding == 'gzip' else zlib.compress(body, 6))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+def result_payload(columns, rows, result_format):
+    """Rows as a list of objects (the original format) or as columns, types and row arrays"""
+    if result_format == 'columnar':
+        return {"columns": columns, "types": column_types(columns, rows), "rows": [list(row) for row in rows]}
+    return {"data": [dict(zip(columns, row)) for row in rows]}
+
+def stream_select_results(connection, result, query, start_time, batch_size, running, max_rows, timings):
+    """Yield a SELECT result as NDJSON batches, closing the connection when done"""
+    row_count = 0
+    truncated = False
+    try:
+        yield ndjson_line({"columns": list(result.keys()), "query_id": running.query_id})
+        while True:
+            running.check()
+            with timings.stage('fetch'):
+                batch = result.fetchmany(min(batch_size, max_rows + 1 - row_count))
+            if not batch:
+                break
+            if row_count + len(batch) > max_rows:
+                # Stop at the row cap without reading further
+                batch = batch[:max_rows - row_count]
+                truncated = True
+            row_count += len(batch)
+            with timings.stage('serialize'):
+                line = ndjson_line({"rows": [list(row) for row in batch]})
+            yield line
+            if truncated:
+                break
+        
+        execution_time = (datetime.now() - start_time).total_seconds()
+        log_query(query, 'select', execution_time, True,
+                  slow=slow_query_details(query, connection.engine, execution_time, timings, row_count, 'manage'))
+        yield ndjson_line({"done": True, "row_count": row_count, "execution_time": execution_time,
+                           "truncated": truncated, "max_rows": max_rows})
+    except Exception as e:
+        execution_time = (datetime.now() - start_time).total_seconds()
+        aborted = e if isinstance(e, QueryAborted) else running.aborted(e)
+        if aborted is not None:
+            log_query(query, aborted.status, execution_time, False, str(aborted))
+            yield ndjson_line({"error": str(aborted), "status": aborted.status, "row_count": row_count})
+        else:
+            logger.error(f"Error streaming query results: {e}")
+            log_query(query, 'error', execution_time, False, str(e))
+            yield ndjson_line({"error": str(e), "row_count": row_count})
+    finally:
+        # Closed first: MySQL can't reset the session limit while an unbuffered result is open
+        result.close()
+        running.disarm()
+        connection.close()
+
+# Execution budget
+QueryLimits = namedtuple('QueryLimits', ['timeout', 'max_rows'])
+SQLITE_PROGRESS_STEPS = 10000
+# How PostgreSQL, MySQL and MariaDB report a statement stopped by its server-side time limit
+SERVER_TIMEOUT_MESSAGES = ('statement timeout', 'maximum statement execution time exceeded', 'max_statement_time exceeded')
+
+class QueryAborted(Exception):
+    """Raised when a statement is stopped by its time limit or a cancel request"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.status_code = 408 if status == 'timeout' else 409
+
+def get_query_limits(user_id=None):
+    """The user's own timeout and row cap, falling back to the defaults and capped by the server maxima"""
+    user_id = user_id or flask_session.get('user_id')
+    limits = db.session.get(UserQueryLimits, user_id) if user_id else None
+    timeout = (limits.timeout if limits and limits.timeout else None) or app.config['QUERY_TIMEOUT']
+    max_rows = (limits.max_rows if limits and limits.max_rows else None) or app.config['QUERY_MAX_ROWS']
+    return QueryLimits(min(timeout, app.config['QUERY_TIMEOUT_MAX']), min(max_rows, app.config['QUERY_MAX_ROWS_MAX']))
+
+class RunningQuery:
+    """A statement in flight that can time out or be cancelled from another request"""
+    def __init__(self, query_id, user_id, connection, timeout):
+        self.query_id = query_id or uuid.uuid4().hex
+        self.user_id = user_id
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.cancelled = False
+        self._connection = connection
+        self._dialect = connection.dialect.name
+        self._dbapi_connection = connection.connection.dbapi_connection
+    
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+    
+    def _progress(self):
+        # A non-zero return makes SQLite abort the running statement
+        return 1 if self.cancelled or self.expired() else 0
+    
+    def arm(self):
+        running_queries.add(self)
+        if self._dialect == 'sqlite':
+            self._dbapi_connection.set_progress_handler(self._progress, SQLITE_PROGRESS_STEPS)
+        elif self._dialect == 'postgresql' and self.timeout:
+            # SET LOCAL ends with the transaction, so pooled connections come back clean
+            self._connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(self.timeout * 1000)}")
+        elif self._dialect == 'mysql' and self.timeout:
+            # Session-wide, so disarm restores the server default before the connection is pooled again
+            if getattr(self._connection.dialect, 'is_mariadb', False):
+                self._connection.exec_driver_sql(f"SET SESSION max_statement_time = {self.timeout:g}")
+            else:
+                self._connection.exec_driver_sql(f"SET SESSION max_execution_time = {int(self.timeout * 1000)}")
+        return self
+    
+    def disarm(self):
+        running_queries.remove(self)
+        if self._dialect == 'sqlite':
+            self._dbapi_connection.set_progress_handler(None, 0)
+        elif self._dialect == 'mysql' and self.timeout:
+            variable = 'max_statement_time' if getattr(self._connection.dialect, 'is_mariadb', False) else 'max_execution_time'
+            try:
+                self._connection.exec_driver_sql(f"SET SESSION {variable} = DEFAULT")
+            except Exception as e:
+                # Don't hand the next user a connection that still carries this query's limit
+                logger.warning(f"Could not reset {variable}, discarding the connection: {e}")
+                self._connection.invalidate()
+    
+    def check(self):
+        """Raise if the budget ran out; used between fetches on backends without an interrupt hook"""
+        if self.cancelled or self.expired():
+            raise self.aborted()
+    
+    def cancel(self):
+        self.cancelled = True
+        if self._dialect == 'sqlite':
+            self._dbapi_connection.interrupt()
+        elif hasattr(self._dbapi_connection, 'cancel'):
+            self._dbapi_connection.cancel()
+    
+    def aborted(self, error=None):
+        """The QueryAborted for this statement, or None if `error` is unrelated to the budget"""
+        if self.cancelled:
+            return QueryAborted('cancelled', "Query was cancelled")
+        if self.expired() or (error is not None and any(message in str(error).lower() for message in SERVER_TIMEOUT_MESSAGES)):
+            return QueryAborted('timeout', f"Query exceeded the {self.timeout:g}s time limit")
+        return None
+
+class RunningQueryRegistry:
+    """Statements currently executing in this process, by query id"""
+    def __init__(self):
+        self._queries = {}
+        self._lock = threading.Lock()
+    
+    def add(self, running):
+        with self._lock:
+            if running.query_id in self._queries:
+                raise QueryIdError("A query with this id is already running")
+            self._queries[running.query_id] = running
+    
+    def remove(self, running):
+        with self._lock:
+            if self._queries.get(running.query_id) is running:
+                del self._queries[running.query_id]
+    
+    def get(self, query_id):
+        with self._lock:
+            return self._queries.get(query_id)
+    
+    def ids(self):
+        with self._lock:
+            return list(self._queries)
+
+running_queries = RunningQueryRegistry()
+query_cancel_watcher_pid = None
+query_cancel_watcher_lock = threading.Lock()
+
+class QueryIdError(Exception):
+    """Raised for a query id that wasn't issued to the caller or is already in use"""
+    status_code = 409
+
+@retry_on_lock
+def issue_query_id(user_id):
+    """Issue an id the client can send with a query and cancel through any worker while it runs"""
+    # Tickets are only needed while their query runs
+    QueryTicket.query.filter(QueryTicket.created_at < datetime.utcnow() - timedelta(days=1)).delete(synchronize_session=False)
+    ticket = QueryTicket(query_id=uuid.uuid4().hex, user_id=user_id)
+    db.session.add(ticket)
+    db.session.commit()
+    return ticket.query_id
+
+@retry_on_lock
+def claim_query_id(query_id):
+    """The id to run a statement under: a fresh one, or `query_id` if it was issued to this user and is unused"""
+    if not query_id:
+        return uuid.uuid4().hex
+    claimed = QueryTicket.query.filter(
+        QueryTicket.query_id == str(query_id),
+        QueryTicket.user_id == flask_session.get('user_id'),
+        QueryTicket.status == 'issued'
+    ).update({QueryTicket.status: 'running'}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        raise QueryIdError("Unknown or already used query_id; request a new one from POST /manage/query_id")
+    ensure_query_cancel_watcher()
+    return query_id
+
+def ensure_query_cancel_watcher():
+    """Start, once per process, the thread that applies cancellations recorded by other workers"""
+    global query_cancel_watcher_pid
+    with query_cancel_watcher_lock:
+        if query_cancel_watcher_pid == os.getpid():
+            return
+        query_cancel_watcher_pid = os.getpid()
+    threading.Thread(target=query_cancel_loop, name='query-cancel', daemon=True).start()
+
+def query_cancel_loop():
+    while True:
+        time.sleep(app.config['QUERY_CANCEL_POLL'])
+        local = running_queries.ids()
+        if not local:
+            continue
+        try:
+            with app.app_context(), db.engine.connect() as connection:
+                cancelled = connection.execute(
+                    db.select(QueryTicket.query_id).where(QueryTicket.query_id.in_(local), QueryTicket.cancelled)
+                ).scalars().all()
+        except Exception as e:
+            logger.warning(f"Could not check for cancelled queries: {e}")
+            continue
+        for query_id in cancelled:
+            running = running_queries.get(query_id)
+            if running is not None:
+                running.cancel()
+
+@contextmanager
+def query_budget(connection, limits, query_id=None):
+    """Run statements on `connection` under the limits' timeout, registered for cancellation"""
+    running = RunningQuery(query_id, flask_session.get('user_id'), connection, limits.timeout).arm()
+    try:
+        yield running
+    except QueryAborted:
+        raise
+    except Exception as e:
+        aborted = running.aborted(e)
+        if aborted is not None:
+            raise aborted from e
+        raise
+    finally:
+        running.disarm()
+
+def fetch_capped(result, max_rows, running=None, batch_size=1000):
+    """Fetch at most max_rows rows, returning (rows, truncated) without reading past the cap"""
+    rows = []
+    while True:
+        if running is not None:
+            running.check()
+        batch = result.fetchmany(min(batch_size, max_rows + 1 - len(rows)))
+        if not batch:
+            return rows, False
+        rows.extend(tuple(row) for row in batch)
+        if len(rows) > max_rows:
+            return rows[:max_rows], True
+
+# Report export
+REPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+XLSX_MAX_ROWS = 1048576
+EXPORT_READ_SIZE = 64 * 1024
+
+def iter_csv_export(result, batch_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(result.keys())
+    while True:
+        batch = result.fetchmany(batch_size)
+        if not batch:
+            break
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def iter_ndjson_export(result, batch_size):
+    columns = list(result.keys())
+    while True:
+        batch = result.fetchmany(batch_size)
+        if not batch:
+            break
+        yield "".join(ndjson_line(dict(zip(columns, row))) for row in batch).encode('utf-8')
+
+def xlsx_value(value):
+    # openpyxl only accepts plain scalars and dates
+    if value is None or isinstance(value, (int, float, str, bool, datetime)):
+        return value
+    if isinstance(value, bytes):
+        return value.hex()
+    return str(value)
+
+def iter_xlsx_export(result, batch_size):
+    """Write rows through openpyxl's write-only mode into a private temporary file, then stream it.
+
+    The zip container can only be finished once every row is written, so the bytes go out at
+    the end, but the workbook never holds more than one batch of rows in memory.
+    """
+    columns = list(result.keys())
+    workbook = Workbook(write_only=True)
+    sheet, sheet_rows, sheet_number = None, XLSX_MAX_ROWS, 0
+    while True:
+        batch = result.fetchmany(batch_size)
+        if not batch:
+            break
+        for row in batch:
+            # Continue on a new sheet once Excel's row limit is reached
+            if sheet_rows >= XLSX_MAX_ROWS:
+                sheet_number += 1
+                sheet = workbook.create_sheet("Report" if sheet_number == 1 else f"Report ({sheet_number})")
+                sheet.append(columns)
+                sheet_rows = 1
+            sheet.append([xlsx_value(value) for value in row])
+            sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet("Report").append(columns)
+    
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        while True:
+            chunk = output.read(EXPORT_READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def gzip_chunks(chunks):
+    """Compress a byte stream incrementally into a single gzip member"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def stream_export(connection, result, query, start_time, output_format, batch_size, running, compress=False):
+    """Yield an export straight from the cursor under the query budget, logging it once the last byte is produced"""
+    writers = {'csv': iter_csv_export, 'ndjson': iter_ndjson_export, 'xlsx': iter_xlsx_export}
+    try:
+        chunks = writers[output_format](result, batch_size)
+        if compress:
+            chunks = gzip_chunks(chunks)
+        for chunk in chunks:
+            running.check()
+            yield chunk
+        execution_time = (datetime.now() - start_time).total_seconds()
+        log_query(query, 'export', execution_time, True)
+    except Exception as e:
+        # Headers are already sent; aborting the response marks the download as incomplete
+        execution_time = (datetime.now() - start_time).total_seconds()
+        aborted = e if isinstance(e, QueryAborted) else running.aborted(e)
+        if aborted is not None:
+            log_query(query, aborted.status, execution_time, False, str(aborted))
+        else:
+            log_query(query, 'error', execution_time, False, str(e))
+        logger.error(f"Error exporting query results: {aborted or e}")
+        raise
+    finally:
+        result.close()
+        running.disarm()
+        connection.close()
+
+# Pagination helpers
+class PageTokenError(Exception):
+    """Raised when a page token is malformed, belongs to another query or has expired"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+# Simple single-table SELECTs that can be rewritten to seek on a key
+KEYSET_QUERY_PATTERN = re.compile(
+    r'^\s*select\s+(?P<columns>.+?)\s+from\s+(?P<table>[A-Za-z_][A-Za-z0-9_]*)'
+    r'(?:\s+where\s+(?P<where>.+?))?'
+    r'(?:\s+order\s+by\s+(?P<order_column>[A-Za-z_][A-Za-z0-9_]*)(?:\s+(?P<order_dir>asc|desc))?)?'
+    r'\s*;?\s*$',
+    re.IGNORECASE | re.DOTALL
+)
+KEYSET_UNSAFE_PATTERN = re.compile(
+    r'\b(join|group|having|limit|offset|union|intersect|except|order|distinct|over|select)\b'
+    r'|\b(count|sum|avg|min|max|total|group_concat)\s*\(',
+    re.IGNORECASE
+)
+
+def query_fingerprint(query, engine):
+    """Short stable hash used to tie page tokens to the query and database that issued them"""
+    return hashlib.sha256(f"{engine.url}|{normalize_sql(query)}".encode('utf-8')).hexdigest()[:16]
+
+def plan_keyset_pagination(connection, query):
+    """Describe how to seek through a SELECT by key, or return None if it can't be rewritten"""
+    match = KEYSET_QUERY_PATTERN.match(query)
+    if not match:
+        return None
+    
+    columns, table, where = match.group('columns'), match.group('table'), match.group('where')
+    if KEYSET_UNSAFE_PATTERN.search(columns) or (where and KEYSET_UNSAFE_PATTERN.search(where)):
+        return None
+    
+    if connection.dialect.name == 'sqlite':
+        # Only ordinary rowid tables expose a stable, indexed rowid
+        table_sql = connection.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": table}
+        ).scalar()
+        if not table_sql or 'WITHOUT ROWID' in table_sql.upper():
+            return None
+        key_column = 'rowid'
+    else:
+        primary_key = sqlalchemy_inspect(connection).get_pk_constraint(table).get('constrained_columns') or []
+        if len(primary_key) != 1:
+            return None
+        key_column = primary_key[0]
+    
+    order_column = match.group('order_column')
+    descending = (match.group('order_dir') or '').lower() == 'desc'
+    if order_column and order_column.lower() == key_column.lower():
+        order_column = None
+    if order_column and connection.dialect.name != 'sqlite':
+        # Ties on a non-unique column need rowid semantics we only rely on for SQLite
+        return None
+    
+    return {
+        "table": table,
+        "columns": columns,
+        "where": where,
+        "key_column": key_column,
+        "order_column": order_column,
+        "descending": descending
+    }
+
+def build_keyset_sql(plan, after):
+    """Rewrite a planned SELECT into a seek query for the page following `after`"""
+    key, order = plan['key_column'], plan['order_column']
+    direction = 'DESC' if plan['descending'] else 'ASC'
+    compare = '<' if plan['descending'] else '>'
+    
+    select_list = f"{key} AS __chatdb_key"
+    if order:
+        select_list += f", {order} AS __chatdb_order"
+    
+    conditions = []
+    if plan['where']:
+        conditions.append(f"({plan['where']})")
+    if after is not None:
+        if not order:
+            conditions.append(f"{key} {compare} :after_key")
+        elif after.get('v') is None:
+            # SQLite sorts NULLs first ascending and last descending
+            if plan['descending']:
+                conditions.append(f"({order} IS NULL AND {key} < :after_key)")
+            else:
+                conditions.append(f"({order} IS NOT NULL OR {key} > :after_key)")
+        elif plan['descending']:
+            conditions.append(f"({order} < :after_value OR ({order} = :after_value AND {key} < :after_key) OR {order} IS NULL)")
+        else:
+            conditions.append(f"({order} > :after_value OR ({order} = :after_value AND {key} > :after_key))")
+    
+    sql = f"SELECT {select_list}, {plan['columns']} FROM {plan['table']}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    order_by = f"{order} {direction}, {key} {direction}" if order else f"{key} {direction}"
+    return f"{sql} ORDER BY {order_by} LIMIT :page_limit"
+
+def estimate_table_rows(connection, plan):
+    """Cheap row-count estimate from the key range or catalog statistics"""
+    try:
+        dialect = connection.dialect.name
+        if dialect == 'sqlite':
+            low, high = connection.execute(text(f"SELECT MIN(rowid), MAX(rowid) FROM {plan['table']}")).one()
+            return 0 if high is None else high - low + 1
+        if dialect == 'postgresql':
+            estimate = connection.execute(
+                text("SELECT reltuples::bigint FROM pg_class WHERE relname = :name"), {"name": plan['table']}
+            ).scalar()
+            return max(int(estimate), 0) if estimate is not None else None
+        if dialect == 'mysql':
+            return connection.execute(
+                text("SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = :name"),
+                {"name": plan['table']}
+            ).scalar()
+    except Exception as e:
+        logger.warning(f"Could not estimate row count for {plan['table']}: {e}")
+    return None
+
+def pool_capacity(engine):
+    """Most connections the engine's pool hands out at once, or None when it isn't bounded"""
+    pool = engine.pool
+    if isinstance(pool, QueuePool) and pool._max_overflow >= 0:
+        return pool.size() + pool._max_overflow
+    return None
+
+class PageCursorCache:
+    """Open result cursors for queries that can't be keyset-paginated, evicted by TTL and count
+
+    Each held cursor pins a pooled connection, so cursors per engine stay below the pool size
+    (less PAGE_CURSOR_POOL_HEADROOM) and each user holds at most max_per_user of them.
+    """
+    def __init__(self, ttl, max_open, max_per_user, pool_headroom):
+        self.ttl = ttl
+        self.max_open = max_open
+        self.max_per_user = max_per_user
+        self.pool_headroom = pool_headroom
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def engine_limit(self, engine):
+        capacity = pool_capacity(engine)
+        if capacity is None:
+            return self.max_open
+        return max(0, min(self.max_open, capacity - self.pool_headroom))
+    
+    def _evict_oldest(self, matches):
+        cursor_id = next((cid for cid, entry in self._entries.items() if matches(entry)), None)
+        if cursor_id is not None:
+            self.close_entry(self._entries.pop(cursor_id))
+    
+    def reserve(self, engine, user_id):
+        """Make room for one more cursor on `engine` for `user_id`, closing their oldest ones first.
+
+        Returns False when the engine's pool is too small to spare a connection for a cursor.
+        """
+        limit = self.engine_limit(engine)
+        if limit <= 0 or self.max_per_user <= 0:
+            return False
+        with self._lock:
+            self._evict_expired()
+            while sum(1 for entry in self._entries.values() if entry['user_id'] == user_id) >= self.max_per_user:
+                self._evict_oldest(lambda entry: entry['user_id'] == user_id)
+            while sum(1 for entry in self._entries.values() if entry['engine'] is engine) >= limit:
+                self._evict_oldest(lambda entry: entry['engine'] is engine)
+        return True
+    
+    def close_entry(self, entry):
+        try:
+            entry['result'].close()
+            entry['connection'].close()
+        except Exception as e:
+            logger.warning(f"Error closing page cursor: {e}")
+    
+    def _evict_expired(self):
+        now = time.monotonic()
+        for cursor_id in [cid for cid, entry in self._entries.items() if entry['expires'] <= now]:
+            self.close_entry(self._entries.pop(cursor_id))
+    
+    def put(self, entry):
+        cursor_id = uuid.uuid4().hex
+        entry['expires'] = time.monotonic() + self.ttl
+        with self._lock:
+            self._evict_expired()
+            self._entries[cursor_id] = entry
+            while len(self._entries) > self.max_open:
+                _, oldest = self._entries.popitem(last=False)
+                self.close_entry(oldest)
+        return cursor_id
+    
+    def take(self, cursor_id):
+        """Remove and return a live cursor so only one request reads it at a time"""
+        with self._lock:
+            self._evict_expired()
+            return self._entries.pop(cursor_id, None)
+
+page_cursor_cache = PageCursorCache(app.config['PAGE_CURSOR_TTL'], app.config['PAGE_CURSOR_MAX_OPEN'],
+                                    app.config['PAGE_CURSOR_MAX_PER_USER'], app.config['PAGE_CURSOR_POOL_HEADROOM'])
+
+app_cursor_engine = None
+app_cursor_engine_lock = threading.Lock()
+
+def page_cursor_engine(engine):
+    """Engine to hold a pagination cursor on, for queries against `engine`
+
+    The application database also serves logins, history and upload jobs, and in WAL mode every
+    SELECT can hold a cursor, so its cursors get unpooled connections of their own instead.
+    """
+    global app_cursor_engine
+    if engine is not db.engine:
+        return engine
+    with app_cursor_engine_lock:
+        if app_cursor_engine is None or app_cursor_engine.url != engine.url:
+            app_cursor_engine = create_engine(engine.url, poolclass=NullPool)
+        return app_cursor_engine
+
+def fetch_cursor_page(entry, page_size):
+    """Read one page from a cached cursor, keeping a single look-ahead row to detect the end"""
+    rows = entry.pop('lookahead', [])
+    rows.extend(entry['result'].fetchmany(page_size + 1 - len(rows)))
+    if len(rows) > page_size:
+        entry['lookahead'] = rows[page_size:]
+        return rows[:page_size], True
+    return rows, False
+
+def paginate_select(query, engine, page_size, page_token=None, result_format='rows', limits=None, query_id=None):
+    """Return one page of a SELECT using keyset seeks when possible, else a cached cursor or OFFSET.
+
+    Every page runs under the caller's time limit, and paging stops at their max_rows.
+    """
+    limits = limits or get_query_limits()
+    fingerprint = query_fingerprint(query, engine)
+    state = None
+    if page_token:
+        try:
+            state = page_token_serializer.loads(page_token)
+        except BadSignature:
+            raise PageTokenError("Invalid page token")
+        if state.get('q') != fingerprint:
+            raise PageTokenError("Page token does not belong to this query")
+    
+    offset = state.get('o', 0) if state else 0
+    # Tokens are only issued below the row cap, so at least one row remains
+    page_size = max(1, min(page_size, limits.max_rows - offset))
+    
+    if state and state.get('m') == 'cursor':
+        entry = page_cursor_cache.take(state.get('c'))
+        if entry is None:
+            # Held by another worker process, or expired: carry on from the same row with OFFSET
+            return fetch_offset_page(engine.connect(), query, fingerprint, page_size, offset, result_format, limits, query_id)
+        if entry['user_id'] != flask_session.get('user_id'):
+            page_cursor_cache.close_entry(entry)
+            raise PageTokenError("Page token does not belong to this user", 403)
+        try:
+            with query_budget(entry['connection'], limits, query_id):
+                rows, has_more = fetch_cursor_page(entry, page_size)
+        except Exception:
+            page_cursor_cache.close_entry(entry)
+            raise
+        next_state = None
+        if has_more and offset + len(rows) < limits.max_rows:
+            next_state = {"q": fingerprint, "m": "cursor", "c": page_cursor_cache.put(entry), "o": offset + len(rows)}
+        else:
+            page_cursor_cache.close_entry(entry)
+        return build_page_payload(entry['columns'], rows, page_size, next_state, offset, None, 'cursor', result_format,
+                                  limits.max_rows, has_more)
+    
+    connection = engine.connect()
+    try:
+        plan = plan_keyset_pagination(connection, query)
+        if plan is not None:
+            params = {"page_limit": page_size + 1}
+            if state:
+                params.update({"after_key": state.get('k'), "after_value": state.get('v')})
+            with query_budget(connection, limits, query_id):
+                result = connection.execute(text(build_keyset_sql(plan, state)), params)
+                raw_rows = result.fetchall()
+            skip = 2 if plan['order_column'] else 1
+            columns = list(result.keys())[skip:]
+            
+            has_more = len(raw_rows) > page_size
+            next_state = None
+            if has_more:
+                raw_rows = raw_rows[:page_size]
+                if offset + page_size < limits.max_rows:
+                    last = raw_rows[-1]
+                    next_state = {"q": fingerprint, "m": "keyset", "k": last[0], "o": offset + page_size}
+                    if plan['order_column']:
+                        next_state['v'] = last[1]
+            
+            rows = [row[skip:] for row in raw_rows]
+            estimate = estimate_table_rows(connection, plan) if state is None else None
+            connection.close()
+            return build_page_payload(columns, rows, page_size, next_state, offset, estimate, 'keyset', result_format,
+                                      limits.max_rows, has_more)
+    except Exception:
+        connection.close()
+        raise
+    
+    if state is not None and state.get('m') == 'offset':
+        return fetch_offset_page(connection, query, fingerprint, page_size, offset, result_format, limits, query_id)
+    if state is not None:
+        connection.close()
+        raise PageTokenError("Page token does not match the query's pagination mode")
+    user_id = flask_session.get('user_id')
+    cursor_engine = page_cursor_engine(engine)
+    if not can_hold_cursor(connection) or not page_cursor_cache.reserve(cursor_engine, user_id):
+        return fetch_offset_page(connection, query, fingerprint, page_size, 0, result_format, limits, query_id)
+    
+    # Fall back to holding the cursor open between requests
+    if cursor_engine is not engine:
+        connection.close()
+        connection = cursor_engine.connect()
+    try:
+        with query_budget(connection, limits, query_id):
+            result = connection.execute(text(query))
+            entry = {"connection": connection, "result": result, "columns": list(result.keys()),
+                     "user_id": user_id, "engine": cursor_engine}
+            rows, has_more = fetch_cursor_page(entry, page_size)
+    except Exception:
+        connection.close()
+        raise
+    
+    next_state = None
+    if has_more and len(rows) < limits.max_rows:
+        next_state = {"q": fingerprint, "m": "cursor", "c": page_cursor_cache.put(entry), "o": len(rows)}
+    else:
+        page_cursor_cache.close_entry(entry)
+    return build_page_payload(entry['columns'], rows, page_size, next_state, 0, None, 'cursor', result_format,
+                              limits.max_rows, has_more)
+
+def can_hold_cursor(connection):
+    """An open SQLite read cursor blocks writers unless the database runs in WAL mode"""
+    if connection.dialect.name != 'sqlite':
+        return True
+    journal_mode = connection.execute(text("PRAGMA journal_mode")).scalar()
+    return (journal_mode or '').lower() == 'wal'
+
+def fetch_offset_page(connection, query, fingerprint, page_size, offset, result_format='rows', limits=None, query_id=None):
+    """Last-resort pagination that re-runs the query with LIMIT/OFFSET"""
+    limits = limits or get_query_limits()
+    try:
+        with query_budget(connection, limits, query_id):
+            result = connection.execute(
+                text(f"SELECT * FROM ({normalize_sql(query)}) AS __chatdb_page LIMIT :page_limit OFFSET :page_offset"),
+                {"page_limit": page_size + 1, "page_offset": offset}
+            )
+            columns = list(result.keys())
+            rows = result.fetchall()
+    finally:
+        connection.close()
+    
+    has_more = len(rows) > page_size
+    next_state = None
+    if has_more:
+        rows = rows[:page_size]
+        if offset + page_size < limits.max_rows:
+            next_state = {"q": fingerprint, "m": "offset", "o": offset + page_size}
+    return build_page_payload(columns, rows, page_size, next_state, offset, None, 'offset', result_format,
+                              limits.max_rows, has_more)
+
+def build_page_payload(columns, rows, page_size, next_state, offset, estimate, mode, result_format='rows',
+                       max_rows=None, has_more=False):
+    """Assemble the response body for one page of results"""
+    # More rows exist but the caller's row cap ends paging here
+    truncated = next_state is None and has_more
+    if next_state is None and not truncated:
+        # Reaching the last page gives an exact total for free
+        estimate = offset + len(rows)
+    return {
+        **result_payload(columns, rows, result_format),
+        "columns": columns,
+        "page_size": page_size,
+        "next_page_token": page_token_serializer.dumps(next_state) if next_state else None,
+        "estimated_total": estimate,
+        "pagination": mode,
+        "truncated": truncated,
+        "max_rows": max_rows
+    }
+
+# Result cache
+class ResultCache:
+    """Thread-safe LRU cache with TTL expiry, a byte budget and table-based invalidation"""
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size']
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires'] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry['value']
+    
+    def put(self, key, value, size, tables=(), generation=None):
+        """Store a value unless it is too large or an invalidation happened since `generation`"""
+        if self.max_bytes <= 0 or size > self.max_bytes // 4:
+            return False
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "value": value,
+                "size": size,
+                "tables": frozenset(tables),
+                "expires": time.monotonic() + self.ttl
+            }
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+    
+    def invalidate_tables(self, tables=None):
+        """Drop entries reading any of `tables`, or everything when tables is None"""
+        with self._lock:
+            self.generation += 1
+            if tables is None:
+                stale = list(self._entries)
+            else:
+                tables = {t.lower() for t in tables}
+                stale = [key for key, entry in self._entries.items() if entry['tables'] & tables]
+            for key in stale:
+                self._remove(key)
+            self.invalidations += len(stale)
+            return len(stale)
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+result_cache = ResultCache(
+    app.config['RESULT_CACHE_MAX_ENTRIES'],
+    app.config['RESULT_CACHE_MAX_BYTES'],
+    app.config['RESULT_CACHE_TTL']
+)
+
+# SQL parsing
+SQL_LEXER_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<string>'(?:[^']|'')*'?)
+  | (?P<identifier>"(?:[^"]|"")*"?|`(?:[^`]|``)*`?|\[[^\]]*\]?)
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<param>[?:@$][A-Za-z0-9_]*)
+  | (?P<op>.)
+""", re.VERBOSE | re.DOTALL)
+SQL_PARSE_CACHE_SIZE = 1024
+
+READ_KEYWORDS = {'SELECT', 'VALUES', 'EXPLAIN', 'SHOW', 'DESCRIBE', 'DESC'}
+WRITE_KEYWORDS = {'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'UPSERT', 'MERGE'}
+DDL_KEYWORDS = {'CREATE', 'DROP', 'ALTER', 'TRUNCATE', 'RENAME'}
+# Case-folded in the cache key; other words keep their case since MySQL table names are case-sensitive
+CLAUSE_KEYWORDS = {'SELECT', 'DISTINCT', 'FROM', 'WHERE', 'AND', 'OR', 'NOT', 'IN', 'IS', 'NULL', 'LIKE', 'BETWEEN',
+                   'AS', 'ON', 'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS', 'USING', 'GROUP', 'BY',
+                   'HAVING', 'ORDER', 'ASC', 'DESC', 'LIMIT', 'OFFSET', 'UNION', 'ALL', 'EXCEPT', 'INTERSECT',
+                   'WITH', 'RECURSIVE', 'CASE', 'WHEN', 'THEN', 'ELSE', 'END', 'EXISTS', 'CAST', 'VALUES'}
+BLOCKED_KEYWORDS = ['DROP', 'DELETE', 'TRUNCATE', 'ALTER', 'CREATE', 'INSERT', 'UPDATE']
+# Words that may sit between a write keyword and the table it targets
+TARGET_SKIP_WORDS = {'OR', 'ROLLBACK', 'ABORT', 'FAIL', 'IGNORE', 'REPLACE', 'INTO', 'FROM', 'TABLE',
+                     'IF', 'NOT', 'EXISTS', 'ONLY', 'TEMP', 'TEMPORARY', 'LOW_PRIORITY', 'QUICK'}
+
+ParsedQuery = namedtuple('ParsedQuery', [
+    'kind',             # 'select', 'modify', 'ddl', 'other' or 'empty', from the first statement
+    'statement_count',
+    'keywords',         # upper-cased bare words; quoted names, strings and comments never appear here
+    'identifiers',      # lower-cased words and quoted names, a superset of the tables referenced
+    'modified_tables',  # tables written by the statement, or None when they can't be determined
+    'normalized',       # comments dropped, whitespace collapsed, trailing semicolons removed
+    'canonical',        # normalized with uniform spacing and lower-cased keywords, used as the result cache key
+    'fingerprint'       # hash of the normalized text with literals replaced by placeholders
+])
+
+def tokenize_sql(query):
+    """Yield (kind, text, spaced) tokens; spaced is True when whitespace or a comment preceded it"""
+    spaced = False
+    for match in SQL_LEXER_PATTERN.finditer(query):
+        kind = match.lastgroup
+        if kind in ('space', 'comment'):
+            spaced = True
+            continue
+        yield kind, match.group(), spaced
+        spaced = False
+
+def unquote_identifier(text):
+    if text[0] in '"`[':
+        return text[1:-1] if len(text) > 1 and text[-1] in '"`]' else text[1:]
+    return text
+
+def statement_kind(tokens):
+    words = [text.upper() for kind, text, _ in tokens if kind == 'word']
+    if not words:
+        return 'empty' if not tokens else 'other'
+    first = words[0]
+    if first == 'WITH':
+        # The main statement is the first read/write keyword outside the CTE bodies
+        depth = 0
+        for kind, text, _ in tokens[1:]:
+            if text == '(':
+                depth += 1
+            elif text == ')':
+                depth -= 1
+            elif depth == 0 and kind == 'word':
+                upper = text.upper()
+                if upper in READ_KEYWORDS:
+                    return 'select'
+                if upper in WRITE_KEYWORDS:
+                    return 'modify'
+        return 'other'
+    if first in READ_KEYWORDS:
+        return 'select'
+    if first in WRITE_KEYWORDS:
+        return 'modify'
+    if first in DDL_KEYWORDS:
+        return 'ddl'
+    return 'other'
+
+def statement_targets(tokens):
+    """Names written by a modify/DDL statement, or None if a target can't be found"""
+    targets = set()
+    for index, (kind, text, _) in enumerate(tokens):
+        if kind != 'word' or text.upper() not in WRITE_KEYWORDS | DDL_KEYWORDS:
+            continue
+        if text.upper() == 'CREATE' and not any(t.upper() == 'TABLE' for k, t, _ in tokens[index + 1:index + 4] if k == 'word'):
+            continue
+        position = index + 1
+        while position < len(tokens) and tokens[position][0] == 'word' and tokens[position][1].upper() in TARGET_SKIP_WORDS:
+            position += 1
+        name = None
+        # Take the last part of a schema-qualified name
+        while position < len(tokens) and tokens[position][0] in ('word', 'identifier'):
+            name = unquote_identifier(tokens[position][1])
+            if position + 1 < len(tokens) and tokens[position + 1][1] == '.':
+                position += 2
+            else:
+                break
+        if name:
+            targets.add(name.lower())
+    return targets or None
+
+@lru_cache(maxsize=SQL_PARSE_CACHE_SIZE)
+def parse_sql(query):
+    """Lex a query once and classify it; cached so validation, routing and cache keys share one parse"""
+    statements = [[]]
+    for token in tokenize_sql(query or ''):
+        if token[1] == ';':
+            statements.append([])
+        else:
+            statements[-1].append(token)
+    statements = [tokens for tokens in statements if tokens]
+    tokens = [token for statement in statements for token in statement]
+    
+    def join(tokens):
+        return ''.join((' ' if spaced and index else '') + text for index, (kind, text, spaced) in enumerate(tokens))
+    
+    def template(tokens, literals=True):
+        # Spacing and keyword case don't change what a query does; with literals=False neither do the values
+        return ' '.join('?' if not literals and kind in ('string', 'number')
+                        else text.lower() if kind == 'word' and text.upper() in CLAUSE_KEYWORDS else text
+                        for kind, text, _ in tokens)
+    
+    first = statements[0] if statements else []
+    kind = statement_kind(first)
+    return ParsedQuery(
+        kind=kind,
+        statement_count=len(statements),
+        keywords=frozenset(text.upper() for k, text, _ in tokens if k == 'word'),
+        identifiers=frozenset(
+            unquote_identifier(text).lower() for k, text, _ in tokens if k in ('word', 'identifier')
+        ),
+        modified_tables=statement_targets(first) if kind in ('modify', 'ddl') else None,
+        normalized='; '.join(join(statement) for statement in statements),
+        canonical='; '.join(template(statement) for statement in statements),
+        fingerprint=hashlib.sha256(
+            '; '.join(template(statement, literals=False) for statement in statements).encode('utf-8')
+        ).hexdigest()[:16]
+    )
+
+def is_select(query):
+    return parse_sql(query).kind == 'select'
+
+def normalize_sql(query):
+    """Comments dropped, whitespace collapsed outside literals and trailing semicolons removed"""
+    return parse_sql(query).normalized
+
+def referenced_identifiers(query):
+    """All identifiers outside string literals - a safe superset of the tables a query reads"""
+    return set(parse_sql(query).identifiers)
+
+def modified_tables(query):
+    """Tables written by a statement, or None when they can't be determined"""
+    tables = parse_sql(query).modified_tables
+    return set(tables) if tables else None
+
+def estimate_result_size(columns, rows):
+    """Rough in-memory footprint of a result set, used for the cache byte budget"""
+    size = sys.getsizeof(rows) + sum(sys.getsizeof(column) for column in columns)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value) if value is not None else 0
+    return size
+
+def engine_uri(engine):
+    return engine.url.render_as_string(hide_password=False)
+
+def table_versions(tables):
+    """Write counters of `tables` from the application database, for result cache keys"""
+    names = sorted({table.lower() for table in tables} | {'*'})
+    try:
+        with db.engine.connect() as connection:
+            rows = connection.execute(
+                db.select(TableVersion.table_name, TableVersion.version).where(TableVersion.table_name.in_(names))
+            ).all()
+    except Exception as e:
+        # Without versions the entry can't be shared safely; a fresh token keeps it out of the cache
+        logger.warning(f"Could not read table versions: {e}")
+        return (uuid.uuid4().hex,)
+    return tuple(sorted(rows))
+
+def invalidate_results(tables=None):
+    """Drop cached results reading `tables` (every table when None) in this and all other workers"""
+    names = ['*'] if tables is None else sorted({table.lower() for table in tables})
+    if names:
+        try:
+            with db.engine.begin() as connection:
+                statement = sqlite_insert(TableVersion)
+                connection.execute(statement.on_conflict_do_update(
+                    index_elements=['table_name'], set_={"version": TableVersion.version + 1}
+                ), [{"table_name": name, "version": 1} for name in names])
+        except Exception as e:
+            logger.error(f"Could not bump table versions: {e}")
+    result_cache.invalidate_tables(tables)
+
+def fetch_select_cached(query, engine, limits=None, query_id=None, timings=None):
+    """Run a SELECT through the result cache, returning (columns, rows, cache_hit, truncated)"""
+    limits = limits or get_query_limits()
+    timings = timings or QueryTimings()
+    tables = referenced_identifiers(query)
+    key = (parse_sql(query).canonical, engine_uri(engine), limits.max_rows, table_versions(tables))
+    cached = result_cache.get(key)
+    if cached is not None:
+        return cached[0], cached[1], True, cached[2]
+    
+    generation = result_cache.generation
+    with engine.connect() as connection, query_budget(connection, limits, query_id) as running:
+        with timings.stage('execute'):
+            result = connection.execute(text(query))
+        columns = list(result.keys())
+        with timings.stage('fetch'):
+            rows, truncated = fetch_capped(result, limits.max_rows, running)
+        result.close()
+    result_cache.put(key, (columns, rows, truncated), estimate_result_size(columns, rows),
+                     tables=tables, generation=generation)
+    return columns, rows, False, truncated
+
+# Index advisor
+# Words that start a new clause, ending the current list of tables or predicate columns
+ADVISOR_CLAUSES = {'SELECT', 'FROM', 'JOIN', 'WHERE', 'ON', 'GROUP', 'ORDER', 'HAVING', 'LIMIT', 'OFFSET',
+                   'UNION', 'EXCEPT', 'INTERSECT', 'WINDOW', 'SET'}
+NON_ALIAS_WORDS = CLAUSE_KEYWORDS | ADVISOR_CLAUSES | {'NATURAL', 'TRUE', 'FALSE', 'COLLATE', 'ESCAPE', 'GLOB'}
+EQUALITY_OPERATORS = {'=', '==', 'IN', 'IS'}
+RANGE_OPERATORS = {'<', '>', '<=', '>=', 'BETWEEN', 'LIKE', 'GLOB'}
+# Fraction of rows a range predicate is assumed to keep, the usual planner default without histograms
+RANGE_SELECTIVITY = 0.3
+# Indexes keeping more than this fraction of the table aren't worth recommending
+ADVISOR_MAX_SELECTIVITY = 0.2
+ADVISOR_MAX_COLUMNS = 3
+ADVISOR_SAMPLE_QUERIES = 3
+# Rows read to estimate distinct values the planner statistics don't cover
+ADVISOR_SAMPLE_ROWS = 10000
+
+def merge_operators(tokens):
+    # The lexer emits one character per operator token; rejoin <=, >=, <>, != and ==
+    merged = []
+    for token in tokens:
+        if (merged and token[0] == 'op' and merged[-1][0] == 'op' and not token[2]
+                and merged[-1][1] in ('<', '>', '!', '=') and token[1] in ('=', '>')):
+            merged[-1] = ('op', merged[-1][1] + token[1], merged[-1][2])
+        else:
+            merged.append(token)
+    return merged
+
+@lru_cache(maxsize=SQL_PARSE_CACHE_SIZE)
+def predicate_columns(query):
+    """Tables a SELECT reads and the columns it filters, joins or sorts on
+
+    Returns (((alias, table), ...), ((qualifier, column, use), ...)) where use is
+    'eq', 'range', 'join' or 'order' and qualifier is the alias written before the column, if any.
+    """
+    tokens = merge_operators(list(tokenize_sql(query)))
+    aliases, uses = {}, []
+    clause = None
+    
+    def name_at(position):
+        # A possibly schema-qualified name starting at position: (qualifier, name, next position)
+        if position >= len(tokens) or tokens[position][0] not in ('word', 'identifier'):
+            return None, None, position
+        qualifier, name = None, unquote_identifier(tokens[position][1])
+        while position + 2 < len(tokens) and tokens[position + 1][1] == '.' and tokens[position + 2][0] in ('word', 'identifier'):
+            qualifier, name = name, unquote_identifier(tokens[position + 2][1])
+            position += 2
+        return qualifier, name, position + 1
+    
+    def is_keyword(position):
+        return tokens[position][0] == 'word' and tokens[position][1].upper() in NON_ALIAS_WORDS
+    
+    position = 0
+    while position < len(tokens):
+        kind, text_value, _ = tokens[position]
+        upper = text_value.upper() if kind == 'word' else None
+        if upper in ADVISOR_CLAUSES:
+            clause = upper
+            position += 1
+            if upper in ('GROUP', 'ORDER') and position < len(tokens) and tokens[position][1].upper() == 'BY':
+                position += 1
+            while clause in ('FROM', 'JOIN') and position < len(tokens) and not is_keyword(position):
+                # table [AS] alias, repeated after commas in FROM
+                _, table, position = name_at(position)
+                if table is None:
+                    break
+                alias = table
+                if position < len(tokens) and tokens[position][1].upper() == 'AS':
+                    position += 1
+                if position < len(tokens) and tokens[position][0] in ('word', 'identifier') and not is_keyword(position):
+                    alias = unquote_identifier(tokens[position][1])
+                    position += 1
+                aliases[alias.lower()] = table
+                aliases[table.lower()] = table
+                if clause == 'JOIN' or position >= len(tokens) or tokens[position][1] != ',':
+                    break
+                position += 1
+            continue
+        
+        if clause in ('WHERE', 'ON', 'HAVING', 'GROUP', 'ORDER') and kind in ('word', 'identifier') and not is_keyword(position):
+            qualifier, column, after = name_at(position)
+            if after < len(tokens) and tokens[after][1] == '(':
+                position = after  # function call, not a column
+                continue
+            if clause in ('GROUP', 'ORDER'):
+                uses.append((qualifier, column, 'order'))
+            else:
+                operator = tokens[after][1].upper() if after < len(tokens) else None
+                before = tokens[position - 1][1].upper() if position else None
+                if operator in EQUALITY_OPERATORS or before in ('=', '=='):
+                    # col = other_col in a join condition lets the index drive the join
+                    other = after + 1 if operator in ('=', '==') else None
+                    joined = other is not None and other < len(tokens) and tokens[other][0] in ('word', 'identifier') \
+                        and not is_keyword(other) and not (other + 1 < len(tokens) and tokens[other + 1][1] == '(')
+                    uses.append((qualifier, column, 'join' if joined else 'eq'))
+                elif operator in RANGE_OPERATORS or before in RANGE_OPERATORS:
+                    uses.append((qualifier, column, 'range'))
+            position = after
+            continue
+        position += 1
+    return tuple(aliases.items()), tuple(uses)
+
+def workload_queries(user_id, limit):
+    """The user's recent successful SELECTs, one entry per fingerprint with how often it ran"""
+    rows = db.session.query(QueryHistory.query).filter(
+        QueryHistory.user_id == user_id,
+        QueryHistory.success == True,
+        QueryHistory.query_type == 'select'
+    ).order_by(QueryHistory.created_at.desc()).limit(limit).all()
+    workload = OrderedDict()
+    for (query,) in rows:
+        fingerprint = parse_sql(query).fingerprint
+        entry = workload.setdefault(fingerprint, {"query": query, "count": 0})
+        entry['count'] += 1
+    return list(workload.values())
+
+def planner_statistics(connection, table):
+    """(row count, {column: distinct values}) from the database's own statistics, without reading the table
+
+    Either part is missing when the table hasn't been analyzed; on SQLite and MySQL only the
+    leading column of each index has a distinct count.
+    """
+    dialect = connection.dialect.name
+    row_count, distinct = None, {}
+    if dialect == 'sqlite':
+        if connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")).first():
+            for index, stat in connection.execute(text("SELECT idx, stat FROM sqlite_stat1 WHERE tbl = :name"), {"name": table}):
+                # "rows rows-per-key-of-column-1 ..." followed by optional flags
+                numbers = [int(value) for value in (stat or '').split() if value.isdigit()]
+                if not numbers:
+                    continue
+                row_count = numbers[0]
+                if index and len(numbers) > 1:
+                    leading = connection.execute(
+                        text("SELECT name FROM pragma_index_info(:index) ORDER BY seqno LIMIT 1"), {"index": index}
+                    ).scalar()
+                    if leading:
+                        distinct[leading] = max(1, round(numbers[0] / max(numbers[1], 1)))
+        if row_count is None:
+            low, high = connection.execute(
+                text(f"SELECT MIN(rowid), MAX(rowid) FROM {connection.dialect.identifier_preparer.quote(table)}")
+            ).one()
+            row_count = 0 if high is None else high - low + 1
+    elif dialect == 'postgresql':
+        estimate = connection.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE relname = :name"), {"name": table}
+        ).scalar()
+        # -1 until the table is first analyzed
+        row_count = int(estimate) if estimate is not None and estimate >= 0 else None
+        for column, n_distinct in connection.execute(
+                text("SELECT attname, n_distinct FROM pg_stats WHERE tablename = :name"), {"name": table}):
+            # Negative values are a fraction of the row count
+            if n_distinct >= 0:
+                distinct[column] = n_distinct
+            elif row_count is not None:
+                distinct[column] = -n_distinct * row_count
+    elif dialect == 'mysql':
+        row_count = connection.execute(
+            text("SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = :name"),
+            {"name": table}
+        ).scalar()
+        for column, cardinality in connection.execute(
+                text("SELECT column_name, MAX(cardinality) FROM information_schema.statistics "
+                     "WHERE table_schema = DATABASE() AND table_name = :name AND seq_in_index = 1 GROUP BY column_name"),
+                {"name": table}):
+            if cardinality is not None:
+                distinct[column] = cardinality
+    return row_count, distinct
+
+def sample_statistics(connection, table, columns, row_count=None):
+    """(rows sampled, {column: estimated distinct values}) from the first ADVISOR_SAMPLE_ROWS rows of a table
+
+    Distinct counts are scaled to `row_count` rows with the Haas-Stokes estimator PostgreSQL's
+    ANALYZE uses, from the values seen exactly once in the sample.
+    """
+    quote = connection.dialect.identifier_preparer.quote
+    sample = f"(SELECT * FROM {quote(table)} LIMIT {ADVISOR_SAMPLE_ROWS}) AS __chatdb_sample"
+    sampled_rows = connection.execute(text(f"SELECT COUNT(*) FROM {sample}")).scalar()
+    total = max(row_count or 0, sampled_rows)
+    distinct = {}
+    for column in columns:
+        seen, once, values = connection.execute(text(
+            f"SELECT COUNT(*), SUM(CASE WHEN n = 1 THEN 1 ELSE 0 END), SUM(n) FROM "
+            f"(SELECT COUNT(*) AS n FROM {sample} WHERE {quote(column)} IS NOT NULL GROUP BY {quote(column)}) AS __chatdb_groups"
+        )).one()
+        once, values = int(once or 0), int(values or 0)
+        if not values:
+            distinct[column] = 0
+            continue
+        estimate = values * seen / (values - once + once * values / total)
+        distinct[column] = max(seen, min(round(estimate), total))
+    return sampled_rows, distinct
+
+def table_statistics(connection, table, columns):
+    """Row count and distinct values per column from planner statistics, sampling only what they lack"""
+    try:
+        row_count, known = planner_statistics(connection, table)
+    except Exception as e:
+        logger.warning(f"Could not read planner statistics for {table}: {e}")
+        row_count, known = None, {}
+    known = {column.lower(): value for column, value in known.items()}
+    distinct = {column: known[column.lower()] for column in columns if column.lower() in known}
+    missing = [column for column in columns if column not in distinct]
+    if row_count is None or missing:
+        sampled_rows, sampled = sample_statistics(connection, table, missing, row_count)
+        if row_count is None:
+            row_count = sampled_rows
+        distinct.update(sampled)
+    return row_count, distinct
+
+def existing_index_prefixes(inspector, table):
+    indexes = [[column.lower() for column in index['column_names'] if column] for index in inspector.get_indexes(table)]
+    primary_key = inspector.get_pk_constraint(table).get('constrained_columns') or []
+    return indexes + [[column.lower() for column in primary_key]]
+
+def advised_index_name(table, columns, prefix='ix'):
+    return re.sub(r'\W+', '_', f"{prefix}_{table}_{'_'.join(columns)}").lower()[:60]
+
+def recommend_indexes(engine, user_id, limits=None):
+    """Mine the user's query history for predicate columns and rank the indexes that would help most"""
+    limits = limits or get_query_limits(user_id)
+    inspector = sqlalchemy_inspect(engine)
+    tables = {name.lower(): name for name in inspector.get_table_names()}
+    table_columns = {}
+    candidates = {}
+    
+    for entry in workload_queries(user_id, app.config['INDEX_ADVISOR_HISTORY']):
+        aliases, uses = predicate_columns(entry['query'])
+        aliases = {alias: tables[table.lower()] for alias, table in aliases if table.lower() in tables}
+        if not aliases:
+            continue
+        # Group the columns this query touches by the table they belong to
+        access = {}
+        for qualifier, column, use in uses:
+            if qualifier:
+                table = aliases.get(qualifier.lower())
+                owners = [table] if table else []
+            else:
+                owners = list(dict.fromkeys(aliases.values()))
+            for table in owners:
+                if table not in table_columns:
+                    table_columns[table] = {column['name'].lower(): column['name'] for column in inspector.get_columns(table)}
+                if column.lower() in table_columns[table]:
+                    access.setdefault(table, []).append((table_columns[table][column.lower()], use))
+                    break
+        for table, columns in access.items():
+            key_columns = list(dict.fromkeys(column for column, use in columns if use in ('eq', 'join')))
+            range_columns = [column for column, use in columns if use == 'range' and column not in key_columns]
+            order_columns = [column for column, use in columns if use == 'order' and column not in key_columns]
+            if not key_columns and not range_columns:
+                continue
+            candidate = candidates.setdefault(table, {}).setdefault(tuple(key_columns), {
+                "range": range_columns[:1], "order": order_columns, "queries": []
+            })
+            candidate['queries'].append(entry)
+    
+    recommendations = []
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.connect() as connection, query_budget(connection, limits):
+        for table, patterns in candidates.items():
+            columns_used = sorted({column for key in patterns for column in key}
+                                  | {column for pattern in patterns.values() for column in pattern['range'] + pattern['order']})
+            row_count, distinct = table_statistics(connection, table, columns_used)
+            if row_count < app.config['INDEX_ADVISOR_MIN_ROWS']:
+                continue
+            existing = existing_index_prefixes(inspector, table)
+            
+            merged = {}
+            for key_columns, pattern in patterns.items():
+                # Most selective equality columns first, then one range column or the sort columns
+                ordered = sorted(key_columns, key=lambda column: -distinct[column])
+                trailing = pattern['range'] or [column for column in pattern['order'] if column not in ordered]
+                index_columns = tuple((ordered + trailing)[:ADVISOR_MAX_COLUMNS])
+                selectivity = 1.0
+                for column in index_columns:
+                    if column in key_columns:
+                        selectivity /= max(distinct[column], 1)
+                    elif column in pattern['range']:
+                        selectivity *= RANGE_SELECTIVITY
+                entry = merged.setdefault(index_columns, {"selectivity": selectivity, "queries": []})
+                entry['selectivity'] = max(entry['selectivity'], selectivity)
+                entry['queries'].extend(pattern['queries'])
+            
+            # A longer index also serves queries on its leading columns
+            for index_columns in sorted(merged, key=len):
+                longer = [other for other in merged if len(other) > len(index_columns) and other[:len(index_columns)] == index_columns]
+                if longer:
+                    merged[longer[0]]['queries'].extend(merged.pop(index_columns)['queries'])
+            
+            for index_columns, entry in merged.items():
+                lowered = [column.lower() for column in index_columns]
+                if entry['selectivity'] > ADVISOR_MAX_SELECTIVITY or any(index[:len(lowered)] == lowered for index in existing):
+                    continue
+                runs = sum(query['count'] for query in entry['queries'])
+                rows_read = max(1, round(row_count * entry['selectivity']))
+                name = advised_index_name(table, index_columns)
+                recommendations.append({
+                    "name": name,
+                    "table": table,
+                    "columns": list(index_columns),
+                    "sql": f"CREATE INDEX {quote(name)} ON {quote(table)} ({', '.join(quote(column) for column in index_columns)})",
+                    "rows": row_count,
+                    "selectivity": entry['selectivity'],
+                    "estimated_rows_read": rows_read,
+                    # Rows no longer read across the recorded workload
+                    "estimated_benefit": runs * (row_count - rows_read),
+                    "runs": runs,
+                    "queries": [query['query'] for query in entry['queries'][:ADVISOR_SAMPLE_QUERIES]]
+                })
+    recommendations.sort(key=lambda recommendation: recommendation['estimated_benefit'], reverse=True)
+    return recommendations
+
+def time_query(engine, query, limits):
+    """Seconds to run a query and read its rows, bypassing the result cache"""
+    started = time.perf_counter()
+    with engine.connect() as connection, query_budget(connection, limits) as running:
+        result = connection.execute(text(query))
+        fetch_capped(result, limits.max_rows, running)
+        result.close()
+    return time.perf_counter() - started
+
+def create_advised_index(engine, recommendation, limits):
+    """Create a recommended index, timing its sample queries before and after"""
+    def timings():
+        measured = []
+        for query in recommendation['queries']:
+            try:
+                measured.append(time_query(engine, query, limits))
+            except Exception as e:
+                logger.warning(f"Index advisor could not time query: {e}")
+                measured.append(None)
+        return measured
+    
+    before = timings()
+    with engine.begin() as connection:
+        connection.execute(text(recommendation['sql']))
+        if engine.dialect.name == 'sqlite':
+            # Refresh sqlite_stat1 so the planner weighs the new index against the others
+            connection.execute(text(f"ANALYZE {engine.dialect.identifier_preparer.quote(recommendation['table'])}"))
+    after = timings()
+    
+    measured = [(b, a) for b, a in zip(before, after) if b is not None and a is not None]
+    total_before, total_after = sum(b for b, _ in measured), sum(a for _, a in measured)
+    logger.info(f"Created index {recommendation['name']}: {total_before:.4f}s -> {total_after:.4f}s on {len(measured)} queries")
+    return {
+        "name": recommendation['name'],
+        "table": recommendation['table'],
+        "columns": recommendation['columns'],
+        "sql": recommendation['sql'],
+        "queries": [
+            {"query": query, "before": b, "after": a}
+            for query, b, a in zip(recommendation['queries'], before, after)
+        ],
+        "before": total_before,
+        "after": total_after,
+        "speedup": round(total_before / total_after, 2) if total_after else None
+    }
+
+# Chart rendering
+class ChartStore:
+    """Rendered charts as content-addressed PNG files shared by all worker processes
+
+    Files expire by modification time, which a hit refreshes, and the oldest are removed once the
+    directory holds more than max_entries files or max_bytes bytes.
+    """
+    def __init__(self, directory, max_entries, max_bytes, ttl):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+    
+    def _path(self, key):
+        # Keys are hex digests; anything else can't name a stored chart
+        if not re.fullmatch(r'[0-9a-f]+', key):
+            return None
+        return os.path.join(self.directory, f"{key}.png")
+    
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if path is None or os.path.getmtime(path) + self.ttl <= time.time():
+                raise FileNotFoundError(key)
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+    
+    def put(self, key, value, size):
+        """Store a PNG unless it is too large for the budget; False when it wasn't stored"""
+        path = self._path(key)
+        if path is None or self.max_bytes <= 0 or size > self.max_bytes // 4:
+            return False
+        try:
+            # Written under a temporary name so other workers never read a partial file
+            with tempfile.NamedTemporaryFile(dir=self.directory, prefix='.incoming_', delete=False) as f:
+                f.write(value)
+            os.replace(f.name, path)
+            self._prune()
+        except OSError as e:
+            logger.warning(f"Could not store chart {key}: {e}")
+            return False
+        return True
+    
+    def _files(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.png'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(files)
+    
+    def _prune(self):
+        files = self._files()
+        expired_before = time.time() - self.ttl
+        total = sum(size for _, size, _ in files)
+        for index, (mtime, size, path) in enumerate(files):
+            if mtime > expired_before and len(files) - index <= self.max_entries and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+    
+    def stats(self):
+        files = self._files()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0,
+            "entries": len(files),
+            "bytes": sum(size for _, size, _ in files),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "evictions": self.evictions,
+            "directory": self.directory
+        }
+
+chart_cache = ChartStore(
+    app.config['CHART_CACHE_DIR'],
+    app.config['CHART_CACHE_MAX_ENTRIES'],
+    app.config['CHART_CACHE_MAX_BYTES'],
+    app.config['CHART_CACHE_TTL']
+)
+
+CHART_TYPES = ('bar', 'line', 'scatter')
+CHART_DEFAULT_SIZE = (15, 8)
+CHART_MAX_INCHES = 40
+
+def chart_options(payload):
+    """Validate chart type, size (inches) and dpi from a request payload"""
+    chart_type = payload.get('chart_type') or 'bar'
+    if chart_type not in CHART_TYPES:
+        raise ValueError(f"chart_type must be one of {', '.join(CHART_TYPES)}")
+    try:
+        width = float(payload.get('width') or CHART_DEFAULT_SIZE[0])
+        height = float(payload.get('height') or CHART_DEFAULT_SIZE[1])
+        dpi = int(payload.get('dpi') or app.config['CHART_DEFAULT_DPI'])
+    except (TypeError, ValueError):
+        raise ValueError("width, height and dpi must be numbers")
+    if not (1 <= width <= CHART_MAX_INCHES and 1 <= height <= CHART_MAX_INCHES):
+        raise ValueError(f"width and height must be between 1 and {CHART_MAX_INCHES} inches")
+    if not 10 <= dpi <= app.config['CHART_MAX_DPI']:
+        raise ValueError(f"dpi must be between 10 and {app.config['CHART_MAX_DPI']}")
+    pixels = int(width * dpi) * int(height * dpi)
+    if pixels > app.config['CHART_MAX_PIXELS']:
+        raise ValueError(f"A {width:g}x{height:g} inch chart at {dpi} dpi is {pixels:,} pixels; "
+                         f"the limit is {app.config['CHART_MAX_PIXELS']:,}. Reduce the size or dpi.")
+    return chart_type, (width, height), dpi
+
+CHART_AGGREGATES = ('sum', 'avg', 'min', 'max', 'count')
+
+def point_budget(size, dpi):
+    """Points worth drawing: one per horizontal pixel, capped by CHART_MAX_POINTS"""
+    return max(3, min(int(size[0] * dpi), app.config['CHART_MAX_POINTS']))
+
+def lttb_indices(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: indices of `threshold` points preserving the visual shape"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    selected = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        # Average of the following bucket (the last point for the final bucket)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[selected] - avg_x) * (y[start:end] - y[selected])
+            - (x[selected] - x[start:end]) * (avg_y - y[selected])
+        )
+        selected = start + int(area.argmax())
+        indices[i + 1] = selected
+    return indices
+
+def minmax_indices(y, threshold):
+    """Keep the minimum and maximum of each of threshold/2 equal-width buckets, in original order"""
+    n = len(y)
+    if threshold >= n:
+        return np.arange(n)
+    edges = np.linspace(0, n, max(1, threshold // 2) + 1).astype(np.int64)
+    indices = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end <= start:
+            continue
+        bucket = y[start:end]
+        indices.extend(sorted({start + int(bucket.argmin()), start + int(bucket.argmax())}))
+    return np.array(indices, dtype=np.int64)
+
+def downsample_series(df, x_axis, y_axis, chart_type, budget):
+    """Reduce a line (LTTB) or scatter (min/max buckets) series to the point budget"""
+    if len(df) <= budget:
+        return df, None
+    if pd.api.types.is_numeric_dtype(df[x_axis]):
+        x = df[x_axis].to_numpy(dtype=float)
+    else:
+        x = np.arange(len(df), dtype=float)
+    y = df[y_axis].to_numpy(dtype=float)
+    if chart_type == 'line':
+        method, indices = 'lttb', lttb_indices(x, y, budget)
+    else:
+        method, indices = 'minmax', minmax_indices(y, budget)
+    return df.iloc[indices].reset_index(drop=True), method
+
+def fetch_bar_data(query, engine, x_axis, y_axis, aggregate, max_bars, limits=None, query_id=None, timings=None):
+    """Fetch bar chart rows, pushing a GROUP BY into SQL when there are too many to draw
+
+    Returns (columns, rows, reduction) where reduction is None if the rows were used as-is.
+    """
+    source = normalize_sql(query)
+    columns, rows, _, _ = fetch_select_cached(
+        f"SELECT * FROM ({source}) AS chart_source LIMIT {max_bars + 1}", engine, limits, query_id, timings
+    )
+    if len(rows) <= max_bars or x_axis not in columns or y_axis not in columns:
+        return columns, rows, None
+
+    quote = engine.dialect.identifier_preparer.quote
+    x_column, y_column = quote(x_axis), quote(y_axis)
+    value = f"COUNT({y_column})" if aggregate == 'count' else f"{aggregate.upper()}({y_column})"
+    grouped_columns, grouped_rows, _, _ = fetch_select_cached(
+        f"SELECT {x_column}, {value} AS {y_column}, "
+        f"COUNT(*) OVER () AS chart_groups, SUM(COUNT(*)) OVER () AS chart_rows "
+        f"FROM ({source}) AS chart_source GROUP BY {x_column} "
+        f"ORDER BY {value} DESC LIMIT {max_bars}",
+        engine, limits, query_id, timings
+    )
+    if not grouped_rows:
+        return [x_axis, y_axis], [], None
+    total_groups, total_rows = grouped_rows[0][2], grouped_rows[0][3]
+    reduction = {
+        "method": "group_by",
+        "aggregate": aggregate,
+        "original_points": int(total_rows),
+        "groups": int(total_groups),
+        "plotted_points": len(grouped_rows),
+        "truncated": total_groups > len(grouped_rows)
+    }
+    # Largest groups were kept; draw them in x order
+    grouped_rows = sorted((row[:2] for row in grouped_rows), key=lambda row: (row[0] is None, str(row[0])))
+    return [x_axis, y_axis], grouped_rows, reduction
+
+CHART_FORMATS = ('png', 'data')
+
+def encode_chart_column(series):
+    """Encode a series as a base64 typed array, or a dictionary plus codes for categorical values"""
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        if pd.api.types.is_integer_dtype(series) and len(series) and \
+                np.iinfo(np.int32).min <= series.min() and series.max() <= np.iinfo(np.int32).max:
+            values, dtype = series.to_numpy(dtype='<i4'), 'int32'
+        else:
+            values, dtype = series.to_numpy(dtype='<f8', na_value=np.nan), 'float64'
+        return {"name": series.name, "type": dtype, "data": base64.b64encode(values.tobytes()).decode('ascii')}
+    
+    codes, dictionary = pd.factorize(series.astype(object).where(series.notna(), None), use_na_sentinel=True)
+    code_type = 'int16' if len(dictionary) < np.iinfo(np.int16).max else 'int32'
+    codes = codes.astype('<i2' if code_type == 'int16' else '<i4')
+    return {
+        "name": series.name,
+        "type": "dictionary",
+        "dictionary": [str(value) for value in dictionary],
+        "index_type": code_type,
+        "codes": base64.b64encode(codes.tobytes()).decode('ascii')
+    }
+
+def chart_key(df, x_axis, y_axis, chart_type, size, dpi):
+    """Content hash of the plotted data and every option that changes the rendered image"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([x_axis, y_axis, chart_type, size, dpi, str(df[x_axis].dtype)]).encode())
+    digest.update(pd.util.hash_pandas_object(df[[x_axis, y_axis]], index=False).values.tobytes())
+    return digest.hexdigest()
+
+class ChartRenderBusy(Exception):
+    """Raised when no render worker became available within CHART_RENDER_TIMEOUT"""
+
+class ChartRenderPool:
+    """Pre-warmed matplotlib worker processes with a bounded, time-limited queue"""
+    def __init__(self, workers, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Renders running or waiting in the pool; further requests wait here up to the timeout
+        self._slots = threading.BoundedSemaphore(max(1, workers) * 2)
+        self._inline_ready = False
+        self.rendered = 0
+        self.rejected = 0
+    
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # Spawned rather than forked so workers never inherit request threads or open connections
+                context = multiprocessing.get_context('spawn')
+                self._pool = context.Pool(self.workers, initializer=chart_render.init_worker)
+                self._pid = os.getpid()
+            return self._pool
+    
+    def render(self, *args):
+        deadline = time.monotonic() + self.timeout
+        if not self._slots.acquire(timeout=self.timeout):
+            self.rejected += 1
+            raise ChartRenderBusy("Chart renderer is busy, try again shortly")
+        
+        if self.workers <= 0:
+            try:
+                with self._lock:
+                    if not self._inline_ready:
+                        chart_render.init_worker()
+                        self._inline_ready = True
+                png = chart_render.render_chart_png(*args)
+                self.rendered += 1
+                return png
+            finally:
+                self._slots.release()
+        
+        try:
+            pending = self._get_pool().apply_async(
+                chart_render.render_chart_png, args,
+                callback=lambda _: self._slots.release(),
+                error_callback=lambda _: self._slots.release()
+            )
+        except Exception:
+            self._slots.release()
+            raise
+        try:
+            png = pending.get(timeout=max(0.0, deadline - time.monotonic()))
+        except multiprocessing.TimeoutError:
+            # The worker finishes the render and frees its slot; this request just stops waiting
+            self.rejected += 1
+            raise ChartRenderBusy("Chart rendering timed out, try again shortly")
+        self.rendered += 1
+        return png
+    
+    def close(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+
+chart_render_pool = ChartRenderPool(app.config['CHART_RENDER_WORKERS'], app.config['CHART_RENDER_TIMEOUT'])
+atexit.register(chart_render_pool.close)
+
+# Bulk ingestion helpers
+# Compile-time default for SQLite builds older than 3.32; newer builds report their own limit
+SQLITE_DEFAULT_MAX_VARIABLES = 999
+MAX_ROWS_PER_INSERT = 500
+
+def max_bind_parameters(connection):
+    """Largest number of bound parameters one statement may carry on this connection"""
+    if connection.dialect.name != 'sqlite':
+        return 65535
+    dbapi_connection = connection.connection.driver_connection
+    if hasattr(dbapi_connection, 'getlimit'):
+        return dbapi_connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    return SQLITE_DEFAULT_MAX_VARIABLES
+
+def dataframe_rows(df):
+    """Convert a DataFrame chunk to DB-API parameter tuples with NaN mapped to NULL"""
+    frame = df.astype(object).where(df.notna(), None)
+    return list(frame.itertuples(index=False, name=None))
+
+def insert_rows(connection, table_name, columns, rows):
+    """Bulk insert rows with multi-row VALUES statements sized under the bind parameter limit"""
+    if not rows:
+        return
+    preparer = connection.dialect.identifier_preparer
+    placeholder = '?' if connection.dialect.paramstyle == 'qmark' else '%s'
+    row_sql = "(" + ", ".join([placeholder] * len(columns)) + ")"
+    insert_sql = f"INSERT INTO {preparer.quote(table_name)} ({', '.join(preparer.quote(c) for c in columns)}) VALUES "
+    
+    rows_per_statement = max(1, min(MAX_ROWS_PER_INSERT, max_bind_parameters(connection) // len(columns)))
+    full_groups = len(rows) // rows_per_statement
+    if full_groups:
+        batched_sql = insert_sql + ", ".join([row_sql] * rows_per_statement)
+        params = [
+            tuple(value for row in rows[i:i + rows_per_statement] for value in row)
+            for i in range(0, full_groups * rows_per_statement, rows_per_statement)
+        ]
+        connection.exec_driver_sql(batched_sql, params)
+    
+    remainder = rows[full_groups * rows_per_statement:]
+    if remainder:
+        connection.exec_driver_sql(insert_sql + row_sql, remainder)
+
+# Upload schema
+# Short text columns with few distinct values are declared VARCHAR rather than TEXT
+CATEGORICAL_MAX_DISTINCT = 256
+CATEGORICAL_MAX_LENGTH = 64
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+# Text is typed as a date only in this exact shape: no partial dates, compact forms or UTC offsets
+DATE_TEXT_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+DATETIME_TEXT_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?')
+
+UPLOAD_MODES = ('replace', 'append', 'upsert')
+# Staging column recording input order, so the last row wins when a key repeats within one upload
+STAGING_ROW_COLUMN = '__chatdb_row'
+STAGING_TABLE_PREFIX = '__chatdb_stage_'
+
+UPLOAD_MESSAGES = {
+    'replace': "File uploaded successfully as {tables}",
+    'append': "File appended to {tables}",
+    'upsert': "File merged into {tables}"
+}
+
+UploadOptions = namedtuple('UploadOptions', ['primary_key', 'indexes', 'mode', 'key'],
+                           defaults=((), (), 'replace', ()))
+
+class UploadSchemaError(ValueError):
+    """An upload option that doesn't fit the file, such as a key column it doesn't have"""
+
+def dated_text(values):
+    """'date' or 'datetime' when every string fully matches DATE_TEXT_PATTERN or DATETIME_TEXT_PATTERN"""
+    if not len(values) or not values.map(lambda value: isinstance(value, str)).all():
+        return None
+    if values.map(lambda value: DATE_TEXT_PATTERN.fullmatch(value) is not None).all():
+        return 'date'
+    if values.map(lambda value: bool(DATE_TEXT_PATTERN.fullmatch(value) or DATETIME_TEXT_PATTERN.fullmatch(value))).all():
+        # "2024-01-01 00:00" was written with a time, so keep it a DATETIME
+        return 'datetime'
+    return None
+
+def infer_column_type(series, dialect):
+    """(SQLAlchemy type, kind) for a column, judged from its values rather than only the pandas dtype
+
+    kind is 'integer', 'real', 'boolean', 'date', 'datetime' or 'text' and tells coerce_column
+    how to convert later chunks. Values that can't be judged, such as mixed UTC offsets, make a
+    text column rather than failing the upload.
+    """
+    try:
+        return infer_values_type(series, dialect)
+    except (TypeError, ValueError, OverflowError) as e:
+        logger.warning(f"Could not infer a type for column {series.name!r}, storing it as text: {e}")
+        return sqlalchemy_types.Text(), 'text'
+
+def infer_values_type(series, dialect):
+    values = series.dropna()
+    # The type is fixed from the first chunk. SQLite stores any value in any column, so narrowing
+    # by content is safe there; other databases would reject a later 10.5 or longer string.
+    narrow = dialect.name == 'sqlite'
+    if pd.api.types.is_bool_dtype(series):
+        return sqlalchemy_types.Boolean(), 'boolean'
+    if pd.api.types.is_integer_dtype(series) or (
+            narrow and pd.api.types.is_float_dtype(series) and len(values)
+            and np.isfinite(values).all() and (values == values.round()).all()):
+        # Integer columns with blanks are read as float; store them as integers again.
+        # SQLite integers are always 64-bit, and only INTEGER PRIMARY KEY becomes the rowid.
+        fits_int32 = values.empty or (INT32_MIN <= values.min() and values.max() <= INT32_MAX)
+        if fits_int32 or dialect.name == 'sqlite':
+            return sqlalchemy_types.Integer(), 'integer'
+        return sqlalchemy_types.BigInteger(), 'integer'
+    if pd.api.types.is_float_dtype(series):
+        return sqlalchemy_types.Float(), 'real'
+    
+    if pd.api.types.is_datetime64_any_dtype(series) and getattr(series.dt, 'tz', None) is None:
+        if narrow and len(values) and (values == values.dt.normalize()).all():
+            return sqlalchemy_types.Date(), 'date'
+        return sqlalchemy_types.DateTime(), 'datetime'
+    kind = dated_text(values) if narrow else None
+    if kind is not None and pd.to_datetime(values, format='ISO8601', errors='coerce').notna().all():
+        # The pattern allows impossible dates such as 2024-02-30, which stay text
+        return (sqlalchemy_types.Date(), 'date') if kind == 'date' else (sqlalchemy_types.DateTime(), 'datetime')
+    
+    if narrow and len(values):
+        lengths = values.astype(str).str.len()
+        distinct = values.nunique()
+        if distinct <= CATEGORICAL_MAX_DISTINCT and distinct < len(values) and lengths.max() <= CATEGORICAL_MAX_LENGTH:
+            # Leave headroom for longer values in later chunks
+            return sqlalchemy_types.String(min(255, max(16, 1 << int(2 * lengths.max()).bit_length()))), 'text'
+    return sqlalchemy_types.Text(), 'text'
+
+def coerce_column(series, kind):
+    """Convert a chunk's values to the form its column type expects; values that don't fit are left as-is"""
+    try:
+        if kind == 'integer' and not pd.api.types.is_integer_dtype(series):
+            return series.astype('Int64')
+        if kind in ('date', 'datetime'):
+            if pd.api.types.is_datetime64_any_dtype(series):
+                if getattr(series.dt, 'tz', None) is not None:
+                    return series
+                parsed = series
+            elif dated_text(series.dropna()) is not None:
+                parsed = pd.to_datetime(series, format='ISO8601', errors='coerce')
+            else:
+                # Rewriting other shapes would change them, e.g. drop an offset or pad "2024-01"
+                return series
+            if parsed.notna().sum() != series.notna().sum():
+                return series
+            times = parsed.dropna()
+            if kind == 'date' and (times == times.dt.normalize()).all():
+                text_format = '%Y-%m-%d'
+            elif (times.dt.microsecond != 0).any():
+                text_format = '%Y-%m-%d %H:%M:%S.%f'
+            else:
+                text_format = '%Y-%m-%d %H:%M:%S'
+            return parsed.dt.strftime(text_format).where(parsed.notna(), None)
+    except (TypeError, ValueError, OverflowError):
+        pass
+    return series
+
+def column_sql_type(series, connection):
+    """DDL type for a new column"""
+    return infer_column_type(series, connection.dialect)[0].compile(dialect=connection.dialect)
+
+def column_kind(sql_type):
+    """coerce_column kind for a column that already exists in the database"""
+    if isinstance(sql_type, sqlalchemy_types.Boolean):
+        return 'boolean'
+    if isinstance(sql_type, sqlalchemy_types.Integer):
+        return 'integer'
+    if isinstance(sql_type, sqlalchemy_types.DateTime):
+        return 'datetime'
+    if isinstance(sql_type, sqlalchemy_types.Date):
+        return 'date'
+    if isinstance(sql_type, (sqlalchemy_types.Float, sqlalchemy_types.Numeric)):
+        return 'real'
+    return 'text'
+
+def match_columns(names, columns):
+    """Rename file headers to the table's column names regardless of case, as the databases match them"""
+    existing = {column.lower(): column for column in columns}
+    return [existing.get(name.lower(), name) for name in names]
+
+def check_upload_options(options, columns):
+    requested = (*options.primary_key, *options.key, *(column for index in options.indexes for column in index))
+    missing = [column for column in requested if column not in columns]
+    if missing:
+        raise UploadSchemaError(f"Column(s) not in file: {', '.join(dict.fromkeys(missing))}. Available: {', '.join(columns)}")
+
+def ensure_upsert_key(connection, table_name, options):
+    """Key columns for an upsert, creating the unique index ON CONFLICT needs if the table lacks one"""
+    inspector = sqlalchemy_inspect(connection)
+    primary_key = inspector.get_pk_constraint(table_name).get('constrained_columns') or []
+    key = list(options.key or options.primary_key or primary_key)
+    if not key:
+        raise UploadSchemaError("Upsert needs key columns: pass key (e.g. key=id) or upload into a table with a primary key")
+    
+    unique_sets = [set(primary_key)] + [set(index['column_names']) for index in inspector.get_indexes(table_name) if index.get('unique')]
+    unique_sets += [set(constraint['column_names']) for constraint in inspector.get_unique_constraints(table_name)]
+    if set(key) not in unique_sets:
+        # One-off cost on the first upsert; later loads only probe this index
+        preparer = connection.dialect.identifier_preparer
+        name = advised_index_name(table_name, key, prefix='ux')
+        try:
+            connection.exec_driver_sql(
+                f"CREATE UNIQUE INDEX {preparer.quote(name)} ON {preparer.quote(table_name)} "
+                f"({', '.join(preparer.quote(column) for column in key)})"
+            )
+        except IntegrityError as e:
+            raise UploadSchemaError(f"Existing rows of {table_name} repeat the key ({', '.join(key)}), so it can't be upserted on") from e
+    return key
+
+def merge_staging_sql(dialect, table_name, staging, columns, key):
+    """One set-based statement inserting new keys and updating existing ones from the staging table"""
+    quote = dialect.identifier_preparer.quote
+    column_list = ", ".join(quote(column) for column in columns)
+    key_list = ", ".join(quote(column) for column in key)
+    latest = (
+        f"SELECT {column_list} FROM {quote(staging)} WHERE {quote(STAGING_ROW_COLUMN)} IN "
+        f"(SELECT MAX({quote(STAGING_ROW_COLUMN)}) FROM {quote(staging)} GROUP BY {key_list})"
+    )
+    updates = [column for column in columns if column not in key]
+    if dialect.name == 'mysql':
+        assignments = ", ".join(f"{quote(column)} = VALUES({quote(column)})" for column in updates or key[:1])
+        return f"INSERT INTO {quote(table_name)} ({column_list}) {latest} ON DUPLICATE KEY UPDATE {assignments}"
+    if updates:
+        action = "DO UPDATE SET " + ", ".join(f"{quote(column)} = excluded.{quote(column)}" for column in updates)
+    else:
+        action = "DO NOTHING"
+    return f"INSERT INTO {quote(table_name)} ({column_list}) {latest} ON CONFLICT ({key_list}) {action}"
+
+def analyze_table(connection, table_name):
+    """Refresh planner statistics so new indexes are used straight away"""
+    quoted = connection.dialect.identifier_preparer.quote(table_name)
+    statement = f"ANALYZE TABLE {quoted}" if connection.dialect.name == 'mysql' else f"ANALYZE {quoted}"
+    connection.exec_driver_sql(statement)
+
+def ingest_frames(engine, table_name, frames, progress=None, options=None):
+    """Load an iterator of DataFrame chunks into `table_name` in one transaction
+
+    In replace mode the table is dropped and recreated with column types inferred from the first
+    chunk and the requested primary key; secondary indexes are built and ANALYZE run after the rows
+    are in. Append inserts into the existing table, and upsert loads the rows into a staging table
+    and merges them on the key columns in one statement, so both cost time in proportion to the
+    upload rather than the table. Columns the table doesn't have yet are added with ALTER TABLE.
+    """
+    options = options or UploadOptions()
+    start = time.monotonic()
+    row_count = 0
+    columns = None
+    kinds = {}
+    schema = {}
+    index_names = []
+    key = []
+    loaded = {}
+    staging = None
+    target = table_name
+    
+    with engine.begin() as connection:
+        preparer = connection.dialect.identifier_preparer
+        
+        def add_column(column, series):
+            sql_type, kinds[column] = infer_column_type(series, connection.dialect)
+            schema[column] = sql_type.compile(dialect=connection.dialect)
+            for table in filter(None, (table_name, staging)):
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {preparer.quote(table)} ADD COLUMN {preparer.quote(column)} {schema[column]}"
+                )
+        
+        for chunk in frames:
+            chunk.columns = [str(column) for column in chunk.columns]
+            if columns is None:
+                inspector = sqlalchemy_inspect(connection)
+                if options.mode != 'replace' and inspector.has_table(table_name):
+                    existing = inspector.get_columns(table_name)
+                    kinds = {column['name']: column_kind(column['type']) for column in existing}
+                    schema = {column['name']: column['type'].compile(dialect=connection.dialect) for column in existing}
+                    chunk.columns = match_columns(chunk.columns, kinds)
+                    check_upload_options(options, list(chunk.columns))
+                else:
+                    check_upload_options(options, list(chunk.columns))
+                    sql_types = {}
+                    for column in chunk.columns:
+                        sql_types[column], kinds[column] = infer_column_type(chunk[column], connection.dialect)
+                        schema[column] = sql_types[column].compile(dialect=connection.dialect)
+                    primary_key = list(options.primary_key or (options.key if options.mode == 'upsert' else ()))
+                    connection.exec_driver_sql(f"DROP TABLE IF EXISTS {preparer.quote(table_name)}")
+                    connection.exec_driver_sql(pd.io.sql.get_schema(
+                        chunk, table_name, keys=primary_key or None, con=connection, dtype=sql_types
+                    ))
+                columns = list(kinds)
+                if options.mode == 'upsert':
+                    key = ensure_upsert_key(connection, table_name, options)
+                    staging = f"{STAGING_TABLE_PREFIX}{table_name}"
+                    connection.exec_driver_sql(f"DROP TABLE IF EXISTS {preparer.quote(staging)}")
+                    connection.exec_driver_sql(
+                        f"CREATE TEMPORARY TABLE {preparer.quote(staging)} AS SELECT "
+                        f"{', '.join(preparer.quote(column) for column in columns)} FROM {preparer.quote(table_name)} WHERE 1 = 0"
+                    )
+                    connection.exec_driver_sql(
+                        f"ALTER TABLE {preparer.quote(staging)} ADD COLUMN {preparer.quote(STAGING_ROW_COLUMN)} INTEGER"
+                    )
+                    target = staging
+            
+            chunk.columns = match_columns(chunk.columns, columns)
+            # New columns, e.g. keys first seen deep into a JSON file or added to a later export
+            for column in chunk.columns:
+                if column not in kinds:
+                    add_column(column, chunk[column])
+                    columns.append(column)
+            for column in chunk.columns:
+                chunk[column] = coerce_column(chunk[column], kinds[column])
+                loaded[column] = True
+            if staging:
+                chunk[STAGING_ROW_COLUMN] = range(row_count, row_count + len(chunk))
+            insert_rows(connection, target, list(chunk.columns), dataframe_rows(chunk))
+            row_count += len(chunk)
+            if progress:
+                progress(row_count)
+        
+        if staging:
+            if row_count:
+                missing = [column for column in key if column not in loaded]
+                if missing:
+                    raise UploadSchemaError(f"Key column(s) not in file: {', '.join(missing)}")
+                # Columns the file doesn't have keep their current values
+                connection.exec_driver_sql(merge_staging_sql(connection.dialect, table_name, staging, list(loaded), key))
+            connection.exec_driver_sql(f"DROP TABLE {preparer.quote(staging)}")
+        
+        # Building indexes once over the loaded table is cheaper than maintaining them row by row
+        existing_indexes = set()
+        if columns is not None and options.mode != 'replace':
+            existing_indexes = {index['name'] for index in sqlalchemy_inspect(connection).get_indexes(table_name)}
+        for index_columns in options.indexes if columns is not None else ():
+            name = advised_index_name(table_name, index_columns)
+            if name not in existing_indexes:
+                connection.exec_driver_sql(
+                    f"CREATE INDEX {preparer.quote(name)} ON {preparer.quote(table_name)} "
+                    f"({', '.join(preparer.quote(column) for column in index_columns)})"
+                )
+            index_names.append(name)
+        # Delta loads keep the existing statistics unless they changed the indexes
+        if columns is not None and (options.mode == 'replace' or set(index_names) - existing_indexes):
+            analyze_table(connection, table_name)
+    
+    elapsed = time.monotonic() - start
+    rows_per_second = row_count / elapsed if elapsed > 0 else 0
+    logger.info(f"Ingested {row_count} rows into {table_name} ({options.mode}) in {elapsed:.2f}s ({rows_per_second:.0f} rows/s)")
+    return {
+        "columns": columns or [],
+        "row_count": row_count,
+        "elapsed": elapsed,
+        "rows_per_second": rows_per_second,
+        "schema": schema,
+        "mode": options.mode,
+        "primary_key": list(options.primary_key),
+        "key": key,
+        "indexes": index_names
+    }
+
+def ingest_csv(engine, table_name, file_path, chunk_size, progress=None, options=None):
+    """Stream a CSV into a table chunk by chunk so memory is bounded by the chunk size"""
+    return ingest_frames(engine, table_name, upload_parse.iter_csv_frames(file_path, chunk_size), progress, options)
+
+def ingest_json(engine, table_name, file_path, chunk_size, progress=None, options=None):
+    """Stream JSON or NDJSON records into a table in bounded batches"""
+    return ingest_frames(engine, table_name, upload_parse.iter_json_frames(file_path, chunk_size), progress, options)
+
+def safe_table_name(name):
+    """Table name from a file or sheet name: lowercase alphanumerics and underscores, not starting with a digit"""
+    table_name = ''.join(c if c.isalnum() else '_' for c in name.lower())
+    if not table_name or table_name[0].isdigit():
+        table_name = 'f_' + table_name
+    return table_name
+
+def ingest_excel(engine, table_name, file_path, chunk_size, progress=None, options=None):
+    """Stream every worksheet of an XLSX workbook into its own table
+
+    Each sheet is read with openpyxl's read-only mode in bounded batches and loaded in its own
+    transaction, so a failing sheet doesn't roll back the others. Several sheets are parsed in
+    parallel like a multi-file upload.
+    """
+    tasks = upload_tasks(os.path.basename(file_path), file_path, None, table_name)
+    if len(tasks) == 1:
+        return ingest_frames(engine, table_name, upload_parse.iter_file_frames(file_path, 'xlsx', chunk_size, tasks[0].sheet),
+                             progress, options)
+    
+    batch = ingest_upload_tasks(engine, tasks, options, progress)
+    for entry in batch['files']:
+        if entry['error']:
+            raise UploadSchemaError(f"Sheet '{entry['sheet']}': {entry['error']}")
+    return {
+        "columns": [],
+        "row_count": batch['row_count'],
+        "elapsed": batch['elapsed'],
+        "rows_per_second": batch['rows_per_second'],
+        "schema": {},
+        "mode": (options or UploadOptions()).mode,
+        "primary_key": [],
+        "key": [],
+        "indexes": [],
+        # Blank sheets don't create tables
+        "tables": [entry for entry in batch['files'] if entry['columns']]
+    }
+
+# Multi-file uploads
+UploadTask = namedtuple('UploadTask', ['filename', 'file_path', 'kind', 'table_name', 'sheet'], defaults=(None,))
+
+def upload_kind(filename, file_type=None):
+    """Parser for an uploaded file: csv, json, xlsx or xls"""
+    name = filename.lower()
+    if file_type == 'json' or name.endswith(('.json', '.ndjson', '.jsonl')):
+        return 'json'
+    if name.endswith('.xlsx'):
+        return 'xlsx'
+    if name.endswith('.xls'):
+        return 'xls'
+    return 'csv'
+
+def upload_tasks(filename, file_path, file_type, table_name):
+    """One load per table: a task per worksheet for XLSX workbooks, otherwise a single task"""
+    kind = upload_kind(filename, file_type)
+    if kind != 'xlsx':
+        return [UploadTask(filename, file_path, kind, table_name)]
+    sheets = upload_parse.excel_sheet_names(file_path)
+    if len(sheets) == 1:
+        return [UploadTask(filename, file_path, kind, table_name, sheets[0])]
+    return [UploadTask(filename, file_path, kind, safe_table_name(f"{table_name}_{sheet}"), sheet) for sheet in sheets]
+
+def upload_tables(file_path, filename, table_name):
+    """Tables an upload writes to: one per sheet for XLSX workbooks, otherwise just `table_name`"""
+    try:
+        return [task.table_name for task in upload_tasks(filename, file_path, None, table_name)]
+    except Exception:
+        # Not a readable workbook; ingestion reports the error
+        return [table_name]
+
+def extract_upload_archive(archive_path):
+    """Copy the uploadable files out of a ZIP archive, returning (member name, path, SHA-256) triples"""
+    members = []
+    with zipfile.ZipFile(archive_path) as archive:
+        entries = [
+            info for info in archive.infolist()
+            if not info.is_dir() and not info.filename.startswith('__MACOSX/')
+            and not os.path.basename(info.filename).startswith('.')
+            and info.filename.lower().endswith(UPLOAD_EXTENSIONS)
+        ]
+        if not entries:
+            raise UploadSchemaError(f"No {', '.join(UPLOAD_EXTENSIONS)} files in {os.path.basename(archive_path)}")
+        if len(entries) > app.config['UPLOAD_MAX_FILES']:
+            raise UploadSchemaError(f"Archive holds {len(entries)} files; the limit is {app.config['UPLOAD_MAX_FILES']}")
+        # Checked against the declared sizes before anything is written, so a ZIP bomb is refused up front
+        if sum(info.file_size for info in entries) > app.config['UPLOAD_MAX_ARCHIVE_BYTES']:
+            raise UploadSchemaError(f"Archive expands to more than {app.config['UPLOAD_MAX_ARCHIVE_BYTES']} bytes")
+        for info in entries:
+            path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}_{secure_filename(os.path.basename(info.filename))}")
+            with archive.open(info) as source:
+                members.append((info.filename, path, copy_with_hash(source, path)))
+    return members
+
+parse_executor = None
+parse_executor_pid = None
+parse_executor_lock = threading.Lock()
+
+def get_parse_executor():
+    """Upload parse worker processes, or None to parse in the loading threads when UPLOAD_PARSE_WORKERS is 0"""
+    global parse_executor, parse_executor_pid
+    if app.config['UPLOAD_PARSE_WORKERS'] <= 0:
+        return None
+    with parse_executor_lock:
+        if parse_executor is None or parse_executor_pid != os.getpid():
+            # Spawned rather than forked so workers never inherit request threads or open connections
+            parse_executor = ProcessPoolExecutor(max_workers=app.config['UPLOAD_PARSE_WORKERS'],
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            parse_executor_pid = os.getpid()
+        return parse_executor
+
+def ingest_upload_tasks(engine, tasks, options=None, progress=None):
+    """Parse several files or sheets concurrently and load each into its own table
+
+    Files are parsed on the UPLOAD_PARSE_WORKERS processes, which spool their chunks to disk,
+    and each table is loaded from its spool in its own transaction as soon as its parse is done.
+    SQLite takes one writer at a time, so there loads run one after another on a single thread;
+    other databases load up to UPLOAD_TABLE_WRITERS tables at once. Returns a manifest entry per
+    task; a file that fails records its error without affecting the others.
+    """
+    start = time.monotonic()
+    chunk_size = app.config['UPLOAD_CHUNK_SIZE']
+    manifest = [
+        {"filename": task.filename, "sheet": task.sheet, "table_name": task.table_name, "row_count": 0,
+         "columns": [], "schema": {}, "parse_time": None, "load_time": None, "error": None}
+        for task in tasks
+    ]
+    owners = {}
+    for index, entry in enumerate(manifest):
+        owner = owners.setdefault(entry['table_name'], index)
+        if owner != index:
+            entry['error'] = f"{manifest[owner]['filename']} in this upload also loads table '{entry['table_name']}'"
+    
+    loaded_rows = [0] * len(tasks)
+    progress_lock = threading.Lock()
+    
+    def load(index, frames, spool=None):
+        entry = manifest[index]
+        started = time.perf_counter()
+        
+        def report(rows):
+            with progress_lock:
+                loaded_rows[index] = rows
+                total = sum(loaded_rows)
+            if progress:
+                progress(total)
+        
+        try:
+            stats = ingest_frames(engine, entry['table_name'], frames, report, options)
+            entry.update(row_count=stats['row_count'], columns=stats['columns'], schema=stats['schema'])
+        except Exception as e:
+            logger.error(f"Loading {entry['filename']} into {entry['table_name']} failed: {e}")
+            entry['error'] = str(e)
+        finally:
+            entry['load_time'] = time.perf_counter() - started
+            if spool:
+                os.remove(spool)
+    
+    parse_pool = get_parse_executor()
+    writers = 1 if engine.dialect.name == 'sqlite' else max(1, min(app.config['UPLOAD_TABLE_WRITERS'], len(tasks)))
+    spool_dir = tempfile.mkdtemp(prefix='chatdb-upload-')
+    try:
+        with ThreadPoolExecutor(max_workers=writers, thread_name_prefix='upload-load') as loader:
+            parses = {}
+            for index, task in enumerate(tasks):
+                if manifest[index]['error']:
+                    continue
+                if parse_pool is None:
+                    loader.submit(load, index, upload_parse.iter_file_frames(task.file_path, task.kind, chunk_size, task.sheet))
+                    continue
+                spool = os.path.join(spool_dir, f"{index}.pickle")
+                future = parse_pool.submit(upload_parse.parse_to_spool, task.file_path, task.kind, chunk_size, spool, task.sheet)
+                parses[future] = (index, spool)
+            for future in as_completed(parses):
+                index, spool = parses[future]
+                try:
+                    manifest[index]['parse_time'] = future.result()['parse_time']
+                except Exception as e:
+                    manifest[index]['error'] = f"Could not parse file: {e}"
+                    continue
+                loader.submit(load, index, upload_parse.iter_spool(spool), spool)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    
+    elapsed = time.monotonic() - start
+    row_count = sum(entry['row_count'] for entry in manifest)
+    failed = sum(1 for entry in manifest if entry['error'])
+    rows_per_second = row_count / elapsed if elapsed > 0 else 0
+    logger.info(f"Ingested {row_count} rows from {len(tasks)} files in {elapsed:.2f}s ({rows_per_second:.0f} rows/s, {failed} failed)")
+    return {
+        "files": manifest,
+        "row_count": row_count,
+        "elapsed": elapsed,
+        "rows_per_second": rows_per_second,
+        "loaded": len(tasks) - failed,
+        "failed": failed
+    }
+
+# Upload catalog
+# Loads that leave the table holding exactly the file's rows; append and upsert merge into what was there
+CATALOG_MODES = ('replace',)
+CATALOG_FIELDS = ('columns', 'row_count', 'schema', 'mode', 'primary_key', 'key', 'indexes')
+
+class HashingUploadFile:
+    """Spool for an uploaded file that hashes the bytes as the form parser writes them"""
+    def __init__(self):
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=UPLOAD_FOLDER, prefix='incoming_')
+        self._digest = hashlib.sha256()
+    
+    def write(self, data):
+        self._digest.update(data)
+        return self._file.write(data)
+    
+    @property
+    def content_hash(self):
+        return self._digest.hexdigest()
+    
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingUploadFile()
+
+app.request_class = UploadRequest
+
+def copy_with_hash(source, path):
+    """Copy a stream to `path`, returning the SHA-256 of the bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'wb') as target:
+        for block in iter(lambda: source.read(1 << 20), b''):
+            digest.update(block)
+            target.write(block)
+    return digest.hexdigest()
+
+def save_upload(file, path):
+    """Save an uploaded file to `path` and return its SHA-256, reusing the hash taken while it arrived"""
+    stream = file.stream
+    if isinstance(stream, HashingUploadFile):
+        stream.flush()
+        try:
+            # Same directory, so a hard link saves writing the bytes a second time
+            os.link(stream.name, path)
+            return stream.content_hash
+        except OSError:
+            pass
+    stream.seek(0)
+    return copy_with_hash(stream, path)
+
+def upload_database_key(engine):
+    return engine.url.render_as_string(hide_password=True)
+
+def upload_options_key(options, kind):
+    """Everything besides the bytes that decides what a load produces"""
+    signature = json.dumps([kind, (options or UploadOptions())._asdict()], sort_keys=True)
+    return hashlib.sha256(signature.encode()).hexdigest()[:16]
+
+def table_change_marker(engine, table):
+    """A value that changes when rows are added to a table, read without scanning it
+
+    The highest rowid on SQLite and the last update time on MySQL. Other databases have no cheap
+    marker and rely on the app clearing catalog entries of every table it writes to.
+    """
+    with engine.connect() as connection:
+        dialect = connection.dialect.name
+        if dialect == 'sqlite':
+            value = connection.execute(
+                text(f"SELECT MAX(rowid) FROM {connection.dialect.identifier_preparer.quote(table)}")
+            ).scalar()
+        elif dialect == 'mysql':
+            value = connection.execute(
+                text("SELECT update_time FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = :name"),
+                {"name": table}
+            ).scalar()
+        else:
+            return None
+    return None if value is None else str(value)
+
+def find_loaded_upload(engine, tables, content_hash, options_key):
+    """Stats of `tables` if each was last loaded from this content with these options and still holds it
+
+    Writes through /manage and other loads clear a table's entry; a change marker that moved since
+    loading catches rows added by other clients.
+    """
+    entries = UploadCatalog.query.filter(
+        UploadCatalog.database == upload_database_key(engine),
+        UploadCatalog.table_name.in_(tables),
+        UploadCatalog.content_hash == content_hash,
+        UploadCatalog.options_key == options_key
+    ).all()
+    if len(entries) != len(tables):
+        return None
+    by_table = {entry.table_name: json.loads(entry.stats or '{}') for entry in entries}
+    markers = {entry.table_name: entry.change_marker for entry in entries}
+    # Blank sheets are catalogued without columns and never had a table
+    inspector = sqlalchemy_inspect(engine)
+    for table in tables:
+        if not by_table[table].get('columns'):
+            continue
+        if not inspector.has_table(table) or table_change_marker(engine, table) != markers[table]:
+            return None
+    return [{"table_name": table, **by_table[table]} for table in tables]
+
+@retry_on_lock
+def forget_uploads(engine, tables):
+    """Drop the catalog entries of tables whose contents are changing, or of every table when None"""
+    entries = UploadCatalog.query.filter(UploadCatalog.database == upload_database_key(engine))
+    if tables is not None:
+        tables = [table.lower() for table in tables]
+        if not tables:
+            return
+        entries = entries.filter(db.func.lower(UploadCatalog.table_name).in_(tables))
+    entries.delete(synchronize_session=False)
+    db.session.commit()
+
+@retry_on_lock
+def record_upload(engine, user_id, content_hash, options_key, filename, table_stats):
+    """Note which content each table now holds; `table_stats` maps table name to its load stats"""
+    database = upload_database_key(engine)
+    UploadCatalog.query.filter(
+        UploadCatalog.database == database,
+        UploadCatalog.table_name.in_(list(table_stats))
+    ).delete(synchronize_session=False)
+    for table, stats in table_stats.items():
+        db.session.add(UploadCatalog(
+            user_id=user_id,
+            database=database,
+            table_name=table,
+            content_hash=content_hash,
+            options_key=options_key,
+            filename=filename[:255],
+            stats=json.dumps({field: stats[field] for field in CATALOG_FIELDS if field in stats}),
+            change_marker=table_change_marker(engine, table) if stats.get('columns') else None
+        ))
+    db.session.commit()
+
+def loaded_table_stats(stats, tables):
+    """Per-table stats of a single-file upload into `tables`: one entry per sheet for workbooks"""
+    if 'tables' not in stats:
+        return {tables[0]: stats}
+    loaded = {entry['table_name']: entry for entry in stats['tables']}
+    blank = {"columns": [], "row_count": 0, "schema": {}}
+    return {table: {**loaded.get(table, blank), "mode": stats['mode']} for table in tables}
+
+# Background upload jobs
+upload_executor = None
+upload_executor_lock = threading.Lock()
+# Live progress for jobs running in this process; the database row is updated on state changes
+upload_job_progress = {}
+# Jobs queued or running in this process, whose heartbeat it keeps fresh
+local_upload_jobs = set()
+upload_heartbeat_pid = None
+
+def get_upload_executor():
+    """Create the ingestion worker pool on first use, after any fork by the app server"""
+    global upload_executor
+    ensure_upload_heartbeat()
+    with upload_executor_lock:
+        if upload_executor is None:
+            upload_executor = ThreadPoolExecutor(max_workers=app.config['UPLOAD_WORKERS'], thread_name_prefix='upload')
+        return upload_executor
+
+@app.before_request
+def ensure_upload_heartbeat():
+    """Once per process: interrupt jobs orphaned by a restart and start the heartbeat thread"""
+    global upload_heartbeat_pid
+    with upload_executor_lock:
+        if upload_heartbeat_pid == os.getpid():
+            return
+        upload_heartbeat_pid = os.getpid()
+        # A forked worker doesn't own its parent's jobs
+        local_upload_jobs.clear()
+    recover_upload_jobs()
+    threading.Thread(target=upload_heartbeat_loop, name='upload-heartbeat', daemon=True).start()
+
+def upload_heartbeat_loop():
+    while True:
+        time.sleep(app.config['UPLOAD_JOB_HEARTBEAT'])
+        with app.app_context():
+            try:
+                job_ids = list(local_upload_jobs)
+                if job_ids:
+                    UploadJob.query.filter(UploadJob.id.in_(job_ids)).update(
+                        {UploadJob.heartbeat_at: datetime.utcnow()}, synchronize_session=False
+                    )
+                    db.session.commit()
+                recover_upload_jobs()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Upload job heartbeat failed: {e}")
+
+def upload_job_orphaned(job):
+    """Whether the process that queued a job is gone.
+
+    PIDs repeat across container restarts, so liveness comes from the heartbeat rather than the PID.
+    """
+    if job.id in local_upload_jobs:
+        return False
+    if job.worker_pid == os.getpid():
+        # Our PID, but not our job: it belonged to an earlier process
+        return True
+    last_seen = job.heartbeat_at or job.started_at or job.created_at
+    stale_after = timedelta(seconds=4 * app.config['UPLOAD_JOB_HEARTBEAT'])
+    return last_seen is None or datetime.utcnow() - last_seen > stale_after
+
+def recover_upload_jobs(jobs=None):
+    """Mark queued or running jobs whose worker process has died as interrupted"""
+    try:
+        if jobs is None:
+            jobs = UploadJob.query.filter(UploadJob.status.in_(['queued', 'running'])).all()
+        changed = False
+        for job in jobs:
+            if job.status in ('queued', 'running') and upload_job_orphaned(job):
+                job.status = 'interrupted'
+                job.error_message = 'The server restarted before this upload finished. Please upload the file again.'
+                job.finished_at = datetime.utcnow()
+                changed = True
+        if changed:
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error recovering upload jobs: {e}")
+
+@retry_on_lock
+def update_upload_job(job_id, **fields):
+    job = db.session.get(UploadJob, job_id)
+    for name, value in fields.items():
+        setattr(job, name, value)
+    db.session.commit()
+
+def run_upload_job(job_id, engine, file_path, filename, file_type, table_name, user_id, options=None, content_hash=None):
+    """Worker entry point: ingest an uploaded file and record the outcome on its UploadJob"""
+    with app.app_context():
+        start = time.monotonic()
+        upload_job_progress[job_id] = {"rows_processed": 0, "rows_per_second": 0}
+        
+        def progress(rows):
+            elapsed = time.monotonic() - start
+            upload_job_progress[job_id] = {
+                "rows_processed": rows,
+                "rows_per_second": rows / elapsed if elapsed > 0 else 0
+            }
+        
+        tables = upload_tables(file_path, filename, table_name)
+        try:
+            update_upload_job(job_id, status='running', started_at=datetime.utcnow(), worker_pid=os.getpid())
+            forget_uploads(engine, tables)
+            stats = process_upload(engine, file_path, filename, file_type, table_name, progress, options)
+            if content_hash and (options or UploadOptions()).mode in CATALOG_MODES:
+                record_upload(engine, user_id, content_hash, upload_options_key(options, upload_kind(filename, file_type)),
+                              filename, loaded_table_stats(stats, tables))
+            update_upload_job(
+                job_id,
+                status='completed',
+                rows_processed=stats['row_count'],
+                rows_per_second=stats['rows_per_second'],
+                finished_at=datetime.utcnow()
+            )
+            log_query(f"UPLOAD: {filename} -> {', '.join(tables)}", 'upload', stats['elapsed'], True, user_id=user_id)
+        except Exception as e:
+            logger.error(f"Upload job {job_id} failed: {e}")
+            db.session.rollback()
+            rows = upload_job_progress.get(job_id, {}).get('rows_processed', 0)
+            update_upload_job(job_id, status='failed', error_message=str(e), rows_processed=rows,
+                              finished_at=datetime.utcnow())
+            log_query(f"UPLOAD: {filename}", 'upload', success=False, error_message=str(e), user_id=user_id)
+        finally:
+            upload_job_progress.pop(job_id, None)
+            local_upload_jobs.discard(job_id)
+            invalidate_results(tables)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+def upload_job_status(job):
+    """JSON view of a job, overlaying live progress when this process is running it"""
+    live = upload_job_progress.get(job.id, {})
+    if job.started_at:
+        end = job.finished_at or datetime.utcnow()
+        elapsed = (end - job.started_at).total_seconds()
+    else:
+        elapsed = None
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "filename": job.filename,
+        "table_name": job.table_name,
+        "rows_processed": live.get('rows_processed', job.rows_processed or 0),
+        "rows_per_second": live.get('rows_per_second', job.rows_per_second),
+        "elapsed": elapsed,
+        "error": job.error_message,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None
+    }
+
+# Engine registry
+def create_pooled_engine(uri):
+    """Create an engine with a tuned connection pool for a user database"""
+    url = make_url(uri)
+    options = {"pool_pre_ping": True}
+    if not (url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')):
+        options.update(
+            pool_size=app.config['ENGINE_POOL_SIZE'],
+            max_overflow=app.config['ENGINE_MAX_OVERFLOW'],
+            pool_recycle=app.config['ENGINE_POOL_RECYCLE']
+        )
+    return create_engine(url, **options)
+
+class EngineRegistry:
+    """Engines keyed by DatabaseConnection.id, evicted least-recently-used or when idle"""
+    def __init__(self, max_engines, idle_timeout):
+        self.max_engines = max_engines
+        self.idle_timeout = idle_timeout
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _dispose(self, connection_id):
+        # Checked-out connections keep working and are closed when they are returned
+        entry = self._engines.pop(connection_id)
+        entry['engine'].dispose()
+        logger.info(f"Disposed engine for connection {connection_id}")
+    
+    def get(self, connection_id, uri):
+        with self._lock:
+            now = time.monotonic()
+            for idle_id in [cid for cid, entry in self._engines.items()
+                            if cid != connection_id and now - entry['last_used'] > self.idle_timeout]:
+                self._dispose(idle_id)
+            
+            entry = self._engines.get(connection_id)
+            if entry is not None and entry['uri'] != uri:
+                self._dispose(connection_id)
+                entry = None
+            if entry is None:
+                entry = {"engine": create_pooled_engine(uri), "uri": uri}
+                self._engines[connection_id] = entry
+                while len(self._engines) > self.max_engines:
+                    self._dispose(next(iter(self._engines)))
+            
+            entry['last_used'] = now
+            self._engines.move_to_end(connection_id)
+            return entry['engine']
+    
+    def discard(self, connection_id):
+        with self._lock:
+            if connection_id in self._engines:
+                self._dispose(connection_id)
+    
+    def stats(self):
+        with self._lock:
+            return {str(cid): entry['engine'].pool.status() for cid, entry in self._engines.items()}
 
-def admin_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in flask_session:
-            flash('Please log in to access this page.', 'warning')
-            return redirect(url_for('login'))
-        # Add admin check logic here if needed
-        return f(*args, **kwargs)
-    return decorated_function
+engine_registry = EngineRegistry(app.config['ENGINE_REGISTRY_MAX'], app.config['ENGINE_IDLE_TIMEOUT'])
 
-# Utility functions
-def log_query(query, query_type, execution_time=None, success=True, error_message=None):
-    """Log query execution for analytics"""
-    try:
-        user_id = flask_session.get('user_id')
-        history = QueryHistory(
-            user_id=user_id,
-            query=query,
-            query_type=query_type,
-            execution_time=execution_time,
-            success=success,
-            error_message=error_message
-        )
-        db.session.add(history)
-        db.session.commit()
-    except Exception as e:
-        logger.error(f"Error logging query: {e}")
+def get_user_connection():
+    """The DatabaseConnection selected in this session, or None for the application database"""
+    connection_id = flask_session.get('connection_id')
+    if connection_id is None:
+        return None
+    connection = db.session.get(DatabaseConnection, connection_id)
+    if connection is None or connection.user_id != flask_session.get('user_id'):
+        flask_session.pop('connection_id', None)
+        return None
+    return connection
+
+def get_user_engine():
+    """Engine for the current user's selected database, defaulting to the application database"""
+    connection = get_user_connection()
+    if connection is None:
+        return db.engine
+    return engine_registry.get(connection.id, connection.connection_string)
 
 def get_hf_query_suggestion(user_query):
     """Get AI-powered query suggestions using Hugging Face"""
@@ -176,13 +3421,16 @@ def get_hf_query_suggestion(user_query):
         return None
 
 def validate_sql_query(query):
-    """Basic SQL injection prevention"""
-    dangerous_keywords = ['DROP', 'DELETE', 'TRUNCATE', 'ALTER', 'CREATE', 'INSERT', 'UPDATE']
-    query_upper = query.upper().strip()
+    """Basic SQL injection prevention, checking keywords only (not strings, comments or quoted names)"""
+    parsed = parse_sql(query or '')
+    if parsed.statement_count == 0:
+        return False, "Query is empty"
+    if parsed.statement_count > 1:
+        return False, "Only one statement can be run at a time"
     
     # Check for dangerous operations
-    for keyword in dangerous_keywords:
-        if keyword in query_upper:
+    for keyword in BLOCKED_KEYWORDS:
+        if keyword in parsed.keywords:
             return False, f"Operation '{keyword}' is not allowed for security reasons"
     
     return True, "Query is safe"
@@ -236,6 +3484,121 @@ def init_database():
             )
         ''')
 
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_job (
+                id VARCHAR(32) PRIMARY KEY,
+                user_id INTEGER,
+                filename VARCHAR(255) NOT NULL,
+                table_name VARCHAR(255) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                rows_processed INTEGER DEFAULT 0,
+                rows_per_second FLOAT,
+                error_message TEXT,
+                worker_pid INTEGER,
+                heartbeat_at DATETIME,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                started_at DATETIME,
+                finished_at DATETIME,
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        # Databases created before job heartbeats were added
+        upload_job_columns = {row[1] for row in conn.execute('PRAGMA table_info(upload_job)')}
+        if 'heartbeat_at' not in upload_job_columns:
+            conn.execute('ALTER TABLE upload_job ADD COLUMN heartbeat_at DATETIME')
+
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_query_history_user_created
+            ON query_history (user_id, created_at)
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_query_limits (
+                user_id INTEGER PRIMARY KEY,
+                timeout FLOAT,
+                max_rows INTEGER,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_query_stats (
+                user_id INTEGER NOT NULL,
+                query_type VARCHAR(50) NOT NULL,
+                total_count INTEGER NOT NULL DEFAULT 0,
+                success_count INTEGER NOT NULL DEFAULT 0,
+                total_execution_time FLOAT NOT NULL DEFAULT 0,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, query_type),
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS slow_query (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                query TEXT NOT NULL,
+                fingerprint VARCHAR(16),
+                source VARCHAR(20),
+                execution_time FLOAT,
+                execute_time FLOAT,
+                fetch_time FLOAT,
+                serialize_time FLOAT,
+                row_count INTEGER,
+                plan TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_slow_query_user_created
+            ON slow_query (user_id, created_at)
+        ''')
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_catalog (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                database VARCHAR(512) NOT NULL,
+                table_name VARCHAR(255) NOT NULL,
+                content_hash VARCHAR(64) NOT NULL,
+                options_key VARCHAR(16) NOT NULL,
+                filename VARCHAR(255),
+                stats TEXT,
+                change_marker VARCHAR(64),
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                CONSTRAINT uq_upload_catalog_table UNIQUE (database, table_name),
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_upload_catalog_hash
+            ON upload_catalog (content_hash)
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS table_version (
+                table_name VARCHAR(255) PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS query_ticket (
+                query_id VARCHAR(32) PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                status VARCHAR(10) NOT NULL DEFAULT 'issued',
+                cancelled BOOLEAN NOT NULL DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        upload_catalog_columns = {row[1] for row in conn.execute('PRAGMA table_info(upload_catalog)')}
+        if 'change_marker' not in upload_catalog_columns:
+            conn.execute('ALTER TABLE upload_catalog ADD COLUMN change_marker VARCHAR(64)')
+
         conn.commit()
         conn.close()
         print("Database tables created manually")
@@ -307,6 +3670,114 @@ def reset_database():
             )
         ''')
         
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_job (
+                id VARCHAR(32) PRIMARY KEY,
+                user_id INTEGER,
+                filename VARCHAR(255) NOT NULL,
+                table_name VARCHAR(255) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                rows_processed INTEGER DEFAULT 0,
+                rows_per_second FLOAT,
+                error_message TEXT,
+                worker_pid INTEGER,
+                heartbeat_at DATETIME,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                started_at DATETIME,
+                finished_at DATETIME,
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_query_history_user_created
+            ON query_history (user_id, created_at)
+        ''')
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_query_limits (
+                user_id INTEGER PRIMARY KEY,
+                timeout FLOAT,
+                max_rows INTEGER,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS user_query_stats (
+                user_id INTEGER NOT NULL,
+                query_type VARCHAR(50) NOT NULL,
+                total_count INTEGER NOT NULL DEFAULT 0,
+                success_count INTEGER NOT NULL DEFAULT 0,
+                total_execution_time FLOAT NOT NULL DEFAULT 0,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, query_type),
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS slow_query (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                query TEXT NOT NULL,
+                fingerprint VARCHAR(16),
+                source VARCHAR(20),
+                execution_time FLOAT,
+                execute_time FLOAT,
+                fetch_time FLOAT,
+                serialize_time FLOAT,
+                row_count INTEGER,
+                plan TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_slow_query_user_created
+            ON slow_query (user_id, created_at)
+        ''')
+        
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_catalog (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                database VARCHAR(512) NOT NULL,
+                table_name VARCHAR(255) NOT NULL,
+                content_hash VARCHAR(64) NOT NULL,
+                options_key VARCHAR(16) NOT NULL,
+                filename VARCHAR(255),
+                stats TEXT,
+                change_marker VARCHAR(64),
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                CONSTRAINT uq_upload_catalog_table UNIQUE (database, table_name),
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS ix_upload_catalog_hash
+            ON upload_catalog (content_hash)
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS table_version (
+                table_name VARCHAR(255) PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS query_ticket (
+                query_id VARCHAR(32) PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                status VARCHAR(10) NOT NULL DEFAULT 'issued',
+                cancelled BOOLEAN NOT NULL DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES user (id)
+            )
+        ''')
+        
         conn.commit()
         conn.close()
         logger.info("Database reset successful")
@@ -533,74 +4004,180 @@ def logout():
 @app.route('/connect', methods=['GET', 'POST'])
 @login_required
 def connect_page():
+    user_id = flask_session.get('user_id')
     if request.method == 'POST':
         db_uri = request.json.get('db_uri')
         connection_name = request.json.get('connection_name', 'Default Connection')
         
+        # Switch to a saved connection, or back to the application database
+        if not db_uri and 'connection_id' in request.json:
+            connection_id = request.json.get('connection_id')
+            if connection_id is None:
+                flask_session.pop('connection_id', None)
+                return jsonify({"message": "Using the application database"})
+            
+            connection = db.session.get(DatabaseConnection, connection_id)
+            if connection is None or connection.user_id != user_id:
+                return jsonify({"error": "Connection not found"}), 404
+            try:
+                with engine_registry.get(connection.id, connection.connection_string).connect() as conn:
+                    conn.execute(text("SELECT 1"))
+            except Exception as e:
+                logger.error(f"Error connecting to SQL: {e}")
+                return jsonify({"error": str(e)}), 500
+            flask_session['connection_id'] = connection.id
+            return jsonify({"message": f"Connected to {connection.name}", "connection_id": connection.id})
+        
         if not db_uri:
             return jsonify({"error": "SQL Database URI is required."}), 400
         
+        connection = DatabaseConnection.query.filter_by(user_id=user_id, connection_string=db_uri).first()
         try:
-            # Validate connection
-            app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
-            db.engine.dispose()
-            
-            with app.app_context():
-                db.create_all()
-                # Test connection
-                db.session.execute(text("SELECT 1"))
-                db.session.commit()
+            if connection is None:
+                connection = DatabaseConnection(
+                    user_id=user_id,
+                    name=connection_name,
+                    connection_string=db_uri,
+                    database_type='sqlite' if 'sqlite' in db_uri else 'mysql' if 'mysql' in db_uri else 'postgresql'
+                )
+                db.session.add(connection)
+                db.session.flush()
             
-            # Save connection
-            connection = DatabaseConnection(
-                user_id=flask_session['user_id'],
-                name=connection_name,
-                connection_string=db_uri,
-                database_type='sqlite' if 'sqlite' in db_uri else 'mysql' if 'mysql' in db_uri else 'postgresql'
-            )
-            db.session.add(connection)
+            # Validate connection on its own pool; other users' engines are untouched
+            with engine_registry.get(connection.id, db_uri).connect() as conn:
+                conn.execute(text("SELECT 1"))
             db.session.commit()
             
-            return jsonify({"message": f"Connected to SQL database: {db_uri}"})
+            flask_session['connection_id'] = connection.id
+            return jsonify({"message": f"Connected to SQL database: {db_uri}", "connection_id": connection.id})
         except Exception as e:
+            db.session.rollback()
+            if connection.id is not None:
+                engine_registry.discard(connection.id)
             logger.error(f"Error connecting to SQL: {e}")
             return jsonify({"error": str(e)}), 500
     
     # Get user's saved connections
-    connections = DatabaseConnection.query.filter_by(user_id=flask_session.get('user_id')).all()
-    return render_template('connect.html', title="Connect to Database", connections=connections)
+    connections = DatabaseConnection.query.filter_by(user_id=user_id).all()
+    return render_template('connect.html', title="Connect to Database", connections=connections,
+                           active_connection_id=flask_session.get('connection_id'))
 
 @app.route('/manage', methods=['GET', 'POST'])
 @login_required
 def manage_page():
     if request.method == 'POST':
         query = request.json.get('query')
+        stream = bool(request.json.get('stream'))
+        page_size = request.json.get('page_size')
+        page_token = request.json.get('page_token')
+        result_format = request.json.get('format') or 'rows'
+        if result_format not in RESULT_FORMATS:
+            return jsonify({"error": f"format must be one of {', '.join(RESULT_FORMATS)}"}), 400
+        limits = get_query_limits()
         
         # Validate query
         is_safe, message = validate_sql_query(query)
         if not is_safe:
             return jsonify({"error": message}), 400
         
+        # Clients get an id from /manage/query_id up front so they can cancel while the request is still running
+        try:
+            query_id = claim_query_id(request.json.get('query_id'))
+        except QueryIdError as e:
+            return jsonify({"error": str(e)}), e.status_code
+        
         start_time = datetime.now()
+        timings = QueryTimings()
+        if (page_size or page_token) and is_select(query):
+            try:
+                page_size = int(page_size or app.config['MANAGE_MAX_PAGE_SIZE'])
+            except (TypeError, ValueError):
+                return jsonify({"error": "page_size must be an integer"}), 400
+            page_size = max(1, min(page_size, app.config['MANAGE_MAX_PAGE_SIZE']))
+            
+            try:
+                engine = get_user_engine()
+                # Paging runs and reads the page in one step, so it is all counted as execute
+                with timings.stage('execute'):
+                    payload = paginate_select(query, engine, page_size, page_token, result_format, limits, query_id)
+            except PageTokenError as e:
+                return jsonify({"error": str(e)}), e.status_code
+            except QueryAborted as e:
+                execution_time = (datetime.now() - start_time).total_seconds()
+                log_query(query, e.status, execution_time, False, str(e))
+                return jsonify({"error": str(e), "status": e.status, "query_id": query_id}), e.status_code
+            except Exception as e:
+                execution_time = (datetime.now() - start_time).total_seconds()
+                log_query(query, 'error', execution_time, False, str(e))
+                return jsonify({"error": str(e)}), 500
+            
+            with timings.stage('serialize'):
+                response = negotiated_response(payload)
+            # Only the first page is recorded so paging doesn't flood the history
+            if not page_token:
+                execution_time = (datetime.now() - start_time).total_seconds()
+                row_count = len(payload.get('data', payload.get('rows', [])))
+                log_query(query, 'select', execution_time, True,
+                          slow=slow_query_details(query, engine, execution_time, timings, row_count, 'manage', limits))
+            return response
+        
+        if stream and is_select(query):
+            # Stream rows in batches from a server-side cursor so memory stays flat
+            batch_size = app.config['MANAGE_STREAM_BATCH_SIZE']
+            connection = get_user_engine().connect().execution_options(yield_per=batch_size)
+            running = RunningQuery(query_id, flask_session.get('user_id'), connection, limits.timeout).arm()
+            try:
+                with timings.stage('execute'):
+                    result = connection.execute(text(query))
+            except Exception as e:
+                running.disarm()
+                connection.close()
+                execution_time = (datetime.now() - start_time).total_seconds()
+                aborted = running.aborted(e)
+                if aborted is not None:
+                    log_query(query, aborted.status, execution_time, False, str(aborted))
+                    return jsonify({"error": str(aborted), "status": aborted.status, "query_id": query_id}), aborted.status_code
+                log_query(query, 'error', execution_time, False, str(e))
+                return jsonify({"error": str(e)}), 500
+            
+            generator = stream_select_results(connection, result, query, start_time, batch_size, running,
+                                              limits.max_rows, timings)
+            return Response(stream_with_context(generator), mimetype='application/x-ndjson',
+                            headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'})
+        
         try:
+            engine = get_user_engine()
             with app.app_context():
-                if query.strip().lower().startswith("select"):
-                    result = db.session.execute(text(query))
-                    columns = result.keys()
-                    rows = [dict(zip(columns, row)) for row in result]
+                if is_select(query):
+                    columns, rows, cache_hit, truncated = fetch_select_cached(query, engine, limits, query_id, timings)
                     
-                    execution_time = (datetime.now() - start_time).total_seconds()
-                    log_query(query, 'select', execution_time, True)
+                    with timings.stage('serialize'):
+                        response = negotiated_response({
+                            **result_payload(columns, rows, result_format),
+                            "cached": cache_hit,
+                            "truncated": truncated,
+                            "max_rows": limits.max_rows,
+                            "query_id": query_id
+                        })
                     
-                    return jsonify({"data": rows})
+                    execution_time = (datetime.now() - start_time).total_seconds()
+                    log_query(query, 'select', execution_time, True,
+                              slow=slow_query_details(query, engine, execution_time, timings, len(rows), 'manage', limits))
+                    return response
                 else:
-                    db.session.execute(text(query))
-                    db.session.commit()
+                    with engine.begin() as connection, query_budget(connection, limits, query_id):
+                        connection.execute(text(query))
+                    invalidate_results(modified_tables(query))
+                    forget_uploads(engine, modified_tables(query))
                     
                     execution_time = (datetime.now() - start_time).total_seconds()
                     log_query(query, 'modify', execution_time, True)
                     
-                    return jsonify({"message": "Query executed successfully."})
+                    return jsonify({"message": "Query executed successfully.", "query_id": query_id})
+        except QueryAborted as e:
+            execution_time = (datetime.now() - start_time).total_seconds()
+            log_query(query, e.status, execution_time, False, str(e))
+            return jsonify({"error": str(e), "status": e.status, "query_id": query_id}), e.status_code
         except Exception as e:
             db.session.rollback()
             execution_time = (datetime.now() - start_time).total_seconds()
@@ -609,6 +4186,7 @@ def manage_page():
     
     # Get query history - simplified to avoid complex queries
     try:
+        query_log_writer.flush()
         user_id = flask_session.get('user_id')
         # Use a simple query to avoid complex SQLAlchemy operations
         history = db.session.query(QueryHistory).filter(QueryHistory.user_id == user_id).order_by(QueryHistory.created_at.desc()).limit(10).all()
@@ -618,12 +4196,230 @@ def manage_page():
     
     return render_template('manage.html', title="Manage Data", history=history)
 
+@app.route('/manage/cancel/<query_id>', methods=['POST'])
+@login_required
+def cancel_query(query_id):
+    """Interrupt one of the caller's running statements, in this worker or, through its ticket, any other"""
+    user_id = flask_session.get('user_id')
+    running = running_queries.get(query_id)
+    if running is not None and running.user_id == user_id:
+        running.cancel()
+        return jsonify({"message": "Cancellation requested", "query_id": query_id})
+    flagged = QueryTicket.query.filter_by(query_id=query_id, user_id=user_id).update(
+        {QueryTicket.cancelled: True}, synchronize_session=False
+    )
+    db.session.commit()
+    if not flagged:
+        return jsonify({"error": "No running query with that id"}), 404
+    return jsonify({"message": "Cancellation requested", "query_id": query_id})
+
+@app.route('/manage/query_id', methods=['POST'])
+@login_required
+def new_query_id():
+    """Issue an id to send with the next query so it can be cancelled while it runs"""
+    return jsonify({"query_id": issue_query_id(flask_session.get('user_id'))})
+
+@app.route('/manage/limits', methods=['GET', 'POST'])
+@login_required
+def query_limits():
+    """Read or set the caller's query timeout and row cap; null restores the default"""
+    user_id = flask_session.get('user_id')
+    if request.method == 'POST':
+        settings = db.session.get(UserQueryLimits, user_id) or UserQueryLimits(user_id=user_id)
+        try:
+            if 'timeout' in request.json:
+                timeout = request.json['timeout']
+                if timeout is not None and not 0 < float(timeout) <= app.config['QUERY_TIMEOUT_MAX']:
+                    return jsonify({"error": f"timeout must be between 0 and {app.config['QUERY_TIMEOUT_MAX']:g} seconds"}), 400
+                settings.timeout = None if timeout is None else float(timeout)
+            if 'max_rows' in request.json:
+                max_rows = request.json['max_rows']
+                if max_rows is not None and not 0 < int(max_rows) <= app.config['QUERY_MAX_ROWS_MAX']:
+                    return jsonify({"error": f"max_rows must be between 1 and {app.config['QUERY_MAX_ROWS_MAX']}"}), 400
+                settings.max_rows = None if max_rows is None else int(max_rows)
+        except (TypeError, ValueError):
+            return jsonify({"error": "timeout and max_rows must be numbers"}), 400
+        settings.updated_at = datetime.utcnow()
+        db.session.add(settings)
+        db.session.commit()
+    
+    limits = get_query_limits(user_id)
+    return jsonify({
+        "timeout": limits.timeout,
+        "max_rows": limits.max_rows,
+        "timeout_max": app.config['QUERY_TIMEOUT_MAX'],
+        "max_rows_max": app.config['QUERY_MAX_ROWS_MAX']
+    })
+
+@app.route('/manage/indexes', methods=['GET', 'POST'])
+@login_required
+def index_advisor():
+    """List recommended indexes for the caller's workload, or create one (or the top few with auto)"""
+    user_id = flask_session.get('user_id')
+    engine = get_user_engine()
+    limits = get_query_limits(user_id)
+    try:
+        query_log_writer.flush()
+        recommendations = recommend_indexes(engine, user_id, limits)
+    except QueryAborted as e:
+        return jsonify({"error": str(e), "status": e.status}), e.status_code
+    except Exception as e:
+        logger.error(f"Index advisor error: {e}")
+        return jsonify({"error": str(e)}), 500
+    
+    if request.method == 'GET':
+        return jsonify({"recommendations": recommendations})
+    
+    payload = request.json or {}
+    if payload.get('auto'):
+        try:
+            budget = int(payload.get('max_indexes') or app.config['INDEX_ADVISOR_MAX_AUTO'])
+        except (TypeError, ValueError):
+            return jsonify({"error": "max_indexes must be an integer"}), 400
+        selected = recommendations[:max(0, min(budget, app.config['INDEX_ADVISOR_MAX_AUTO']))]
+    else:
+        # Only indexes the advisor recommended can be created here
+        selected = [recommendation for recommendation in recommendations if recommendation['name'] == payload.get('index')]
+        if not selected:
+            return jsonify({"error": "index must name one of the current recommendations"}), 404
+    
+    created = []
+    try:
+        for recommendation in selected:
+            created.append(create_advised_index(engine, recommendation, limits))
+    except QueryAborted as e:
+        return jsonify({"error": str(e), "status": e.status, "created": created}), e.status_code
+    except Exception as e:
+        logger.error(f"Error creating index: {e}")
+        return jsonify({"error": str(e), "created": created}), 500
+    return jsonify({"created": created})
+
+def upload_options(form):
+    """Load mode plus key and index columns from the upload form: mode=upsert, key=a,b, primary_key=a,b
+    and indexes=c;d,e (or repeated indexes fields)"""
+    def column_list(value):
+        return tuple(dict.fromkeys(column.strip() for column in value.split(',') if column.strip()))
+    
+    mode = (form.get('mode') or 'replace').strip().lower()
+    if mode not in UPLOAD_MODES:
+        raise UploadSchemaError(f"Unknown upload mode '{mode}'. Use one of: {', '.join(UPLOAD_MODES)}")
+    indexes = [column_list(entry) for value in form.getlist('indexes') for entry in value.split(';')]
+    return UploadOptions(
+        primary_key=column_list(form.get('primary_key', '')),
+        indexes=tuple(dict.fromkeys(index for index in indexes if index)),
+        mode=mode,
+        key=column_list(form.get('key', ''))
+    )
+
+@retry_on_lock
+def process_upload(engine, file_path, filename, file_type, table_name, progress=None, options=None):
+    """Parse an uploaded file and load it into `table_name`, returning ingestion stats"""
+    kind = upload_kind(filename, file_type)
+    if kind == 'json':
+        return ingest_json(engine, table_name, file_path, app.config['UPLOAD_CHUNK_SIZE'], progress, options)
+    elif kind == 'xlsx':
+        return ingest_excel(engine, table_name, file_path, app.config['UPLOAD_CHUNK_SIZE'], progress, options)
+    elif kind == 'xls':
+        return ingest_frames(engine, table_name, upload_parse.iter_file_frames(file_path, kind, None), progress, options)
+    else:
+        return ingest_csv(engine, table_name, file_path, app.config['UPLOAD_CHUNK_SIZE'], progress, options)
+
+def upload_many(files, options):
+    """Load several files, or the files inside ZIP archives, in one request and report on each
+
+    Files whose content and options match what their tables were last loaded from are skipped.
+    """
+    if request.form.get('background', '').lower() in ('1', 'true', 'on', 'yes'):
+        return jsonify({"error": "Background uploads take one file at a time"}), 400
+    reload = request.form.get('reload', '').lower() in ('1', 'true', 'on', 'yes')
+    
+    engine = get_user_engine()
+    saved = []
+    tasks = []
+    sources = []
+    skipped = []
+    unreadable = []
+    try:
+        for file in files:
+            file_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}_{secure_filename(file.filename)}")
+            content_hash = save_upload(file, file_path)
+            saved.append(file_path)
+            try:
+                if file.filename.lower().endswith('.zip'):
+                    members = extract_upload_archive(file_path)
+                    saved.extend(path for _, path, _ in members)
+                else:
+                    members = [(file.filename, file_path, content_hash)]
+                for name, path, member_hash in members:
+                    table_name = safe_table_name(os.path.splitext(os.path.basename(name))[0])
+                    member_tasks = upload_tasks(name, path, None, table_name)
+                    options_key = upload_options_key(options, member_tasks[0].kind)
+                    tables = [task.table_name for task in member_tasks]
+                    existing = options.mode in CATALOG_MODES and not reload and \
+                        find_loaded_upload(engine, tables, member_hash, options_key)
+                    if existing:
+                        skipped.extend(
+                            {"filename": name, "sheet": task.sheet, "parse_time": None, "load_time": 0, "error": None,
+                             "deduplicated": True, **entry}
+                            for task, entry in zip(member_tasks, existing)
+                        )
+                        continue
+                    sources.append((name, member_hash, options_key, range(len(tasks), len(tasks) + len(member_tasks))))
+                    tasks.extend(member_tasks)
+            except (UploadSchemaError, zipfile.BadZipFile) as e:
+                return jsonify({"error": f"{file.filename}: {e}"}), 400
+            except Exception as e:
+                # e.g. a workbook whose sheet list can't be read; the other files still load
+                unreadable.append({"filename": file.filename, "sheet": None, "table_name": None, "row_count": 0,
+                                   "columns": [], "schema": {}, "parse_time": None, "load_time": None,
+                                   "error": f"Could not read file: {e}"})
+        
+        logger.info(f"Loading {len(tasks)} tables from {len(files)} uploaded files ({len(skipped)} unchanged)")
+        forget_uploads(engine, [task.table_name for task in tasks])
+        batch = ingest_upload_tasks(engine, tasks, options) if tasks else {
+            "files": [], "row_count": 0, "elapsed": 0, "rows_per_second": 0, "loaded": 0, "failed": 0
+        }
+        if options.mode in CATALOG_MODES:
+            for name, content_hash, options_key, positions in sources:
+                entries = [batch['files'][position] for position in positions]
+                if not any(entry['error'] for entry in entries):
+                    record_upload(engine, flask_session.get('user_id'), content_hash, options_key, name,
+                                  {entry['table_name']: {**entry, "mode": options.mode} for entry in entries})
+        
+        manifest = batch['files'] + skipped + unreadable
+        for entry in manifest:
+            label = f"{entry['filename']} [{entry['sheet']}]" if entry['sheet'] else entry['filename']
+            if entry['error']:
+                log_query(f"UPLOAD: {label}", 'upload', entry['load_time'], success=False, error_message=entry['error'])
+            elif not entry.get('deduplicated'):
+                log_query(f"UPLOAD: {label} -> {entry['table_name']}", 'upload', entry['load_time'], success=True)
+        
+        failed = batch['failed'] + len(unreadable)
+        loaded = [entry['table_name'] for entry in batch['files'] if not entry['error'] and entry['columns']]
+        unchanged = [entry['table_name'] for entry in skipped if entry['columns']]
+        message = (f"Loaded {len(loaded)} of {len(manifest)} tables: " + ", ".join(f"'{t}'" for t in loaded)
+                   if loaded else "No tables were loaded")
+        if unchanged:
+            message += "; unchanged since their last upload: " + ", ".join(f"'{t}'" for t in unchanged)
+        return jsonify({
+            "message": message,
+            "files": manifest,
+            "row_count": batch['row_count'],
+            "elapsed": batch['elapsed'],
+            "rows_per_second": batch['rows_per_second'],
+            "deduplicated": len(skipped),
+            "failed": failed
+        }), 207 if failed else 200
+    finally:
+        invalidate_results([task.table_name for task in tasks])
+        for path in saved:
+            if os.path.exists(path):
+                os.remove(path)
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
     try:
-        # Use /tmp directory for Render compatibility
-        UPLOAD_FOLDER = '/tmp/uploads'
         os.makedirs(UPLOAD_FOLDER, exist_ok=True)
         
         logger.info("Upload request received")
@@ -635,85 +4431,124 @@ def upload_file():
             logger.error("No file part in request")
             return jsonify({"error": "No file part"}), 400
 
-        file = request.files['file']
-        if file.filename == '':
+        files = [file for file in request.files.getlist('file') if file.filename != '']
+        if not files:
             logger.error("No selected file")
             return jsonify({"error": "No selected file"}), 400
-
-        logger.info(f"Processing file: {file.filename}")
+        if len(files) > app.config['UPLOAD_MAX_FILES']:
+            return jsonify({"error": f"At most {app.config['UPLOAD_MAX_FILES']} files can be uploaded at once"}), 400
 
         # Validate file type
-        allowed_extensions = {'csv', 'json', 'xlsx', 'xls'}
-        if not file.filename.lower().endswith(tuple(allowed_extensions)):
-            logger.error(f"Invalid file type: {file.filename}")
-            return jsonify({"error": "File type not allowed"}), 400
-
-        table_name = os.path.splitext(file.filename)[0].lower()
-        table_name = ''.join(c if c.isalnum() else '_' for c in table_name)
-        if table_name[0].isdigit():
-            table_name = 'f_' + table_name
-
-        file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-        logger.info(f"Saving file to: {file_path}")
-        file.save(file_path)
+        for file in files:
+            if not file.filename.lower().endswith((*UPLOAD_EXTENSIONS, '.zip')):
+                logger.error(f"Invalid file type: {file.filename}")
+                return jsonify({"error": "File type not allowed"}), 400
 
         try:
-            if request.form.get('file_type') == 'json':
-                import json
-                with open(file_path, 'r') as f:
-                    data = json.load(f)
-
-                def flatten_json(data):
-                    flattened = []
-                    for item in data:
-                        flat_item = {}
-                        for key, value in item.items():
-                            if isinstance(value, dict):
-                                for nested_key, nested_value in value.items():
-                                    if isinstance(nested_value, (str, int, float, bool)):
-                                        flat_item[f"{key}_{nested_key}"] = nested_value
-                            elif isinstance(value, list):
-                                flat_item[key] = json.dumps(value)
-                            else:
-                                flat_item[key] = value
-                        flattened.append(flat_item)
-                    return flattened
-
-                flattened_data = flatten_json(data if isinstance(data, list) else [data])
-                df = pd.DataFrame(flattened_data)
-            elif file.filename.lower().endswith(('.xlsx', '.xls')):
-                df = pd.read_excel(file_path)
-            else:
-                df = pd.read_csv(file_path)
+            options = upload_options(request.form)
+        except UploadSchemaError as e:
+            return jsonify({"error": str(e)}), 400
+        if len(files) > 1 or files[0].filename.lower().endswith('.zip'):
+            return upload_many(files, options)
 
-            logger.info(f"File loaded successfully. Shape: {df.shape}")
+        file = files[0]
+        logger.info(f"Processing file: {file.filename}")
+        table_name = safe_table_name(os.path.splitext(file.filename)[0])
 
-            with app.app_context():
-                inspector = db.inspect(db.engine)
-                if table_name in inspector.get_table_names():
-                    logger.info(f"Dropping existing table: {table_name}")
-                    db.session.execute(text(f'DROP TABLE IF EXISTS {table_name}'))
-                    db.session.commit()
+        # Unique on-disk name so concurrent uploads of the same file don't collide
+        file_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}_{secure_filename(file.filename)}")
+        logger.info(f"Saving file to: {file_path}")
+        content_hash = save_upload(file, file_path)
+        file_type = request.form.get('file_type')
+        engine = get_user_engine()
+        tables = upload_tables(file_path, file.filename, table_name)
+        options_key = upload_options_key(options, upload_kind(file.filename, file_type))
+        
+        # reload=true loads the file even when its tables already hold it
+        if options.mode in CATALOG_MODES and request.form.get('reload', '').lower() not in ('1', 'true', 'on', 'yes'):
+            lookup_start = time.monotonic()
+            existing = find_loaded_upload(engine, tables, content_hash, options_key)
+            if existing:
+                os.remove(file_path)
+                loaded = [entry['table_name'] for entry in existing if entry.get('columns')]
+                logger.info(f"{file.filename} is unchanged since it was loaded into {', '.join(loaded)}; skipping")
+                return jsonify({
+                    "message": f"File is unchanged since it was loaded; using existing "
+                               + (f"table '{loaded[0]}'" if len(loaded) == 1 else "tables " + ", ".join(f"'{t}'" for t in loaded)),
+                    "table_name": table_name,
+                    **({field: existing[0].get(field) for field in CATALOG_FIELDS} if len(existing) == 1 else {}),
+                    "elapsed": time.monotonic() - lookup_start,
+                    "deduplicated": True,
+                    "tables": [entry for entry in existing if entry.get('columns')] if len(existing) > 1 else []
+                })
+        
+        if request.form.get('background', '').lower() in ('1', 'true', 'on', 'yes'):
+            user_id = flask_session.get('user_id')
+            job = UploadJob(
+                id=uuid.uuid4().hex,
+                user_id=user_id,
+                filename=file.filename,
+                table_name=table_name,
+                status='queued',
+                worker_pid=os.getpid(),
+                heartbeat_at=datetime.utcnow()
+            )
+            # Claimed before the row exists, so recovery never takes it for an earlier process's job
+            local_upload_jobs.add(job.id)
+            db.session.add(job)
+            db.session.commit()
+            get_upload_executor().submit(run_upload_job, job.id, engine, file_path, file.filename, file_type, table_name,
+                                         user_id, options, content_hash)
+            
+            logger.info(f"Queued upload job {job.id} for {file.filename}")
+            return jsonify({
+                "message": f"Upload of '{file.filename}' queued as job {job.id}",
+                "job_id": job.id,
+                "table_name": table_name,
+                "status_url": url_for('upload_job_detail', job_id=job.id)
+            }), 202
 
-            logger.info(f"Creating table: {table_name}")
-            df.to_sql(table_name, db.engine, index=False, if_exists='replace')
+        try:
+            forget_uploads(engine, tables)
+            stats = process_upload(engine, file_path, file.filename, file_type, table_name, options=options)
+            if options.mode in CATALOG_MODES:
+                record_upload(engine, flask_session.get('user_id'), content_hash, options_key, file.filename,
+                              loaded_table_stats(stats, tables))
+            
+            # Blank sheets don't create tables
+            loaded = [entry['table_name'] for entry in stats.get('tables', [])] or [table_name]
             
             # Log the upload
-            log_query(f"UPLOAD: {file.filename} -> {table_name}", 'upload', success=True)
+            log_query(f"UPLOAD: {file.filename} -> {', '.join(loaded)}", 'upload', stats['elapsed'], success=True)
             
-            logger.info(f"Upload successful. Table: {table_name}, Rows: {len(df)}, Columns: {list(df.columns)}")
+            logger.info(f"Upload successful. Tables: {', '.join(loaded)}, Rows: {stats['row_count']}, Columns: {stats['columns']}")
             
             return jsonify({
-                "message": f"File uploaded successfully as table '{table_name}'",
+                "message": UPLOAD_MESSAGES[stats['mode']].format(
+                    tables=f"table '{loaded[0]}'" if len(loaded) == 1 else "tables " + ", ".join(f"'{t}'" for t in loaded)
+                ),
                 "table_name": table_name,
-                "columns": list(df.columns),
-                "row_count": len(df)
+                "columns": stats['columns'],
+                "row_count": stats['row_count'],
+                "elapsed": stats['elapsed'],
+                "rows_per_second": stats['rows_per_second'],
+                "schema": stats['schema'],
+                "mode": stats['mode'],
+                "primary_key": stats['primary_key'],
+                "key": stats['key'],
+                "indexes": stats['indexes'],
+                "tables": stats.get('tables', [])
             })
+        except UploadSchemaError as e:
+            log_query(f"UPLOAD: {file.filename}", 'upload', success=False, error_message=str(e))
+            return jsonify({"error": str(e)}), 400
         except Exception as e:
             logger.error(f"Error processing file: {str(e)}")
             log_query(f"UPLOAD: {file.filename}", 'upload', success=False, error_message=str(e))
             return jsonify({"error": f"Error processing file: {str(e)}"}), 500
         finally:
+            # The tables may have been changed even if the load failed partway
+            invalidate_results(tables)
             if os.path.exists(file_path):
                 os.remove(file_path)
                 logger.info(f"Cleaned up temporary file: {file_path}")
@@ -721,6 +4556,17 @@ def upload_file():
         logger.error(f"Upload route error: {str(e)}")
         return jsonify({"error": f"Upload failed: {str(e)}"}), 500
 
+@app.route('/upload/jobs/<job_id>')
+@login_required
+def upload_job_detail(job_id):
+    job = db.session.get(UploadJob, job_id)
+    if job is None or job.user_id != flask_session.get('user_id'):
+        return jsonify({"error": "Upload job not found"}), 404
+    
+    if job.status in ('queued', 'running') and job.id not in upload_job_progress:
+        recover_upload_jobs([job])
+    return jsonify(upload_job_status(job))
+
 @app.route('/visualize', methods=['GET', 'POST'])
 @login_required
 def visualize_page():
@@ -731,7 +4577,16 @@ def visualize_page():
         query = request.json.get('query')
         x_axis = request.json.get('x_axis')
         y_axis = request.json.get('y_axis')
-        chart_type = request.json.get('chart_type', 'bar')
+        aggregate = (request.json.get('aggregate') or 'sum').lower()
+        output_format = request.json.get('format') or 'png'
+        if output_format not in CHART_FORMATS:
+            return jsonify({"error": f"format must be one of {', '.join(CHART_FORMATS)}"}), 400
+        try:
+            chart_type, size, dpi = chart_options(request.json)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if aggregate not in CHART_AGGREGATES:
+            return jsonify({"error": f"aggregate must be one of {', '.join(CHART_AGGREGATES)}"}), 400
         
         logger.info(f"Visualization request - Query: {query}, X: {x_axis}, Y: {y_axis}, Type: {chart_type}")
         
@@ -745,13 +4600,30 @@ def visualize_page():
             return jsonify({"error": message}), 400
         
         with app.app_context():
-            result = db.session.execute(text(query))
-            rows = result.fetchall()
+            engine = get_user_engine()
+            limits = get_query_limits()
+            try:
+                query_id = claim_query_id(request.json.get('query_id'))
+            except QueryIdError as e:
+                return jsonify({"error": str(e)}), e.status_code
+            truncated = False
+            start_time = datetime.now()
+            timings = QueryTimings()
+            try:
+                if chart_type == 'bar':
+                    columns, rows, reduction = fetch_bar_data(query, engine, x_axis, y_axis, aggregate,
+                                                              app.config['CHART_MAX_BARS'], limits, query_id, timings)
+                else:
+                    columns, rows, cache_hit, truncated = fetch_select_cached(query, engine, limits, query_id, timings)
+                    reduction = None
+            except QueryAborted as e:
+                execution_time = (datetime.now() - start_time).total_seconds()
+                log_query(query, e.status, execution_time, False, str(e))
+                return jsonify({"error": str(e), "status": e.status}), e.status_code
             if not rows:
                 return jsonify({"error": "No data returned from query"}), 404
 
-            df = pd.DataFrame(rows)
-            df.columns = result.keys()
+            df = pd.DataFrame(rows, columns=columns)
             
             logger.info(f"DataFrame columns: {list(df.columns)}")
             logger.info(f"DataFrame shape: {df.shape}")
@@ -774,81 +4646,171 @@ def visualize_page():
                 except Exception as e:
                     return jsonify({"error": f"Column '{y_axis}' must contain numeric data"}), 400
 
-            plt.figure(figsize=(15, 8))
-            plt.style.use('seaborn-v0_8')
-
-            if df[x_axis].dtype == 'object':
-                x_values = range(len(df[x_axis]))
-                if chart_type == "scatter":
-                    plt.scatter(x_values, df[y_axis], alpha=0.7, s=100)
-                elif chart_type == "line":
-                    plt.plot(x_values, df[y_axis], marker='o', linewidth=2, markersize=6)
-                else:  # bar chart
-                    bars = plt.bar(x_values, df[y_axis], alpha=0.8)
-                    # Add value labels on bars
-                    for bar in bars:
-                        height = bar.get_height()
-                        plt.text(bar.get_x() + bar.get_width()/2., height,
-                                f'{height:.1f}', ha='center', va='bottom')
-                plt.xticks(x_values, df[x_axis], rotation=45, ha='right')
-            else:
-                if chart_type == "scatter":
-                    plt.scatter(df[x_axis], df[y_axis], alpha=0.7, s=100)
-                elif chart_type == "line":
-                    plt.plot(df[x_axis], df[y_axis], marker='o', linewidth=2, markersize=6)
-                else:  # bar chart
-                    bars = plt.bar(df[x_axis], df[y_axis], alpha=0.8)
-                    for bar in bars:
-                        height = bar.get_height()
-                        plt.text(bar.get_x() + bar.get_width()/2., height,
-                                f'{height:.1f}', ha='center', va='bottom')
-
-            plt.xlabel(x_axis, fontsize=12, fontweight='bold')
-            plt.ylabel(y_axis, fontsize=12, fontweight='bold')
-            plt.title(f"{chart_type.capitalize()} Chart of {y_axis} vs {x_axis}", fontsize=14, fontweight='bold')
-            plt.grid(True, alpha=0.3)
-            plt.tight_layout()
-
-            # Use /tmp directory for Render compatibility
-            plot_path = '/tmp/plot.png'
-            plt.savefig(plot_path, dpi=300, bbox_inches='tight', facecolor='white')
-            plt.close()
+            if chart_type != 'bar':
+                original_points = len(df)
+                if output_format == 'data':
+                    # Browsers draw on a canvas of known width, so the client names its own budget
+                    try:
+                        budget = int(request.json.get('max_points') or app.config['CHART_MAX_POINTS'])
+                    except (TypeError, ValueError):
+                        return jsonify({"error": "max_points must be an integer"}), 400
+                    budget = max(3, min(budget, app.config['CHART_MAX_POINTS']))
+                else:
+                    budget = point_budget(size, dpi)
+                df, method = downsample_series(df, x_axis, y_axis, chart_type, budget)
+                if method:
+                    reduction = {
+                        "method": method,
+                        "original_points": original_points,
+                        "plotted_points": len(df)
+                    }
+            if reduction:
+                reduction["ratio"] = round(reduction["original_points"] / max(reduction["plotted_points"], 1), 2)
+                logger.info(f"Chart data reduced by {reduction['method']}: "
+                            f"{reduction['original_points']} -> {reduction['plotted_points']} points")
+
+            def log_chart_query():
+                execution_time = (datetime.now() - start_time).total_seconds()
+                log_query(query, 'select', execution_time, True,
+                          slow=slow_query_details(query, engine, execution_time, timings, len(rows), 'visualize', limits))
             
-            # Copy to static directory if it exists
-            static_plot_path = 'static/plot.png'
-            try:
-                import shutil
-                shutil.copy2(plot_path, static_plot_path)
-                plot_url = f"/{static_plot_path}"
-            except Exception as e:
-                logger.warning(f"Could not copy plot to static directory: {e}")
-                plot_url = f"/{plot_path}"
+            if output_format == 'data':
+                # Columnar series for drawing in the browser; no matplotlib render at all
+                with timings.stage('serialize'):
+                    response = negotiated_response({
+                        "chart_type": chart_type,
+                        "length": len(df),
+                        "truncated": truncated,
+                        "x": encode_chart_column(df[x_axis]),
+                        "y": encode_chart_column(df[y_axis]),
+                        "reduced": reduction is not None,
+                        "reduction": reduction
+                    })
+                log_chart_query()
+                return response
+
+            # Identical data and options always map to the same image, so render only on a miss
+            key = chart_key(df, x_axis, y_axis, chart_type, size, dpi)
+            chart_cached = chart_cache.get(key) is not None
+            plot_url = url_for('chart_image', chart_hash=key)
+            if not chart_cached:
+                try:
+                    with timings.stage('serialize'):
+                        png = chart_render_pool.render(df[list(dict.fromkeys([x_axis, y_axis]))], x_axis, y_axis, chart_type, size, dpi)
+                except ChartRenderBusy as e:
+                    return jsonify({"error": str(e)}), 503
+                if not chart_cache.put(key, png, len(png)):
+                    # Too large for the cache (or caching is off), so /charts/<hash>.png would 404; send the image inline
+                    plot_url = 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
+            log_chart_query()
 
-            logger.info(f"Visualization created successfully: {plot_url}")
+            logger.info(f"Visualization created successfully: {plot_url[:80]}")
             return jsonify({
                 "message": "Visualization created successfully",
-                "plot_url": plot_url
+                "plot_url": plot_url,
+                "cached": chart_cached,
+                "dpi": dpi,
+                "size": list(size),
+                "reduced": reduction is not None,
+                "reduction": reduction,
+                "truncated": truncated
             })
             
     except Exception as e:
         logger.error(f"Visualization error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/charts/<chart_hash>.png')
+@login_required
+def chart_image(chart_hash):
+    """Serve a rendered chart; the URL is a content hash so the image never changes"""
+    headers = {
+        "ETag": f'"{chart_hash}"',
+        "Cache-Control": "private, max-age=31536000, immutable"
+    }
+    if chart_hash in request.if_none_match:
+        return Response(status=304, headers=headers)
+    png = chart_cache.get(chart_hash)
+    if png is None:
+        return jsonify({"error": "Chart not found or expired; generate it again"}), 404
+    return Response(png, mimetype='image/png', headers=headers)
+
 @app.route('/report', methods=['GET', 'POST'])
 @login_required
 def report_page():
     if request.method == 'GET':
-        return render_template("report.html", message="Submit data using the form below.")
+        return render_template("report.html", message="Submit a query or a saved history entry to export.",
+                               formats=list(REPORT_FORMATS))
 
-    data = request.json.get('data')
-    report_path = 'static/report.csv'
+    # Accept JSON from scripts and plain form posts from the report page
+    payload = request.get_json(silent=True) or request.form
+    output_format = (payload.get('format') or 'csv').lower()
+    compress = str(payload.get('gzip', '')).lower() in ('1', 'true', 'on', 'yes')
+    if output_format not in REPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(REPORT_FORMATS)}"}), 400
+    
+    query = payload.get('query')
+    history_id = payload.get('history_id')
+    if history_id:
+        try:
+            history_id = int(history_id)
+        except (TypeError, ValueError):
+            return jsonify({"error": "history_id must be an integer"}), 400
+        entry = db.session.get(QueryHistory, history_id)
+        if entry is None or entry.user_id != flask_session.get('user_id'):
+            return jsonify({"error": "History entry not found"}), 404
+        query = entry.query
+    
+    if not query and payload.get('data') is not None:
+        # Inline rows from older clients are still accepted, but returned directly instead of written to static/
+        try:
+            df = pd.DataFrame(payload.get('data'))
+        except Exception as e:
+            logger.error(f"Report generation error: {e}")
+            return jsonify({"error": str(e)}), 400
+        return Response(df.to_csv(index=False), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=report.csv'})
+    
+    is_safe, message = validate_sql_query(query)
+    if not is_safe:
+        return jsonify({"error": message}), 400
+    if not is_select(query):
+        return jsonify({"error": "Only SELECT queries can be exported"}), 400
+    
+    start_time = datetime.now()
+    batch_size = app.config['MANAGE_STREAM_BATCH_SIZE']
+    limits = get_query_limits()
     try:
-        df = pd.DataFrame(data)
-        df.to_csv(report_path, index=False)
-        return jsonify({"message": "Report generated.", "report_url": report_path})
+        query_id = claim_query_id(payload.get('query_id'))
+    except QueryIdError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    connection = get_user_engine().connect().execution_options(yield_per=batch_size)
+    running = RunningQuery(query_id, flask_session.get('user_id'), connection, limits.timeout).arm()
+    try:
+        result = connection.execute(text(query))
     except Exception as e:
-        logger.error(f"Report generation error: {e}")
+        running.disarm()
+        connection.close()
+        execution_time = (datetime.now() - start_time).total_seconds()
+        aborted = running.aborted(e)
+        if aborted is not None:
+            log_query(query, aborted.status, execution_time, False, str(aborted))
+            return jsonify({"error": str(aborted), "status": aborted.status, "query_id": running.query_id}), aborted.status_code
+        log_query(query, 'error', execution_time, False, str(e))
         return jsonify({"error": str(e)}), 500
+    
+    filename = f"report.{output_format}" + (".gz" if compress else "")
+    generator = stream_export(connection, result, query, start_time, output_format, batch_size, running, compress)
+    # No Content-Length, so the server sends the body with chunked transfer encoding
+    return Response(stream_with_context(generator),
+                    mimetype='application/gzip' if compress else REPORT_FORMATS[output_format],
+                    headers={
+                        'Content-Disposition': f'attachment; filename={filename}',
+                        'X-Accel-Buffering': 'no',
+                        'Cache-Control': 'no-store',
+                        # For /manage/cancel while the download is running
+                        'X-Query-Id': running.query_id
+                    })
 
 @app.route('/ai-suggest', methods=['POST'])
 @login_required
@@ -860,51 +4822,82 @@ def ai_suggest():
     suggestion = get_hf_query_suggestion(query)
     return jsonify({"suggestion": suggestion})
 
+@app.route('/cache/stats')
+@login_required
+def cache_stats():
+    """Result and chart cache counters for tuning the cache sizes and TTLs"""
+    return jsonify({**result_cache.stats(), "charts": chart_cache.stats()})
+
 @app.route('/history')
 @login_required
 def query_history():
     page = request.args.get('page', 1, type=int)
     per_page = 20
+    # ?slow=1 lists queries over SLOW_QUERY_THRESHOLD with their plans instead of the full history
+    slow = request.args.get('slow', type=int) == 1
     
     try:
+        query_log_writer.flush()
         user_id = flask_session.get('user_id')
+        model = SlowQuery if slow else QueryHistory
         # Use a simple query to avoid complex SQLAlchemy operations
-        history = db.session.query(QueryHistory).filter(QueryHistory.user_id == user_id).order_by(QueryHistory.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
+        history = db.session.query(model).filter(model.user_id == user_id).order_by(model.created_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
     except Exception as e:
         logger.error(f"Error fetching query history: {e}")
         history = None
     
-    return render_template('history.html', title="Query History", history=history)
+    return render_template('history.html', title="Query History", history=history, slow=slow,
+                           slow_threshold=app.config['SLOW_QUERY_THRESHOLD'])
 
 @app.route('/dashboard')
 @login_required
 def dashboard():
     # Get user statistics
     try:
+        query_log_writer.flush()
         user_id = flask_session.get('user_id')
-        # Use simple queries to avoid complex SQLAlchemy operations
-        total_queries = db.session.query(QueryHistory).filter(QueryHistory.user_id == user_id).count()
-        successful_queries = db.session.query(QueryHistory).filter(QueryHistory.user_id == user_id, QueryHistory.success == True).count()
+        # Totals come from the incrementally maintained stats rows, one per query type
+        type_stats = db.session.query(UserQueryStats).filter(UserQueryStats.user_id == user_id).all()
+        if not type_stats and ensure_user_stats(user_id):
+            db.session.commit()
+            type_stats = db.session.query(UserQueryStats).filter(UserQueryStats.user_id == user_id).all()
+        
+        total_queries = sum(row.total_count for row in type_stats)
+        successful_queries = sum(row.success_count for row in type_stats)
+        total_execution_time = sum(row.total_execution_time for row in type_stats)
         recent_queries = db.session.query(QueryHistory).filter(QueryHistory.user_id == user_id).order_by(QueryHistory.created_at.desc()).limit(5).all()
         
         # Get database connections
-        connections = db.session.query(DatabaseConnection).filter(DatabaseConnection.user_id == user_id).all()
+        connections = db.session.query(DatabaseConnection).filter(DatabaseConnection.user_id == user_id).count()
         
         stats = {
             'total_queries': total_queries,
             'successful_queries': successful_queries,
             'success_rate': (successful_queries / total_queries * 100) if total_queries > 0 else 0,
-            'connections': len(connections),
-            'recent_queries': recent_queries
+            'average_execution_time': (total_execution_time / total_queries) if total_queries > 0 else 0,
+            'connections': connections,
+            'recent_queries': recent_queries,
+            'by_type': {
+                row.query_type: {
+                    'total': row.total_count,
+                    'successful': row.success_count,
+                    'failed': row.total_count - row.success_count,
+                    'average_execution_time': row.total_execution_time / row.total_count if row.total_count else 0
+                }
+                for row in sorted(type_stats, key=lambda row: row.query_type)
+            }
         }
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error fetching dashboard stats: {e}")
         stats = {
             'total_queries': 0,
             'successful_queries': 0,
             'success_rate': 0,
+            'average_execution_time': 0,
             'connections': 0,
-            'recent_queries': []
+            'recent_queries': [],
+            'by_type': {}
         }
     
     return render_template('dashboard.html', title="Dashboard", stats=stats)
@@ -1219,5 +5212,7 @@ if __name__ == '__main__':
     print(f"Database path: {db_path}")
     init_database()
     print("Database initialization complete")
+    with app.app_context():
+        ensure_upload_heartbeat()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
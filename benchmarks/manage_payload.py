@@ -0,0 +1,72 @@
+"""Compare /manage response sizes and serialization time for each wire format.
+
+Builds a synthetic result set and runs it through the same helpers the route uses
+(result_payload and negotiated_response), so the numbers match what clients receive.
+
+    python benchmarks/manage_payload.py --rows 50000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chatdb
+
+def sample_rows(count):
+    random.seed(42)
+    start = datetime(2024, 1, 1)
+    regions = ['north', 'south', 'east', 'west']
+    return [
+        (i, f"customer_{i}", random.choice(regions), round(random.uniform(1, 1000), 2),
+         random.randint(1, 50), (start + timedelta(minutes=i)).isoformat())
+        for i in range(count)
+    ]
+
+def measure(result_format, accept, accept_encoding, columns, rows, repeat):
+    headers = {'Accept': accept, 'Accept-Encoding': accept_encoding}
+    timings = []
+    for _ in range(repeat):
+        with chatdb.app.test_request_context('/manage', headers=headers):
+            started = time.perf_counter()
+            response = chatdb.negotiated_response(chatdb.result_payload(columns, rows, result_format))
+            size = len(response.get_data())
+            timings.append(time.perf_counter() - started)
+    return size, min(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    columns = ['id', 'name', 'region', 'amount', 'quantity', 'created_at']
+    rows = sample_rows(args.rows)
+    cases = [
+        ('rows (current)', 'rows', 'application/json', 'identity'),
+        ('columnar', 'columnar', 'application/json', 'identity'),
+        ('rows + gzip', 'rows', 'application/json', 'gzip'),
+        ('columnar + gzip', 'columnar', 'application/json', 'gzip'),
+        ('columnar + deflate', 'columnar', 'application/json', 'deflate'),
+    ]
+    if chatdb.msgpack is not None:
+        cases += [
+            ('columnar msgpack', 'columnar', 'application/msgpack', 'identity'),
+            ('columnar msgpack + gzip', 'columnar', 'application/msgpack', 'gzip'),
+        ]
+    else:
+        print("msgpack is not installed; skipping MessagePack cases")
+
+    baseline = None
+    print(f"{args.rows} rows x {len(columns)} columns")
+    print(f"{'format':<26}{'bytes':>12}{'vs current':>12}{'ms':>10}")
+    for label, result_format, accept, encoding in cases:
+        size, seconds = measure(result_format, accept, encoding, columns, rows, args.repeat)
+        baseline = baseline or size
+        print(f"{label:<26}{size:>12,}{size / baseline:>11.2f}x{seconds * 1000:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Time a multi-file upload with parsing in the loading thread versus in worker processes.
+
+Writes a set of CSV files and loads them through ingest_upload_tasks, the helper behind
+multi-file and ZIP uploads, into a fresh SQLite database per run. The parse phase should
+shrink with the number of worker processes, up to the number of cores.
+
+    python benchmarks/multi_upload.py --files 16 --rows 200000 --workers 0 2 4
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def write_csvs(directory, files, rows):
+    random.seed(42)
+    paths = []
+    for number in range(files):
+        path = os.path.join(directory, f"part_{number}.csv")
+        with open(path, 'w') as f:
+            f.write("id,region,amount,quantity,created_at\n")
+            for i in range(rows):
+                f.write(f"{i},{random.choice(('north', 'south', 'east', 'west'))},{random.uniform(1, 1000):.2f},"
+                        f"{random.randint(1, 50)},2024-01-{1 + i % 28:02d}\n")
+        paths.append(path)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=16)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4])
+    args = parser.parse_args()
+
+    import logging
+    import app as chatdb
+    from sqlalchemy import create_engine
+
+    chatdb.logger.setLevel(logging.ERROR)
+    directory = tempfile.mkdtemp(prefix='chatdb-bench-')
+    paths = write_csvs(directory, args.files, args.rows)
+    tasks = [chatdb.UploadTask(os.path.basename(path), path, 'csv', f"part_{number}") for number, path in enumerate(paths)]
+
+    print(f"{args.files} CSV files x {args.rows} rows, {os.cpu_count()} CPUs")
+    print(f"{'parse workers':<15}{'wall s':>9}{'rows/s':>12}{'parse s (sum)':>15}{'load s (sum)':>14}")
+    for workers in args.workers:
+        chatdb.app.config['UPLOAD_PARSE_WORKERS'] = workers
+        engine = create_engine(f"sqlite:///{os.path.join(directory, f'bench_{workers}.db')}")
+        started = time.perf_counter()
+        with chatdb.app.app_context():
+            batch = chatdb.ingest_upload_tasks(engine, tasks)
+        wall = time.perf_counter() - started
+        parse = sum(entry['parse_time'] or 0 for entry in batch['files'])
+        load = sum(entry['load_time'] or 0 for entry in batch['files'])
+        print(f"{workers:<15}{wall:>9.2f}{batch['row_count'] / wall:>12.0f}{parse:>15.2f}{load:>14.2f}")
+        engine.dispose()
+        # Start each run with a pool of the requested size
+        if chatdb.parse_executor is not None:
+            chatdb.parse_executor.shutdown()
+            chatdb.parse_executor = None
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Measure SQLite lock errors and throughput with concurrent writer and reader processes.
+
+Runs the same workload under the legacy profile (rollback journal, no retries) and the
+WAL profile, using the connection settings and retry helper from app.py. Writers mimic the
+query history writer (read stats, insert a batch, upsert counters); readers mimic the
+history and dashboard pages; uploaders replace a table in one long transaction like /upload.
+Lock errors appear once a transaction holds the database longer than the 5s busy timeout.
+
+    python benchmarks/sqlite_concurrency.py --writers 4 --readers 4 --uploaders 1 --seconds 20
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCHEMA = [
+    "CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, query TEXT, "
+    "execution_time FLOAT, created_at DATETIME)",
+    "CREATE INDEX ix_history_user_created ON history (user_id, created_at)",
+    "CREATE TABLE stats (user_id INTEGER PRIMARY KEY, total_count INTEGER, total_execution_time FLOAT)",
+    "CREATE TABLE upload (id INTEGER, name TEXT, amount FLOAT)"
+]
+ROLES = ('writer', 'reader', 'uploader')
+BATCH_SIZE = 20
+USERS = 8
+
+def run_worker(role, worker_id, db_file, seconds, upload_rows, barrier, results):
+    import logging
+    import app as chatdb
+    from sqlalchemy import create_engine, text
+
+    chatdb.logger.setLevel(logging.ERROR)
+    engine = create_engine(f"sqlite:///{db_file}")
+    user_id = worker_id % USERS
+
+    @chatdb.retry_on_lock
+    def write_batch():
+        with engine.begin() as connection:
+            connection.execute(text("SELECT total_count FROM stats WHERE user_id = :user_id"), {"user_id": user_id}).fetchall()
+            now = datetime.utcnow()
+            connection.execute(
+                text("INSERT INTO history (user_id, query, execution_time, created_at) VALUES (:user_id, :query, 0.01, :now)"),
+                [{"user_id": user_id, "query": f"SELECT {i}", "now": now} for i in range(BATCH_SIZE)]
+            )
+            connection.execute(text(
+                "INSERT INTO stats (user_id, total_count, total_execution_time) VALUES (:user_id, :count, :time) "
+                "ON CONFLICT (user_id) DO UPDATE SET total_count = total_count + excluded.total_count, "
+                "total_execution_time = total_execution_time + excluded.total_execution_time"
+            ), {"user_id": user_id, "count": BATCH_SIZE, "time": BATCH_SIZE * 0.01})
+
+    def read_page():
+        with engine.connect() as connection:
+            connection.execute(text(
+                "SELECT * FROM history WHERE user_id = :user_id ORDER BY created_at DESC LIMIT 20"
+            ), {"user_id": user_id}).fetchall()
+            connection.execute(text("SELECT * FROM stats WHERE user_id = :user_id"), {"user_id": user_id}).fetchall()
+            # Full pass over the history, like the per-type totals behind the dashboard and stats backfill
+            connection.execute(text(
+                "SELECT user_id, COUNT(*), SUM(execution_time) FROM history GROUP BY user_id"
+            )).fetchall()
+
+    @chatdb.retry_on_lock
+    def upload_table():
+        with engine.begin() as connection:
+            connection.execute(text("DELETE FROM upload"))
+            for start in range(0, upload_rows, 50000):
+                connection.execute(
+                    text("INSERT INTO upload (id, name, amount) VALUES (:id, :name, :amount)"),
+                    [{"id": i, "name": f"row {i}", "amount": i * 0.5} for i in range(start, min(start + 50000, upload_rows))]
+                )
+
+    operation = {'writer': write_batch, 'reader': read_page, 'uploader': upload_table}[role]
+    completed = errors = 0
+    latencies = []
+    barrier.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            operation()
+            completed += 1
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            if not chatdb.is_lock_error(e):
+                raise
+            errors += 1
+    engine.dispose()
+    results.put((role, completed, errors, max(latencies, default=0)))
+
+def run_profile(profile, retries, args):
+    db_file = os.path.join(tempfile.mkdtemp(prefix='chatdb-bench-'), 'bench.db')
+    connection = sqlite3.connect(db_file)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    connection.commit()
+    connection.close()
+
+    # Spawned workers read these when they import app.py
+    os.environ['SQLITE_STORAGE_PROFILE'] = profile
+    os.environ['SQLITE_WRITE_RETRIES'] = str(retries)
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(args.writers + args.readers + args.uploaders)
+    results = context.Queue()
+    workers = [
+        context.Process(target=run_worker, args=(role, worker_id, db_file, args.seconds, args.upload_rows, barrier, results))
+        for worker_id, role in enumerate(['writer'] * args.writers + ['reader'] * args.readers + ['uploader'] * args.uploaders)
+    ]
+    for worker in workers:
+        worker.start()
+    totals = {role: {"completed": 0, "errors": 0, "worst": 0.0} for role in ROLES}
+    for _ in workers:
+        role, completed, errors, worst = results.get()
+        totals[role]['completed'] += completed
+        totals[role]['errors'] += errors
+        totals[role]['worst'] = max(totals[role]['worst'], worst)
+    for worker in workers:
+        worker.join()
+    return totals
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--uploaders', type=int, default=1)
+    parser.add_argument('--upload-rows', type=int, default=1500000)
+    parser.add_argument('--seconds', type=float, default=20)
+    args = parser.parse_args()
+
+    print(f"{args.writers} writers, {args.readers} readers and {args.uploaders} uploaders ({args.upload_rows} rows each), "
+          f"{args.seconds:g}s per profile, {BATCH_SIZE} rows per history write")
+    print(f"{'profile':<22}{'role':<9}{'ops/s':>9}{'lock errors':>13}{'error rate':>12}{'worst ms':>10}")
+    for label, profile, retries in (('legacy, no retries', 'legacy', 0), ('wal + retries', 'wal', 5)):
+        totals = run_profile(profile, retries, args)
+        for role, entry in totals.items():
+            if not getattr(args, role + 's'):
+                continue
+            attempts = entry['completed'] + entry['errors']
+            rate = entry['errors'] / attempts if attempts else 0
+            print(f"{label:<22}{role:<9}{entry['completed'] / args.seconds:>9.1f}{entry['errors']:>13}"
+                  f"{rate:>11.1%}{entry['worst'] * 1000:>10.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Chart rendering for ChatDB, run inside the render worker processes.
+
+Kept separate from app.py so worker processes import only matplotlib and pandas,
+not the Flask application. Uses the object-oriented Figure API rather than pyplot,
+so no global figure state is shared between renders.
+"""
+import io
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.style
+from matplotlib.figure import Figure
+import pandas as pd
+
+CHART_STYLE = 'seaborn-v0_8'
+CHART_BAR_LABEL_LIMIT = 50
+CHART_TICK_LABEL_LIMIT = 50
+
+def init_worker():
+    """Apply the chart style once and render a throwaway figure so fonts are loaded before the first request"""
+    matplotlib.style.use(CHART_STYLE)
+    figure = Figure(figsize=(2, 2))
+    axes = figure.subplots()
+    axes.bar([0, 1], [1, 2])
+    axes.set_title("warm-up", fontsize=14, fontweight='bold')
+    axes.set_xlabel("x", fontsize=12, fontweight='bold')
+    figure.tight_layout()
+    figure.savefig(io.BytesIO(), format='png', dpi=50)
+
+def render_chart_png(df, x_axis, y_axis, chart_type, size, dpi):
+    """Draw the chart and return the PNG bytes without touching the filesystem"""
+    figure = Figure(figsize=size)
+    axes = figure.subplots()
+
+    if df[x_axis].dtype == 'object':
+        x_values = range(len(df[x_axis]))
+        if chart_type == "scatter":
+            axes.scatter(x_values, df[y_axis], alpha=0.7, s=100)
+        elif chart_type == "line":
+            axes.plot(x_values, df[y_axis], marker='o', linewidth=2, markersize=6)
+        else:  # bar chart
+            bars = axes.bar(x_values, df[y_axis], alpha=0.8)
+            # Add value labels on bars while they are still readable
+            if len(bars) <= CHART_BAR_LABEL_LIMIT:
+                for bar in bars:
+                    height = bar.get_height()
+                    axes.text(bar.get_x() + bar.get_width()/2., height,
+                              f'{height:.1f}', ha='center', va='bottom')
+        step = max(1, len(df) // CHART_TICK_LABEL_LIMIT)
+        axes.set_xticks(x_values[::step])
+        axes.set_xticklabels(df[x_axis].iloc[::step], rotation=45, ha='right')
+    else:
+        if chart_type == "scatter":
+            axes.scatter(df[x_axis], df[y_axis], alpha=0.7, s=100)
+        elif chart_type == "line":
+            axes.plot(df[x_axis], df[y_axis], marker='o', linewidth=2, markersize=6)
+        else:  # bar chart
+            bars = axes.bar(df[x_axis], df[y_axis], alpha=0.8)
+            if len(bars) <= CHART_BAR_LABEL_LIMIT:
+                for bar in bars:
+                    height = bar.get_height()
+                    axes.text(bar.get_x() + bar.get_width()/2., height,
+                              f'{height:.1f}', ha='center', va='bottom')
+
+    axes.set_xlabel(x_axis, fontsize=12, fontweight='bold')
+    axes.set_ylabel(y_axis, fontsize=12, fontweight='bold')
+    axes.set_title(f"{chart_type.capitalize()} Chart of {y_axis} vs {x_axis}", fontsize=14, fontweight='bold')
+    axes.grid(True, alpha=0.3)
+    figure.tight_layout()
+
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight', facecolor='white')
+    return buffer.getvalue()
@@ -24,6 +24,28 @@ document.getElementById("connect-sql-form")?.addEventListener("submit", async (e
     }
 });
 
+// Switch to a saved connection (an empty id selects the application database)
+document.querySelectorAll(".use-connection").forEach((button) => {
+    button.addEventListener("click", async () => {
+        const connectionId = button.dataset.connectionId;
+        try {
+            const res = await fetch("/connect", {
+                method: "POST",
+                headers: { "Content-Type": "application/json" },
+                body: JSON.stringify({ connection_id: connectionId ? Number(connectionId) : null }),
+            });
+            const result = await res.json();
+            if (result.error) {
+                alert(`Error: ${result.error}`);
+            } else {
+                window.location.reload();
+            }
+        } catch (error) {
+            alert("An error occurred while switching connections.");
+        }
+    });
+});
+
 // List SQL Tables
 document.getElementById("list-sql-tables")?.addEventListener("click", async () => {
     try {
@@ -44,7 +66,7 @@ document.getElementById("query-form")?.addEventListener("submit", async (e) => {
     e.preventDefault();
     const query = document.getElementById("query").value;
 
-    const payload = { db_type: "sql", query };
+    const payload = { db_type: "sql", query, format: "columnar" };
 
     try {
         const res = await fetch("/manage", {
@@ -64,11 +86,11 @@ document.getElementById("query-form")?.addEventListener("submit", async (e) => {
         dataOutput.appendChild(jsonTitle);
 
         const jsonOutput = document.createElement("pre");
-        jsonOutput.textContent = JSON.stringify(result.data, null, 2);
+        jsonOutput.textContent = JSON.stringify(result.rows ?? result.error ?? result.message);
         dataOutput.appendChild(jsonOutput);
 
         // Add Tabular Output title and display table if data exists
-        if (result.data && result.data.length > 0) {
+        if (result.rows && result.rows.length > 0) {
             const tableTitle = document.createElement("h5");
             tableTitle.textContent = "Tabular Output:";
             dataOutput.appendChild(tableTitle);
@@ -79,11 +101,10 @@ document.getElementById("query-form")?.addEventListener("submit", async (e) => {
             table.style.width = "100%";
 
             // Create table headers
-            const headers = Object.keys(result.data[0]);
             const thead = document.createElement("thead");
             const headerRow = document.createElement("tr");
 
-            headers.forEach((header) => {
+            result.columns.forEach((header) => {
                 const th = document.createElement("th");
                 th.textContent = header;
                 th.style.border = "1px solid black";
@@ -95,13 +116,13 @@ document.getElementById("query-form")?.addEventListener("submit", async (e) => {
             thead.appendChild(headerRow);
             table.appendChild(thead);
 
-            // Create table rows
+            // Create table rows straight from the row arrays
             const tbody = document.createElement("tbody");
-            result.data.forEach((row) => {
+            result.rows.forEach((row) => {
                 const tr = document.createElement("tr");
-                headers.forEach((header) => {
+                row.forEach((value) => {
                     const td = document.createElement("td");
-                    td.textContent = row[header];
+                    td.textContent = value;
                     td.style.border = "1px solid black";
                     td.style.padding = "8px";
                     tr.appendChild(td);
@@ -131,7 +152,8 @@ document.getElementById("visualize-form")?.addEventListener("submit", async (e)
         query: document.getElementById('query').value,
         x_axis: document.getElementById('x-axis').value,
         y_axis: document.getElementById('y-axis').value,
-        chart_type: document.getElementById('chart-type').value
+        chart_type: document.getElementById('chart-type').value,
+        dpi: 100
     };
 
     try {
@@ -150,7 +172,7 @@ document.getElementById("visualize-form")?.addEventListener("submit", async (e)
         } else {
             errorMessage.classList.add('d-none');
             const chartImg = document.getElementById('chart');
-            chartImg.src = `${result.plot_url}?t=${new Date().getTime()}`;
+            chartImg.src = result.plot_url;
             chartImg.classList.remove('d-none');
         }
     } catch (error) {
@@ -160,26 +182,58 @@ document.getElementById("visualize-form")?.addEventListener("submit", async (e)
     }
 });
 
-// Generate Report
-document.getElementById("report-form")?.addEventListener("submit", async (e) => {
-    e.preventDefault();
-    const data = document.getElementById("report-data").value;
-
-    try {
-        const res = await fetch("/report", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ data: JSON.parse(data) }),
-        });
+// Stream /manage results as NDJSON, handing each batch of rows to the caller as it arrives
+async function streamQuery(payload, handlers = {}) {
+    const { onColumns, onRows, onDone, onMessage, onError } = handlers;
+    const res = await fetch("/manage", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ ...payload, stream: true }),
+    });
+
+    // Non-SELECT statements and validation errors come back as a single JSON document
+    const contentType = res.headers.get("content-type") || "";
+    if (!contentType.includes("application/x-ndjson")) {
         const result = await res.json();
-        if (result.report_url) {
-            const link = document.getElementById("report-link");
-            link.href = result.report_url;
-            link.classList.remove("d-none");
+        if (result.error) {
+            onError?.(result.error, result);
         } else {
-            alert(result.error || "An error occurred while generating the report.");
+            onMessage?.(result);
+        }
+        return;
+    }
+
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+
+    const handleLine = (line) => {
+        if (!line.trim()) {
+            return;
+        }
+        const record = JSON.parse(line);
+        if (record.error) {
+            onError?.(record.error, record);
+        } else if (record.columns) {
+            onColumns?.(record.columns);
+        } else if (record.rows) {
+            onRows?.(record.rows);
+        } else if (record.done) {
+            onDone?.(record);
+        }
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        let newline;
+        while ((newline = buffer.indexOf("\n")) >= 0) {
+            handleLine(buffer.slice(0, newline));
+            buffer = buffer.slice(newline + 1);
         }
-    } catch (error) {
-        alert("Invalid JSON data provided for the report.");
     }
-});
\ No newline at end of file
+    handleLine(buffer + decoder.decode());
+}
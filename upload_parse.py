@@ -0,0 +1,206 @@
+"""Parsing of uploaded files into DataFrame chunks, run in the upload parse worker processes.
+
+Kept separate from app.py so worker processes import only pandas and openpyxl, not the Flask
+application. Every parser yields DataFrames of at most `batch_size` rows, so memory is bounded
+by one batch whichever process does the parsing.
+"""
+import json
+import pickle
+import time
+import zipfile
+from xml.etree import ElementTree
+
+from openpyxl import load_workbook
+import pandas as pd
+
+def iter_csv_frames(file_path, batch_size):
+    """CSV chunks; a file with only a header yields one empty frame so its table is still created"""
+    empty = True
+    for chunk in pd.read_csv(file_path, chunksize=batch_size):
+        empty = False
+        yield chunk
+    if empty:
+        yield pd.read_csv(file_path, nrows=0)
+
+def iter_json_records(file_path, read_size=1 << 16):
+    """Yield records from a JSON array, a single document or NDJSON without loading the whole file"""
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        pos = 0
+        eof = False
+        
+        def fill(size):
+            nonlocal buffer, pos, eof
+            chunk = f.read(size)
+            if not chunk:
+                eof = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+        
+        def skip(characters):
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in characters:
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return
+                fill(read_size)
+        
+        skip(' \t\r\n\ufeff')
+        in_array = pos < len(buffer) and buffer[pos] == '['
+        if in_array:
+            pos += 1
+        
+        while True:
+            skip(' \t\r\n,' if in_array else ' \t\r\n')
+            if pos >= len(buffer):
+                if in_array:
+                    raise ValueError("Unexpected end of file inside JSON array")
+                return
+            if in_array and buffer[pos] == ']':
+                return
+            
+            size = read_size
+            while True:
+                try:
+                    record, end = decoder.raw_decode(buffer, pos)
+                    # A value ending exactly at the buffer edge may be truncated (e.g. a number)
+                    if end < len(buffer) or eof:
+                        break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                # Grow reads geometrically so very large records don't decode quadratically
+                fill(size)
+                size *= 2
+            pos = end
+            yield record
+
+def flatten_record(record, prefix='', flat=None):
+    """Flatten nested objects to any depth as parent_child keys; lists are kept as JSON text"""
+    if flat is None:
+        flat = {}
+    for key, value in record.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flatten_record(value, f"{name}_", flat)
+        elif isinstance(value, list):
+            flat[name] = json.dumps(value)
+        else:
+            flat[name] = value
+    return flat
+
+def iter_json_frames(file_path, batch_size):
+    """Batch flattened JSON records into DataFrames over the column set seen so far"""
+    columns = {}
+    batch = []
+    emitted = False
+    for record in iter_json_records(file_path):
+        flat = flatten_record(record if isinstance(record, dict) else {"value": record})
+        for key in flat:
+            columns.setdefault(key, None)
+        batch.append(flat)
+        if len(batch) >= batch_size:
+            yield pd.DataFrame.from_records(batch, columns=list(columns))
+            emitted = True
+            batch = []
+    if batch or not emitted:
+        yield pd.DataFrame.from_records(batch, columns=list(columns))
+
+SPREADSHEETML_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+
+def excel_header(row):
+    """Column names from a sheet's header row, naming blank cells and numbering repeats"""
+    columns = []
+    for position, value in enumerate(row, start=1):
+        name = str(value).strip() if value is not None and str(value).strip() else f"column_{position}"
+        candidate, suffix = name, 1
+        while candidate in columns:
+            suffix += 1
+            candidate = f"{name}_{suffix}"
+        columns.append(candidate)
+    return columns
+
+def iter_excel_frames(sheet, batch_size):
+    """Stream a read-only openpyxl worksheet as DataFrames of at most batch_size rows"""
+    # Some writers store a wrong used range; re-scan instead of trusting it
+    sheet.reset_dimensions()
+    columns = None
+    batch = []
+    emitted = False
+    for row in sheet.iter_rows(values_only=True):
+        if all(value is None for value in row):
+            continue
+        if columns is None:
+            columns = excel_header(row)
+            continue
+        # Pad short rows; cells beyond the header have no column to go into
+        batch.append(tuple(row[:len(columns)]) + (None,) * (len(columns) - len(row)))
+        if len(batch) >= batch_size:
+            yield pd.DataFrame.from_records(batch, columns=columns)
+            emitted = True
+            batch = []
+    # A blank sheet has no header and yields nothing, so no table is created for it
+    if batch or (columns is not None and not emitted):
+        yield pd.DataFrame.from_records(batch, columns=columns)
+
+def excel_sheet_names(file_path):
+    """Worksheet names read from the workbook part alone.
+
+    Opening a workbook in read-only mode scans every sheet lacking a stored size, so only
+    ingestion pays for that.
+    """
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            root = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        sheets = [sheet.get('name') for sheet in root.iter(f"{{{SPREADSHEETML_NAMESPACE}}}sheet")]
+        if sheets:
+            return sheets
+    except (KeyError, ElementTree.ParseError):
+        pass
+    workbook = load_workbook(file_path, read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+def iter_file_frames(file_path, kind, batch_size, sheet=None):
+    """Chunks of one upload by kind: csv, json, xlsx (one `sheet`) or xls"""
+    if kind == 'json':
+        yield from iter_json_frames(file_path, batch_size)
+    elif kind == 'xlsx':
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            yield from iter_excel_frames(workbook[sheet] if sheet else workbook.worksheets[0], batch_size)
+        finally:
+            workbook.close()
+    elif kind == 'xls':
+        # Legacy binary workbooks aren't readable by openpyxl or in chunks
+        yield pd.read_excel(file_path, sheet_name=sheet or 0)
+    else:
+        yield from iter_csv_frames(file_path, batch_size)
+
+def parse_to_spool(file_path, kind, batch_size, spool_path, sheet=None):
+    """Worker entry point: parse a file and pickle its chunks one after another into `spool_path`
+
+    The loading thread reads them back with iter_spool, so parsing runs on all cores while
+    memory in both processes stays bounded by one chunk.
+    """
+    start = time.perf_counter()
+    rows = chunks = 0
+    with open(spool_path, 'wb') as spool:
+        for frame in iter_file_frames(file_path, kind, batch_size, sheet):
+            pickle.dump(frame, spool, protocol=pickle.HIGHEST_PROTOCOL)
+            rows += len(frame)
+            chunks += 1
+    return {"rows": rows, "chunks": chunks, "parse_time": time.perf_counter() - start}
+
+def iter_spool(spool_path):
+    """DataFrame chunks written by parse_to_spool, in order"""
+    with open(spool_path, 'rb') as spool:
+        while True:
+            try:
+                yield pickle.load(spool)
+            except EOFError:
+                return